@@ -0,0 +1,170 @@
+"""Historical backfill of IMAP mailboxes.
+
+``pyzap backfill`` imports old mail through a workflow's normal action chain.
+The requested date range is split into windows that become ``SINCE``/``BEFORE``
+searches. Windows are processed concurrently, each on its own copy of the
+workflow and therefore its own IMAP session. Completed windows are recorded
+in a checkpoint file, so an interrupted backfill only repeats the windows
+that were still running.
+"""
+
+from __future__ import annotations
+
+import copy
+import datetime as _dt
+from functools import partial
+import json
+import logging
+import os
+import sys
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config import load_config
+from .core import Workflow
+from .formatter import parse_date
+from .utils import run_parallel, safe_filename
+from . import state
+
+DEFAULT_WINDOW_DAYS = 7
+DEFAULT_PARALLEL = 4
+
+Window = Tuple[_dt.date, _dt.date]
+
+
+def _as_date(value: Any) -> _dt.date:
+    if isinstance(value, _dt.datetime):
+        return value.date()
+    if isinstance(value, _dt.date):
+        return value
+    return parse_date(str(value)).date()
+
+
+def date_windows(since: Any, until: Any, days: int = DEFAULT_WINDOW_DAYS) -> List[Window]:
+    """Split ``[since, until)`` into consecutive windows of ``days`` days."""
+    start, end = _as_date(since), _as_date(until)
+    if days < 1:
+        raise ValueError("Window size must be at least one day")
+    windows: List[Window] = []
+    while start < end:
+        stop = min(start + _dt.timedelta(days=days), end)
+        windows.append((start, stop))
+        start = stop
+    return windows
+
+
+def _window_key(window: Window) -> str:
+    return f"{window[0].isoformat()}/{window[1].isoformat()}"
+
+
+class _Checkpoint:
+    """Thread-safe record of the windows already processed."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done: List[str] = []
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as fh:
+                    self.done = list(json.load(fh).get("done", []))
+            except (OSError, ValueError) as exc:
+                logging.warning("Unable to read backfill checkpoint %s: %s", path, exc)
+
+    def __contains__(self, window: Window) -> bool:
+        return _window_key(window) in self.done
+
+    def add(self, window: Window) -> None:
+        with self.lock:
+            self.done.append(_window_key(window))
+            tmp_path = f"{self.path}.tmp"
+            with state.open_private(tmp_path, "w", encoding="utf-8") as fh:
+                json.dump({"done": sorted(self.done)}, fh)
+            os.replace(tmp_path, self.path)
+
+
+def _find_workflow(config_path: str, workflow_id: str) -> Dict[str, Any]:
+    data = load_config(config_path)
+    state.configure(config_path, data.get("state_dir") if isinstance(data, dict) else None)
+    workflows = data.get("workflows", []) if isinstance(data, dict) else data
+    for definition in workflows:
+        if definition.get("id") == workflow_id:
+            if definition["trigger"].get("type") != "imap_poll":
+                raise ValueError(f"Workflow {workflow_id} does not use the imap_poll trigger")
+            return definition
+    raise ValueError(f"Workflow {workflow_id} not found")
+
+
+def _run_window(definition: Dict[str, Any], window: Window, search: str) -> int:
+    """Process the messages of one window and return how many failed."""
+    definition = copy.deepcopy(definition)
+    trigger = definition["trigger"]
+    trigger.update(
+        search=search,
+        since=window[0].isoformat(),
+        before=window[1].isoformat(),
+        max_results=sys.maxsize,
+    )
+    # importing old mail should not change its read state
+    trigger.setdefault("mark_seen", False)
+    workflow = Workflow(definition)
+    workflow.trigger.raise_errors = True
+    logging.info("Backfilling %s window %s", workflow.id, _window_key(window))
+    return workflow.run()
+
+
+def backfill(
+    config_path: str,
+    workflow_id: str,
+    since: Any,
+    until: Optional[Any] = None,
+    *,
+    parallel: int = DEFAULT_PARALLEL,
+    window_days: int = DEFAULT_WINDOW_DAYS,
+    search: str = "ALL",
+    checkpoint_file: Optional[str] = None,
+) -> Dict[str, int]:
+    """Run ``workflow_id`` over the mail received between ``since`` and ``until``.
+
+    ``until`` is exclusive and defaults to tomorrow. ``search`` replaces the
+    workflow's own search so already read messages are included; the
+    trigger's other filters still apply. Returns the number of windows that
+    were ``done``, ``skipped`` (already checkpointed) and ``failed``.
+    A window is checkpointed only when every message in it was processed
+    without errors.
+    """
+    definition = _find_workflow(config_path, workflow_id)
+    if until is None:
+        until = _dt.date.today() + _dt.timedelta(days=1)
+    if not checkpoint_file:
+        checkpoint_file = os.path.join(
+            state.private_dir(state.root()), f"backfill-{safe_filename(workflow_id)}.json"
+        )
+    checkpoint = _Checkpoint(checkpoint_file)
+    windows = date_windows(since, until, window_days)
+    pending = [w for w in windows if w not in checkpoint]
+    summary = {"done": 0, "skipped": len(windows) - len(pending), "failed": 0}
+    logging.info(
+        "Backfilling %s: %d windows, %d already done",
+        workflow_id,
+        len(windows),
+        summary["skipped"],
+    )
+
+    def _task(window: Window) -> int:
+        failed = _run_window(definition, window, search)
+        if not failed:
+            checkpoint.add(window)
+        return failed
+
+    outcomes = run_parallel(
+        [partial(_task, w) for w in pending], max_workers=max(1, int(parallel))
+    )
+    for window, (ok, value) in zip(pending, outcomes):
+        if ok and not value:
+            summary["done"] += 1
+        else:
+            summary["failed"] += 1
+            reason = value if not ok else f"{value} messages failed"
+            logging.error("Backfill window %s failed: %s", _window_key(window), reason)
+    return summary
@@ -2,8 +2,11 @@
 
 import argparse
 import json
+import logging
 
-from .core import main_loop
+from . import outbox, state
+from .backfill import DEFAULT_PARALLEL, DEFAULT_WINDOW_DAYS, backfill
+from .core import load_plugins, main_loop, setup_logging
 from .config import load_config, save_config
 from .webapp import app as webapp_app
 
@@ -63,6 +66,51 @@ def run_engine(args: argparse.Namespace) -> None:
     )
 
 
+def run_backfill(args: argparse.Namespace) -> None:
+    """Processes historical IMAP mail through a workflow."""
+    setup_logging(log_level=getattr(logging, args.log_level.upper(), logging.INFO))
+    load_plugins()
+    try:
+        summary = backfill(
+            args.config,
+            args.workflow,
+            args.since,
+            args.until,
+            parallel=args.parallel,
+            window_days=args.window_days,
+            search=args.search,
+            checkpoint_file=args.checkpoint,
+        )
+    except ValueError as exc:
+        raise SystemExit(str(exc)) from exc
+    print(
+        f"Backfill of {args.workflow}: {summary['done']} windows done, "
+        f"{summary['skipped']} already done, {summary['failed']} failed"
+    )
+    if summary["failed"]:
+        raise SystemExit(1)
+
+
+def show_outbox(args: argparse.Namespace) -> None:
+    """Prints the state of the asynchronous action outbox."""
+    config = load_config(args.config)
+    options = config.get("outbox", {}) if isinstance(config, dict) else {}
+    state.configure(args.config, config.get("state_dir") if isinstance(config, dict) else None)
+    box = outbox.Outbox(options.get("path"))
+    try:
+        if args.retry:
+            print(f"Queued {box.retry_failed()} failed jobs again")
+        counts = box.status()
+        print(", ".join(f"{counts[s]} {s}" for s in outbox.STATUSES))
+        for job in box.jobs(args.status, limit=args.limit) if args.status else []:
+            print(
+                f"#{job['id']} {job['workflow']} {job['action']} [{job['key']}] "
+                f"{job['status']} attempts={job['attempts']} {job['error'] or ''}".rstrip()
+            )
+    finally:
+        box.close()
+
+
 def run_dashboard(args: argparse.Namespace) -> None:
     """Starts the Flask web dashboard."""
     print("Starting PyZap dashboard on http://127.0.0.1:5000")
@@ -114,6 +162,59 @@ def main() -> None:
     )
     sub_run.set_defaults(func=run_engine)
 
+    sub_backfill = sub.add_parser("backfill", help="Process historical IMAP mail")
+    sub_backfill.add_argument("workflow", help="Workflow id using imap_poll")
+    sub_backfill.add_argument("--since", required=True, help="First day (YYYY-MM-DD)")
+    sub_backfill.add_argument(
+        "--until",
+        default=None,
+        help="Day after the last one (YYYY-MM-DD), defaults to tomorrow",
+    )
+    sub_backfill.add_argument(
+        "--parallel",
+        type=int,
+        default=DEFAULT_PARALLEL,
+        help="Date windows processed concurrently",
+    )
+    sub_backfill.add_argument(
+        "--window-days",
+        type=int,
+        default=DEFAULT_WINDOW_DAYS,
+        help="Days covered by each window",
+    )
+    sub_backfill.add_argument(
+        "--search",
+        default="ALL",
+        help="IMAP search used instead of the workflow's one",
+    )
+    sub_backfill.add_argument(
+        "--checkpoint",
+        default=None,
+        help="File recording completed windows "
+        "(default backfill-<workflow>.json in the state directory)",
+    )
+    sub_backfill.add_argument(
+        "--log-level",
+        default="INFO",
+        help="Logging level (DEBUG, INFO, WARNING, ERROR)",
+    )
+    sub_backfill.set_defaults(func=run_backfill)
+
+    sub_outbox = sub.add_parser("outbox", help="Show queued asynchronous actions")
+    sub_outbox.add_argument(
+        "--status",
+        choices=outbox.STATUSES,
+        default=None,
+        help="List the most recent jobs in this state",
+    )
+    sub_outbox.add_argument("--limit", type=int, default=20, help="Jobs listed")
+    sub_outbox.add_argument(
+        "--retry",
+        action="store_true",
+        help="Queue failed jobs again; a running engine picks them up",
+    )
+    sub_outbox.set_defaults(func=show_outbox)
+
     sub_dashboard = sub.add_parser("dashboard", help="Run the web dashboard")
     sub_dashboard.set_defaults(func=run_dashboard)
 
@@ -9,12 +9,12 @@ import time
 import signal
 from abc import ABC, abstractmethod
 from email.message import EmailMessage
-import smtplib
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
-from typing import Any, Dict, List, Type
+from typing import Any, Dict, Iterable, List, Optional, Type
 
 from .config import load_config
+from . import http_client, message_cache, outbox, smtp_pool, state
 
 # Plugin registries
 TRIGGERS: Dict[str, Type["BaseTrigger"]] = {}
@@ -24,14 +24,33 @@ ACTIONS: Dict[str, Type["BaseAction"]] = {}
 class BaseTrigger(ABC):
     """Abstract base class for triggers."""
 
+    #: Push triggers wait for events inside ``poll``; the engine runs their
+    #: workflows continuously on a dedicated thread instead of on a schedule.
+    push = False
+    #: Set by triggers whose payloads are returned again by later polls until
+    #: they are committed, so failed payloads are not remembered as seen.
+    redeliver = False
+
     def __init__(self, config: Dict[str, Any]):
         self.config = config
 
     @abstractmethod
-    def poll(self) -> List[Dict[str, Any]]:
-        """Poll for new events and return a list of payloads."""
+    def poll(self) -> Iterable[Dict[str, Any]]:
+        """Poll for new events and return a list of payloads.
+
+        Long running triggers may return an iterator instead; its payloads
+        are processed as they are produced.
+        """
         raise NotImplementedError
 
+    def commit(self, payloads: List[Dict[str, Any]]) -> None:
+        """Acknowledge ``payloads`` whose action chain completed without errors.
+
+        Called once per run with every successful payload so triggers can
+        update their source (flags, labels, folders) in one batched call.
+        The default does nothing.
+        """
+
 
 class BaseAction(ABC):
     """Abstract base class for actions."""
@@ -44,6 +63,13 @@ class BaseAction(ABC):
         """Execute the action on normalized data."""
         raise NotImplementedError
 
+    def flush(self) -> None:
+        """Write out work that ``execute`` buffered.
+
+        Called at the end of every workflow run and when the engine stops.
+        The default does nothing.
+        """
+
 
 class Workflow:
     def __init__(self, definition: Dict[str, Any], *, step_mode: bool = False):
@@ -54,16 +80,38 @@ class Workflow:
             raise ValueError(f"Unknown trigger type {trigger_conf['type']}")
         self.trigger = trigger_cls(trigger_conf)
         self.actions = []
+        # index of each ``async`` action -> its ``async_key`` template
+        self.async_keys: Dict[int, Optional[str]] = {}
         for action_def in definition.get("actions", []):
             action_cls = ACTIONS.get(action_def["type"])
             if not action_cls:
                 raise ValueError(f"Unknown action type {action_def['type']}")
-            self.actions.append(action_cls(action_def.get("params", {})))
+            action = action_cls(action_def.get("params", {}))
+            if action_def.get("async"):
+                self.async_keys[len(self.actions)] = action_def.get("async_key")
+                outbox.register(self.id, len(self.actions), action)
+            self.actions.append(action)
         self.seen_ids = set()
         self.interval = int(trigger_conf.get("interval", 60))
         self.step_mode = step_mode
 
-    def run(self) -> None:
+    @staticmethod
+    def _seen_key(payload: Dict[str, Any]) -> Any:
+        """Return the key used to skip payloads that were already handled."""
+        msg_id = payload.get("id")
+        # IMAP sequence numbers shift when messages leave the mailbox
+        if payload.get("uid") and payload.get("uidvalidity"):
+            msg_id = f"uid:{payload['uidvalidity']}:{payload['uid']}"
+            # flag change events of one message differ by mod-sequence
+            if payload.get("modseq"):
+                msg_id += f":{payload['modseq']}"
+        # ids are only unique per mailbox when a trigger polls several
+        if msg_id and payload.get("account"):
+            msg_id = f"{payload['account']}:{msg_id}"
+        return msg_id
+
+    def run(self) -> int:
+        """Poll the trigger, run the actions and return how many payloads failed."""
         logging.info(
             "Running workflow %s using %s", self.id, type(self.trigger).__name__
         )
@@ -76,22 +124,28 @@ class Workflow:
             input("Press Enter to poll trigger...")
 
         messages = self.trigger.poll()
-        logging.info("Trigger returned %d messages", len(messages))
-        logging.debug(
-            "Trigger %s output payloads: %s",
-            type(self.trigger).__name__,
-            messages,
-        )
+        if isinstance(messages, list):
+            logging.info("Trigger returned %d messages", len(messages))
+            logging.debug(
+                "Trigger %s output payloads: %s",
+                type(self.trigger).__name__,
+                messages,
+            )
+        else:
+            logging.info("Trigger is streaming messages")
         if self.step_mode:
             input("Press Enter to process messages...")
+        succeeded: List[Dict[str, Any]] = []
+        failed = 0
         for payload in messages:
-            msg_id = payload.get("id")
+            msg_id = self._seen_key(payload)
             if msg_id and msg_id in self.seen_ids:
                 continue
             if msg_id:
                 self.seen_ids.add(msg_id)
             current = payload
-            for action in self.actions:
+            ok = True
+            for index, action in enumerate(self.actions):
                 if self.step_mode:
                     input(f"Press Enter to run action {type(action).__name__}...")
                 try:
@@ -103,7 +157,17 @@ class Workflow:
                         type(action).__name__,
                         normalized,
                     )
-                    result = action.execute(normalized)
+                    if index in self.async_keys:
+                        key = outbox.job_key(self.async_keys[index], self.id, index, normalized)
+                        job = outbox.get_outbox().enqueue(
+                            self.id, index, action, normalized, key=key
+                        )
+                        logging.info(
+                            "Action %s queued as outbox job %s", type(action).__name__, job
+                        )
+                        result = None
+                    else:
+                        result = action.execute(normalized)
                     logging.debug(
                         "Action %s output payload: %s",
                         type(action).__name__,
@@ -112,6 +176,7 @@ class Workflow:
                     if isinstance(result, dict):
                         current = result
                 except Exception as exc:  # pylint: disable=broad-except
+                    ok = False
                     logging.exception("Action %s failed: %s", action, exc)
                 else:
                     logging.info(
@@ -119,6 +184,32 @@ class Workflow:
                     )
                     if self.step_mode:
                         input("Press Enter to continue...")
+            if ok:
+                succeeded.append(payload)
+                continue
+            failed += 1
+            if msg_id and self.trigger.redeliver:
+                self.seen_ids.discard(msg_id)
+        self.flush()
+        if succeeded:
+            try:
+                self.trigger.commit(succeeded)
+            except Exception as exc:  # pylint: disable=broad-except
+                logging.exception("Trigger commit failed: %s", exc)
+                failed += len(succeeded)
+                if self.trigger.redeliver:
+                    # let the next poll deliver them again
+                    for payload in succeeded:
+                        self.seen_ids.discard(self._seen_key(payload))
+        return failed
+
+    def flush(self) -> None:
+        """Ask every action to write out its buffered work."""
+        for action in self.actions:
+            try:
+                action.flush()
+            except Exception as exc:  # pylint: disable=broad-except
+                logging.exception("Action %s flush failed: %s", action, exc)
 
 
 class WorkflowEngine:
@@ -131,6 +222,10 @@ class WorkflowEngine:
         self.load_config()
         self._stop_event = threading.Event()
         self._last_run: Dict[str, float] = {}
+        self._push_threads: Dict[str, threading.Thread] = {}
+        self._alerts: List[str] = []
+        self._alerts_due = 0.0
+        self._alerts_lock = threading.Lock()
 
     def load_config(self) -> None:
         data = load_config(self.config_path)
@@ -141,18 +236,49 @@ class WorkflowEngine:
 
         self.admin_email = config.get("admin_email")
         self.smtp_config = config.get("smtp", {})
+        state.configure(self.config_path, config.get("state_dir"))
+        if "message_cache" in config:
+            message_cache.configure(config["message_cache"])
+        if "http" in config:
+            http_client.configure(config["http"])
+        if "outbox" in config:
+            outbox.configure(config["outbox"])
 
         wf_defs = config.get("workflows", [])
         self.workflows = [Workflow(defn, step_mode=self.step_mode) for defn in wf_defs]
+        if any(wf.async_keys for wf in self.workflows):
+            # resume jobs recorded before the last shutdown
+            outbox.get_outbox().start()
 
     def run_all(self) -> None:
         logging.debug("Engine cycle running %d workflows", len(self.workflows))
         for wf in self.workflows:
+            if wf.trigger.push:
+                self._start_push(wf)
+                continue
             last = self._last_run.get(wf.id, 0)
             if time.time() - last < wf.interval:
                 continue
             self._run_workflow(wf)
             self._last_run[wf.id] = time.time()
+        self.flush_alerts()
+
+    def _start_push(self, workflow: Workflow) -> None:
+        """Run a push-triggered workflow on its own thread until stopped."""
+        thread = self._push_threads.get(workflow.id)
+        if thread is not None and thread.is_alive():
+            return
+
+        def _loop() -> None:
+            while not self._stop_event.is_set():
+                self._run_workflow(workflow)
+
+        thread = threading.Thread(
+            target=_loop, name=f"pyzap-push-{workflow.id}", daemon=True
+        )
+        self._push_threads[workflow.id] = thread
+        thread.start()
+        logging.info("Started push workflow %s", workflow.id)
 
     def _run_workflow(self, workflow: Workflow) -> None:
         retry = 0
@@ -170,40 +296,66 @@ class WorkflowEngine:
             self.notify_admin(workflow.id)
 
     def notify_admin(self, workflow_id: str) -> None:
-        """Send a failure notification email to the administrator."""
+        """Send a failure notification email to the administrator.
+
+        With ``coalesce`` (seconds) in the ``smtp`` settings, failures within
+        that window are reported together in a single email.
+        """
         if not self.admin_email:
             logging.error("Admin email not configured")
             logging.error("Workflow %s failed after retries", workflow_id)
             return
 
+        window = float(self.smtp_config.get("coalesce", 0))
+        if window > 0:
+            with self._alerts_lock:
+                if not self._alerts:
+                    self._alerts_due = time.time() + window
+                if workflow_id not in self._alerts:
+                    self._alerts.append(workflow_id)
+        else:
+            self._send_alert([workflow_id])
+        logging.error("Workflow %s failed after retries", workflow_id)
+
+    def flush_alerts(self, *, force: bool = False) -> None:
+        """Send the coalesced admin alert once its window has passed."""
+        with self._alerts_lock:
+            if not self._alerts or (not force and time.time() < self._alerts_due):
+                return
+            workflow_ids, self._alerts = self._alerts, []
+        self._send_alert(workflow_ids)
+
+    def _send_alert(self, workflow_ids: List[str]) -> None:
         message = EmailMessage()
-        message["Subject"] = f"PyZap workflow {workflow_id} failed"
+        if len(workflow_ids) == 1:
+            message["Subject"] = f"PyZap workflow {workflow_ids[0]} failed"
+        else:
+            message["Subject"] = f"PyZap: {len(workflow_ids)} workflows failed"
         message["From"] = self.smtp_config.get("from_addr", self.admin_email)
         message["To"] = self.admin_email
         message.set_content(
-            f"Workflow {workflow_id} failed after maximum retries."
+            "\n".join(
+                f"Workflow {workflow_id} failed after maximum retries."
+                for workflow_id in workflow_ids
+            )
         )
 
-        host = self.smtp_config.get("host", "localhost")
-        port = int(self.smtp_config.get("port", 25))
-        username = self.smtp_config.get("username")
-        password = self.smtp_config.get("password")
-        use_tls = self.smtp_config.get("tls")
-
         try:
-            with smtplib.SMTP(host, port) as smtp:
-                if use_tls:
-                    smtp.starttls()
-                if username and password:
-                    smtp.login(username, password)
-                smtp.send_message(message)
-                logging.info("Admin notification sent for workflow %s", workflow_id)
+            smtp_pool.send(self.smtp_config, [message])
+            logging.info("Admin notification sent for workflows %s", ", ".join(workflow_ids))
         except Exception as exc:  # pylint: disable=broad-except
             logging.exception("Failed to send admin notification: %s", exc)
-        logging.error("Workflow %s failed after retries", workflow_id)
 
     def stop(self) -> None:
         self._stop_event.set()
+        for wf in self.workflows:
+            close = getattr(wf.trigger, "close", None)
+            if wf.trigger.push and close is not None:
+                close()
+            wf.flush()
+        outbox.close()
+        self.flush_alerts(force=True)
+        smtp_pool.close_all()
 
 
 def setup_logging(log_file: str = "pyzap.log", *, log_level: int = logging.INFO) -> None:
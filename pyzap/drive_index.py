@@ -0,0 +1,229 @@
+"""Google Drive folder and file lookups shared by the archive actions.
+
+Archive actions store every message in a Drive folder named after it.
+Resolving that folder and checking which files it already holds only takes
+metadata calls. The results are cached here, so re-running a workflow
+neither creates duplicate folders nor uploads unchanged files again.
+The most recently used folder ids and listings are kept in memory, the
+least recently used are dropped past :data:`MAX_FOLDERS` and
+:data:`MAX_LISTINGS`. Folder ids can also be persisted to a JSON file, in
+which case an entry is checked against Drive once before it is trusted.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set, Tuple
+from urllib import error, parse, request
+
+from . import http_client
+
+FILES_URL = "https://www.googleapis.com/drive/v3/files"
+FOLDER_MIME = "application/vnd.google-apps.folder"
+# Seconds a folder listing is reused before Drive is asked again.
+LISTING_TTL = 300.0
+# Folder ids and folder listings kept in memory before the oldest are dropped.
+MAX_FOLDERS = 10000
+MAX_LISTINGS = 256
+
+_lock = threading.Lock()
+_folders: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+_verified: Set[str] = set()
+_loaded: Set[str] = set()
+_guards: Dict[Tuple[str, str], threading.Lock] = {}
+_listings: "OrderedDict[str, Tuple[float, Dict[str, Dict[str, Any]]]]" = OrderedDict()
+
+
+def _remember(key: Tuple[str, str], folder: str) -> None:
+    """Cache ``folder`` for ``key``, dropping the least recently used; caller holds ``_lock``."""
+    _folders[key] = folder
+    _folders.move_to_end(key)
+    while len(_folders) > MAX_FOLDERS:
+        old_key, old_id = _folders.popitem(last=False)
+        _verified.discard(old_id)
+        guard = _guards.get(old_key)
+        if guard is not None and not guard.locked():
+            del _guards[old_key]
+
+
+def _store_listing(folder: str, files: Dict[str, Dict[str, Any]]) -> None:
+    """Cache the listing of ``folder``, dropping expired and excess ones; caller holds ``_lock``."""
+    now = time.monotonic()
+    _listings[folder] = (now, files)
+    _listings.move_to_end(folder)
+    while _listings and (
+        len(_listings) > MAX_LISTINGS or now - next(iter(_listings.values()))[0] >= LISTING_TTL
+    ):
+        _listings.popitem(last=False)
+
+
+def _q(value: str) -> str:
+    """Quote ``value`` as a string literal in a Drive search query."""
+    return "'%s'" % value.replace("\\", "\\\\").replace("'", "\\'")
+
+
+def _request(url: str, token: str, body: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    headers = {"Authorization": f"Bearer {token}"}
+    data = None
+    if body is not None:
+        headers["Content-Type"] = "application/json"
+        data = json.dumps(body).encode()
+    req = request.Request(url, data=data, headers=headers)
+    with http_client.urlopen(req) as resp:
+        return json.loads(resp.read().decode() or "{}")
+
+
+def _load(cache_file: str) -> None:
+    """Merge the persisted folder ids of ``cache_file``; caller holds ``_lock``."""
+    if cache_file in _loaded:
+        return
+    _loaded.add(cache_file)
+    try:
+        with open(cache_file, "r", encoding="utf-8") as fh:
+            entries = json.load(fh)
+    except (OSError, ValueError):
+        return
+    for entry in entries:
+        key = (entry["parent"], entry["name"])
+        if key not in _folders:
+            _remember(key, entry["id"])
+
+
+def _save(cache_file: str) -> None:
+    with _lock:
+        entries = [{"parent": p, "name": n, "id": i} for (p, n), i in _folders.items()]
+    tmp_path = f"{cache_file}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            json.dump(entries, fh)
+        os.replace(tmp_path, cache_file)
+    except OSError as exc:
+        logging.warning("Unable to save Drive folder cache %s: %s", cache_file, exc)
+
+
+def _exists(file_id: str, token: str) -> bool:
+    try:
+        meta = _request(f"{FILES_URL}/{file_id}?fields=id,trashed", token)
+    except error.HTTPError as exc:
+        if exc.code == 404:
+            return False
+        raise
+    return not meta.get("trashed")
+
+
+def new_folder(name: str, parent: Optional[str], token: str) -> str:
+    """Create folder ``name`` under ``parent`` and return its id.
+
+    Unlike :func:`folder_id` this never reuses an existing folder, for
+    names that do not identify their content.
+    """
+    metadata: Dict[str, Any] = {"name": name, "mimeType": FOLDER_MIME}
+    if parent:
+        metadata["parents"] = [parent]
+    new_id = _request(FILES_URL, token, metadata)["id"]
+    logging.debug("Created Drive folder %s (%s)", name, new_id)
+    with _lock:
+        _store_listing(new_id, {})
+    return new_id
+
+
+def folder_id(name: str, parent: Optional[str], token: str, *, cache_file: Optional[str] = None) -> str:
+    """Return the id of folder ``name`` under ``parent``, creating it if needed."""
+    key = (parent or "root", name)
+    with _lock:
+        if cache_file:
+            _load(cache_file)
+        cached = _folders.get(key)
+        if cached:
+            _folders.move_to_end(key)
+        guard = _guards.setdefault(key, threading.Lock())
+    if cached and cached in _verified:
+        return cached
+    # one thread per folder, so concurrent uploads do not create twins
+    with guard:
+        with _lock:
+            cached = _folders.get(key)
+        if cached and cached in _verified:
+            return cached
+        if cached and _exists(cached, token):
+            with _lock:
+                _verified.add(cached)
+            return cached
+        query = (
+            f"name = {_q(name)} and {_q(key[0])} in parents "
+            f"and mimeType = {_q(FOLDER_MIME)} and trashed = false"
+        )
+        found = _request(
+            f"{FILES_URL}?" + parse.urlencode({"q": query, "fields": "files(id)", "pageSize": 1}),
+            token,
+        ).get("files", [])
+        if found:
+            new_id = found[0]["id"]
+            logging.debug("Reusing Drive folder %s (%s)", name, new_id)
+        else:
+            new_id = new_folder(name, parent, token)
+        with _lock:
+            _remember(key, new_id)
+            _verified.add(new_id)
+    if cache_file:
+        _save(cache_file)
+    return new_id
+
+
+def list_files(folder: str, token: str) -> Dict[str, Dict[str, Any]]:
+    """Return the files of ``folder`` by name with their ``id`` and ``md5Checksum``."""
+    with _lock:
+        cached = _listings.get(folder)
+        if cached:
+            _listings.move_to_end(folder)
+    if cached and time.monotonic() - cached[0] < LISTING_TTL:
+        return dict(cached[1])
+    files: Dict[str, Dict[str, Any]] = {}
+    params = {
+        "q": f"{_q(folder)} in parents and trashed = false",
+        "fields": "nextPageToken,files(id,name,md5Checksum)",
+        "pageSize": 1000,
+    }
+    while True:
+        page = _request(f"{FILES_URL}?" + parse.urlencode(params), token)
+        for item in page.get("files", []):
+            files.setdefault(item["name"], item)
+        if not page.get("nextPageToken"):
+            break
+        params["pageToken"] = page["nextPageToken"]
+    with _lock:
+        _store_listing(folder, files)
+    return dict(files)
+
+
+def record_file(folder: str, name: str, file_id: Optional[str], md5: str) -> None:
+    """Remember an uploaded file so later checks need no listing."""
+    with _lock:
+        cached = _listings.get(folder)
+        if cached is not None:
+            cached[1][name] = {"id": file_id, "name": name, "md5Checksum": md5}
+
+
+def md5_file(path: str) -> str:
+    """Return the hex MD5 digest of ``path``, as reported by Drive."""
+    digest = hashlib.md5()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def clear() -> None:
+    """Forget every cached folder and listing."""
+    with _lock:
+        _folders.clear()
+        _verified.clear()
+        _loaded.clear()
+        _guards.clear()
+        _listings.clear()
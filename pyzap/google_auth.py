@@ -0,0 +1,201 @@
+"""Process-wide cache of Google OAuth credentials and API service objects.
+
+Loading a token file, refreshing it and calling
+``googleapiclient.discovery.build`` are comparatively slow, so every Google
+plugin obtains its credentials and services here. Credentials are shared by
+token file and refreshed shortly before they expire; refreshed tokens are
+written back to the token file atomically. Service objects wrap an
+``httplib2`` connection that is not thread-safe, so they are cached per
+thread.
+
+Plugins calling the REST APIs directly (Drive uploads, Sheets) get their
+bearer token from :func:`bearer_token`. A token file shared by several
+plugins, or by workflows running in parallel, is refreshed once: refreshes
+are serialised per file, and a caller that waited picks up the token
+written by the first instead of refreshing again.
+"""
+
+from __future__ import annotations
+
+import datetime as _dt
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# Refresh tokens this many seconds before they expire.
+REFRESH_MARGIN = 300
+
+_CredKey = Tuple[str, Tuple[str, ...]]
+
+
+class _CredentialEntry:
+    def __init__(self, creds: Any, mtime: Optional[float]):
+        self.creds = creds
+        self.mtime = mtime
+
+
+_lock = threading.Lock()
+_credentials: Dict[_CredKey, _CredentialEntry] = {}
+_file_locks: Dict[str, threading.Lock] = {}
+_services: Dict[Tuple[_CredKey, str, str, int], Any] = {}
+
+
+def _mtime(path: str) -> Optional[float]:
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _needs_refresh(creds: Any) -> bool:
+    if not getattr(creds, "refresh_token", None):
+        return False
+    if getattr(creds, "expired", False):
+        return True
+    expiry = getattr(creds, "expiry", None)
+    if not isinstance(expiry, _dt.datetime):
+        return False
+    # google-auth stores ``expiry`` as a naive UTC datetime
+    now = _dt.datetime.now(_dt.timezone.utc).replace(tzinfo=None)
+    return expiry - now < _dt.timedelta(seconds=REFRESH_MARGIN)
+
+
+def _file_scopes(path: str) -> List[str]:
+    """Return the scopes recorded in token file ``path``."""
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            scopes = json.load(fh).get("scopes") or []
+    except (OSError, ValueError, AttributeError):
+        return []
+    return scopes.split() if isinstance(scopes, str) else list(scopes)
+
+
+def _write_token(path: str, creds: Any) -> Optional[float]:
+    """Persist refreshed ``creds`` to ``path`` and return its new mtime.
+
+    A token granted fewer scopes than the file records is not written, so
+    it cannot break the other plugins sharing the file.
+    """
+    to_json = getattr(creds, "to_json", None)
+    if to_json is None or not os.path.exists(path):
+        return _mtime(path)
+    stored = set(_file_scopes(path))
+    granted = set(getattr(creds, "granted_scopes", None) or getattr(creds, "scopes", None) or ())
+    if stored and not stored <= granted:
+        logging.warning(
+            "Not saving refreshed token %s: missing scopes %s",
+            path,
+            ", ".join(sorted(stored - granted)),
+        )
+        return _mtime(path)
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            fh.write(to_json())
+        os.replace(tmp_path, path)
+    except OSError as exc:
+        logging.warning("Unable to save refreshed token %s: %s", path, exc)
+    return _mtime(path)
+
+
+def _load(path: str, scopes: Sequence[str]) -> Any:
+    from google.oauth2.credentials import Credentials
+
+    logging.debug("Loading credentials from %s", path)
+    # refresh with every scope the file was authorised for, not only the
+    # caller's subset, because the refreshed token is shared through the file
+    return Credentials.from_authorized_user_file(path, _file_scopes(path) or list(scopes))
+
+
+def _entry(token_file: str, scopes: Sequence[str]) -> Tuple[_CredKey, _CredentialEntry]:
+    key = (os.path.abspath(token_file), tuple(sorted(scopes)))
+    mtime = _mtime(token_file)
+    with _lock:
+        entry = _credentials.get(key)
+        if entry is not None and entry.mtime == mtime:
+            return key, entry
+    # First use, or the token file was replaced (for example re-authorised).
+    creds = _load(token_file, scopes)
+    with _lock:
+        entry = _CredentialEntry(creds, mtime)
+        _credentials[key] = entry
+        for service_key in [k for k in _services if k[0] == key]:
+            del _services[service_key]
+    return key, entry
+
+
+def _valid(token_file: str, scopes: Sequence[str]) -> Tuple[_CredKey, Any]:
+    key, entry = _entry(token_file, scopes)
+    if not _needs_refresh(entry.creds):
+        return key, entry.creds
+    with _lock:
+        file_lock = _file_locks.setdefault(key[0], threading.Lock())
+    with file_lock:
+        # another caller may have refreshed the file while we waited
+        key, entry = _entry(token_file, scopes)
+        if _needs_refresh(entry.creds):
+            from google.auth.transport.requests import Request
+
+            logging.debug("Refreshing Google token %s", token_file)
+            entry.creds.refresh(Request())
+            entry.mtime = _write_token(token_file, entry.creds)
+    return key, entry.creds
+
+
+def get_credentials(token_file: str, scopes: Sequence[str]) -> Any:
+    """Return valid credentials for ``token_file``, refreshing when needed."""
+    return _valid(token_file, scopes)[1]
+
+
+def access_token(token_file: str) -> str:
+    """Return a current OAuth access token from ``token_file``.
+
+    The token keeps the scopes it was authorised with.
+    """
+    return get_credentials(token_file, ()).token
+
+
+def bearer_token(params: Dict[str, Any], file_param: str = "token_file") -> Optional[str]:
+    """Return the bearer token configured for a Google REST plugin.
+
+    A token file named by ``params[file_param]`` is preferred, then a static
+    ``token``, then the ``GDRIVE_TOKEN_FILE`` and ``GDRIVE_TOKEN``
+    environment variables.
+    """
+    if params.get(file_param):
+        return access_token(params[file_param])
+    if params.get("token"):
+        return params["token"]
+    if os.environ.get("GDRIVE_TOKEN_FILE"):
+        return access_token(os.environ["GDRIVE_TOKEN_FILE"])
+    return os.environ.get("GDRIVE_TOKEN")
+
+
+def get_service(api: str, version: str, token_file: str, scopes: Sequence[str]) -> Any:
+    """Return a cached ``googleapiclient`` service for the calling thread."""
+    key, creds = _valid(token_file, scopes)
+    service_key = (key, api, version, threading.get_ident())
+    with _lock:
+        service = _services.get(service_key)
+    if service is not None:
+        return service
+    from googleapiclient.discovery import build
+
+    logging.debug("Building %s %s service for %s", api, version, token_file)
+    service = build(api, version, credentials=creds, cache_discovery=False)
+    with _lock:
+        alive = {t.ident for t in threading.enumerate()}
+        for stale in [k for k in _services if k[3] not in alive]:
+            del _services[stale]
+        _services[service_key] = service
+    return service
+
+
+def clear() -> None:
+    """Forget every cached credential and service."""
+    with _lock:
+        _credentials.clear()
+        _services.clear()
+        _file_locks.clear()
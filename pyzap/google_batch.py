@@ -0,0 +1,152 @@
+"""Batch execution of Google API requests.
+
+The Google API client can combine up to 100 calls into a single HTTP
+round-trip with ``service.new_batch_http_request``. :func:`execute_batch`
+wraps it with per-item error reporting and exponential backoff for the items
+rejected by rate limiting, and falls back to executing requests one by one
+when the service object does not provide batching. :func:`execute` applies
+the same backoff to a single request.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+MAX_BATCH_SIZE = 100
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF = 1.0
+
+_RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+
+def error_status(exc: BaseException) -> Optional[int]:
+    """Return the HTTP status carried by a Google API error, if any."""
+    resp = getattr(exc, "resp", None)
+    status = getattr(resp, "status", None) or getattr(exc, "status_code", None)
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_rate_limited(exc: BaseException) -> bool:
+    """Return ``True`` if ``exc`` is an HTTP 429 or a quota 403 error."""
+    status = error_status(exc)
+    if status == 429:
+        return True
+    if status != 403:
+        return False
+    content = getattr(exc, "content", b"")
+    try:
+        if isinstance(content, bytes):
+            content = content.decode("utf-8", "replace")
+        errors = json.loads(content).get("error", {}).get("errors", [])
+    except Exception:
+        return False
+    return any(err.get("reason") in _RATE_LIMIT_REASONS for err in errors)
+
+
+def _execute_round(
+    service: Any, requests: Dict[int, Any], batch_size: int
+) -> Dict[int, Tuple[bool, Any]]:
+    """Run ``requests`` once, in batches of ``batch_size``."""
+    outcomes: Dict[int, Tuple[bool, Any]] = {}
+    pending = sorted(requests)
+    factory = getattr(service, "new_batch_http_request", None)
+    if factory is None:
+        for index in pending:
+            try:
+                outcomes[index] = (True, requests[index].execute())
+            except Exception as exc:  # pylint: disable=broad-except
+                outcomes[index] = (False, exc)
+        return outcomes
+
+    def callback(request_id: str, response: Any, exception: Optional[BaseException]) -> None:
+        index = int(request_id)
+        if exception is not None:
+            outcomes[index] = (False, exception)
+        else:
+            outcomes[index] = (True, response)
+
+    for start in range(0, len(pending), batch_size):
+        chunk = pending[start : start + batch_size]
+        batch = factory(callback=callback)
+        for index in chunk:
+            batch.add(requests[index], request_id=str(index))
+        try:
+            batch.execute()
+        except Exception as exc:  # pylint: disable=broad-except
+            # The whole batch was rejected; report it for every item.
+            for index in chunk:
+                outcomes.setdefault(index, (False, exc))
+    return outcomes
+
+
+def execute(
+    request: Any, *, max_retries: int = DEFAULT_MAX_RETRIES, backoff: float = DEFAULT_BACKOFF
+) -> Any:
+    """Execute a single request, retrying rate limit errors.
+
+    Meant for calls made concurrently from worker threads, which are the
+    most likely to hit per-user quotas. The delays follow
+    :func:`execute_batch`.
+    """
+    attempt = 0
+    while True:
+        try:
+            return request.execute()
+        except Exception as exc:  # pylint: disable=broad-except
+            if not is_rate_limited(exc) or attempt >= max_retries:
+                raise
+            delay = backoff * (2 ** attempt)
+            logging.warning("Google API request rate limited, retrying in %.1fs", delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+def execute_batch(
+    service: Any,
+    requests: Sequence[Any],
+    *,
+    batch_size: int = MAX_BATCH_SIZE,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    backoff: float = DEFAULT_BACKOFF,
+) -> List[Tuple[bool, Any]]:
+    """Execute ``requests`` in batched HTTP round-trips.
+
+    Returns one ``(ok, value)`` tuple per request in input order, where
+    ``value`` is the response or the exception raised for that item. Items
+    rejected with HTTP 429 (or a rate limit 403) are retried in a new batch
+    after an exponential delay starting at ``backoff`` seconds, up to
+    ``max_retries`` times.
+    """
+
+    batch_size = max(1, min(int(batch_size), MAX_BATCH_SIZE))
+    results: List[Tuple[bool, Any]] = [(False, None)] * len(requests)
+    pending = dict(enumerate(requests))
+    attempt = 0
+    while pending:
+        outcomes = _execute_round(service, pending, batch_size)
+        retry: Dict[int, Any] = {}
+        for index, request in pending.items():
+            ok, value = outcomes.get(
+                index, (False, RuntimeError("no response in batch"))
+            )
+            if not ok and is_rate_limited(value) and attempt < max_retries:
+                retry[index] = request
+            results[index] = (ok, value)
+        if not retry:
+            break
+        delay = backoff * (2 ** attempt)
+        logging.warning(
+            "Google API rate limited %d request(s), retrying in %.1fs",
+            len(retry),
+            delay,
+        )
+        time.sleep(delay)
+        attempt += 1
+        pending = retry
+    return results
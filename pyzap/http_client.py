@@ -0,0 +1,443 @@
+"""Shared HTTP client with keep-alive connection pooling.
+
+Plugins calling Google and Slack REST endpoints send their requests through
+:func:`urlopen` instead of :func:`urllib.request.urlopen`, which opens a new
+TCP and TLS connection for every request. Connections are kept alive and
+reused per host. Every request gets a default timeout, gzip responses are
+decoded transparently, and 429 and 5xx answers to idempotent requests are
+retried with exponential backoff (honouring ``Retry-After``). Requests such
+as ``POST`` are only repeated when they failed before being sent. The number
+of requests in flight to a single host is bounded. Proxies configured with
+``HTTP_PROXY``, ``HTTPS_PROXY`` and ``NO_PROXY`` are honoured like urllib
+does; ``https`` requests are tunnelled through the proxy with ``CONNECT``.
+
+:func:`urlopen` accepts the same :class:`urllib.request.Request` objects and
+raises the same :class:`urllib.error.HTTPError` for error statuses, so
+callers keep their existing error handling.
+"""
+
+from __future__ import annotations
+
+import base64
+import http.client
+import io
+import logging
+import select
+import ssl
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
+from urllib import error, request
+from urllib.parse import unquote, urljoin, urlsplit
+import zlib
+
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_PER_HOST = 8
+DEFAULT_POOL_SIZE = 8
+MAX_REDIRECTS = 5
+MAX_RETRY_AFTER = 60.0
+RETRY_STATUS = {429, 500, 502, 503, 504}
+READ_CHUNK = 64 * 1024
+# Unread bodies up to this size are drained on close to keep the connection.
+DRAIN_LIMIT = 256 * 1024
+
+_REDIRECT_STATUS = {301, 302, 303, 307, 308}
+_IDEMPOTENT = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+# Raised when a pooled connection was closed by the server while idle.
+_STALE = (ConnectionResetError, ConnectionAbortedError, BrokenPipeError, http.client.BadStatusLine)
+
+# (scheme, host, port, proxy URL or "")
+_PoolKey = Tuple[str, str, int, str]
+
+
+class _NotSent(error.URLError):
+    """The request failed before it was completely sent; repeating it is safe."""
+
+
+class Response:
+    """A response whose connection returns to the pool once it is consumed.
+
+    Offers the parts of the :func:`urllib.request.urlopen` response interface
+    used by the plugins: ``status``, ``headers``, ``getcode()``, ``read()``
+    and use as a context manager.
+    """
+
+    def __init__(
+        self,
+        client: "HttpClient",
+        key: _PoolKey,
+        conn: http.client.HTTPConnection,
+        raw: http.client.HTTPResponse,
+        url: str,
+        slot: threading.BoundedSemaphore,
+    ):
+        self._client = client
+        self._key = key
+        self._conn = conn
+        self._raw = raw
+        self._slot = slot
+        self._released = False
+        self.url = url
+        self.status = raw.status
+        self.reason = raw.reason
+        self.headers = raw.headers
+        encoding = (raw.getheader("Content-Encoding") or "").lower()
+        self._decoder = (
+            zlib.decompressobj(16 + zlib.MAX_WBITS) if encoding in ("gzip", "x-gzip") else None
+        )
+        self._buffer = b""
+
+    def getcode(self) -> int:
+        return self.status
+
+    def geturl(self) -> str:
+        return self.url
+
+    def info(self) -> Any:
+        return self.headers
+
+    def _read_raw(self, size: int) -> bytes:
+        if self._released:
+            return b""
+        data = self._raw.read() if size < 0 else self._raw.read(size)
+        if not data or self._raw.isclosed():
+            self._release()
+        return data
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        """Read up to ``size`` decoded bytes, or everything by default."""
+        size = -1 if size is None else size
+        if self._decoder is None:
+            return self._read_raw(size)
+        if size < 0:
+            data = self._buffer + self._decoder.decompress(self._read_raw(-1))
+            self._buffer = b""
+            return data + self._decoder.flush()
+        while len(self._buffer) < size and not self._released:
+            chunk = self._read_raw(READ_CHUNK)
+            self._buffer += self._decoder.decompress(chunk) if chunk else self._decoder.flush()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _release(self) -> None:
+        """Return the connection to the pool if the body was fully read."""
+        if self._released:
+            return
+        self._released = True
+        if self._raw.isclosed() and not self._raw.will_close:
+            self._client._put(self._key, self._conn)
+        else:
+            self._conn.close()
+        self._slot.release()
+
+    def close(self) -> None:
+        if self._released:
+            return
+        drained = 0
+        try:
+            # a short unread body is read off so the connection can be reused
+            while not self._raw.isclosed() and drained <= DRAIN_LIMIT:
+                chunk = self._raw.read(READ_CHUNK)
+                if not chunk:
+                    break
+                drained += len(chunk)
+        except (OSError, http.client.HTTPException):
+            pass
+        if not self._raw.isclosed():
+            self._raw.will_close = True
+            self._raw.close()
+        self._release()
+
+    def __enter__(self) -> "Response":
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        self.close()
+
+    def __del__(self) -> None:
+        try:
+            self.close()
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+
+class HttpClient:
+    """Pool of keep-alive connections shared by every plugin."""
+
+    def __init__(
+        self,
+        *,
+        timeout: float = DEFAULT_TIMEOUT,
+        max_retries: int = DEFAULT_RETRIES,
+        backoff: float = DEFAULT_BACKOFF,
+        per_host: int = DEFAULT_PER_HOST,
+        pool_size: int = DEFAULT_POOL_SIZE,
+    ):
+        self.timeout = float(timeout)
+        self.max_retries = max(0, int(max_retries))
+        self.backoff = float(backoff)
+        self.per_host = max(1, int(per_host))
+        self.pool_size = max(0, int(pool_size))
+        self._lock = threading.Lock()
+        self._idle: Dict[_PoolKey, List[http.client.HTTPConnection]] = {}
+        self._slots: Dict[str, threading.BoundedSemaphore] = {}
+        self._ssl = ssl.create_default_context()
+
+    # connection pool ------------------------------------------------------
+
+    def _slot(self, host: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            slot = self._slots.get(host)
+            if slot is None:
+                slot = self._slots[host] = threading.BoundedSemaphore(self.per_host)
+            return slot
+
+    def _get(self, key: _PoolKey, timeout: float) -> Tuple[http.client.HTTPConnection, bool]:
+        """Return an idle connection for ``key`` or a new one, and whether it was reused."""
+        with self._lock:
+            pool = self._idle.get(key)
+            conn = pool.pop() if pool else None
+        if conn is not None and _dropped(conn):
+            conn.close()
+            conn = None
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        scheme, host, port, proxy = key
+        if proxy:
+            proxy_host, proxy_port, proxy_headers = _proxy_address(proxy)
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(
+                    proxy_host, proxy_port, timeout=timeout, context=self._ssl
+                )
+                conn.set_tunnel(host, port, headers=proxy_headers)
+                return conn, False
+            return http.client.HTTPConnection(proxy_host, proxy_port, timeout=timeout), False
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=timeout, context=self._ssl), False
+        return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+    def _put(self, key: _PoolKey, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            pool = self._idle.setdefault(key, [])
+            if len(pool) < self.pool_size:
+                pool.append(conn)
+                return
+        conn.close()
+
+    def close(self) -> None:
+        """Close every idle connection."""
+        with self._lock:
+            pools, self._idle = self._idle, {}
+        for pool in pools.values():
+            for conn in pool:
+                conn.close()
+
+    # requests -------------------------------------------------------------
+
+    def _send(
+        self, method: str, url: str, body: Optional[bytes], headers: Dict[str, str], timeout: float
+    ) -> Response:
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ("http", "https"):
+            raise error.URLError(f"unsupported URL scheme {scheme!r}")
+        host = parts.hostname or ""
+        proxy = _proxy_for(scheme, host)
+        key = (scheme, host, parts.port or (443 if scheme == "https" else 80), proxy)
+        path = parts.path or "/"
+        if parts.query:
+            path = f"{path}?{parts.query}"
+        if proxy and scheme == "http":
+            # plain HTTP proxies expect the absolute URL as request target
+            path = f"http://{parts.netloc.rpartition('@')[2]}{path}"
+            headers = {**headers, **_proxy_address(proxy)[2]}
+        slot = self._slot(host)
+        slot.acquire()
+        try:
+            while True:
+                conn, reused = self._get(key, timeout)
+                try:
+                    conn.request(method, path, body=body, headers=headers)
+                except _STALE as exc:
+                    conn.close()
+                    if reused:
+                        continue
+                    raise _NotSent(exc) from exc
+                except OSError as exc:
+                    conn.close()
+                    raise _NotSent(exc) from exc
+                except BaseException:
+                    conn.close()
+                    raise
+                try:
+                    raw = conn.getresponse()
+                except _STALE:
+                    conn.close()
+                    # the server may have acted on a request it received
+                    if reused and method in _IDEMPOTENT:
+                        continue
+                    raise
+                except BaseException:
+                    conn.close()
+                    raise
+                return Response(self, key, conn, raw, url, slot)
+        except BaseException:
+            slot.release()
+            raise
+
+    def _delay(self, attempt: int, resp: Optional[Response] = None) -> float:
+        retry_after = resp.headers.get("Retry-After", "") if resp is not None else ""
+        if retry_after.strip().isdigit():
+            return min(float(retry_after), MAX_RETRY_AFTER)
+        return self.backoff * (2 ** attempt)
+
+    def open(
+        self,
+        req: Union[str, request.Request],
+        data: Optional[bytes] = None,
+        timeout: Optional[float] = None,
+    ) -> Response:
+        """Send ``req`` and return the response.
+
+        Statuses outside 2xx raise :class:`urllib.error.HTTPError` after
+        retries; ``GET`` and ``HEAD`` requests follow redirects. Only
+        idempotent methods are retried after an error status or a failure
+        once the request was sent.
+        """
+        if isinstance(req, str):
+            req = request.Request(req)
+        if data is not None:
+            req.data = data
+        timeout = self.timeout if timeout is None else float(timeout)
+        method = req.get_method()
+        url = req.full_url
+        body = req.data
+        headers = dict(req.header_items())
+        lower = {k.lower() for k in headers}
+        if "accept-encoding" not in lower:
+            headers["Accept-Encoding"] = "gzip"
+        if "user-agent" not in lower:
+            headers["User-Agent"] = "pyzap"
+
+        attempt = 0
+        redirects = 0
+        while True:
+            try:
+                resp = self._send(method, url, body, headers, timeout)
+            except OSError as exc:
+                # a request that may have reached the server is only repeated
+                # when repeating it is harmless
+                retry = method in _IDEMPOTENT or isinstance(exc, _NotSent)
+                if not retry or attempt >= self.max_retries:
+                    if isinstance(exc, error.URLError):
+                        raise
+                    raise error.URLError(exc) from exc
+                logging.debug("Retrying %s %s after %s", method, url, exc)
+                time.sleep(self._delay(attempt))
+                attempt += 1
+                continue
+
+            status = resp.status
+            location = resp.headers.get("Location")
+            if (
+                status in _REDIRECT_STATUS
+                and location
+                and method in ("GET", "HEAD")
+                and redirects < MAX_REDIRECTS
+            ):
+                resp.close()
+                url = urljoin(url, location)
+                redirects += 1
+                continue
+            if (
+                status in RETRY_STATUS
+                and method in _IDEMPOTENT
+                and attempt < self.max_retries
+            ):
+                delay = self._delay(attempt, resp)
+                resp.close()
+                logging.debug("Retrying %s %s after status %s in %.1fs", method, url, status, delay)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if not 200 <= status < 300:
+                # read the (small) error body so the connection is reused
+                payload = resp.read()
+                raise error.HTTPError(url, status, resp.reason, resp.headers, io.BytesIO(payload))
+            return resp
+
+
+def _proxy_for(scheme: str, host: str) -> str:
+    """Return the proxy URL configured for ``scheme`` unless ``host`` bypasses it."""
+    proxy = request.getproxies().get(scheme, "")
+    if not proxy or request.proxy_bypass(host):
+        return ""
+    return proxy if "://" in proxy else f"http://{proxy}"
+
+
+def _proxy_address(proxy: str) -> Tuple[str, int, Dict[str, str]]:
+    """Split a proxy URL into host, port and its ``Proxy-Authorization`` header."""
+    parts = urlsplit(proxy)
+    headers = {}
+    if parts.username is not None:
+        creds = f"{unquote(parts.username)}:{unquote(parts.password or '')}"
+        headers["Proxy-Authorization"] = "Basic " + base64.b64encode(creds.encode()).decode()
+    return parts.hostname or "", parts.port or 80, headers
+
+
+def _dropped(conn: http.client.HTTPConnection) -> bool:
+    """Return ``True`` if the server closed the idle connection ``conn``."""
+    sock = conn.sock
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    # an idle connection has nothing to read unless it was closed
+    return bool(readable)
+
+
+_client: Optional[HttpClient] = None
+_client_lock = threading.Lock()
+
+
+def configure(options: Optional[Dict[str, Any]] = None) -> HttpClient:
+    """Replace the shared client using ``options`` from the configuration."""
+    global _client
+    options = dict(options or {})
+    client = HttpClient(
+        timeout=float(options.get("timeout", DEFAULT_TIMEOUT)),
+        max_retries=int(options.get("max_retries", DEFAULT_RETRIES)),
+        backoff=float(options.get("backoff", DEFAULT_BACKOFF)),
+        per_host=int(options.get("per_host", DEFAULT_PER_HOST)),
+        pool_size=int(options.get("pool_size", DEFAULT_POOL_SIZE)),
+    )
+    with _client_lock:
+        old, _client = _client, client
+    if old is not None:
+        old.close()
+    return client
+
+
+def get_client() -> HttpClient:
+    """Return the process-wide client, creating it on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
+
+
+def urlopen(
+    req: Union[str, request.Request],
+    data: Optional[bytes] = None,
+    timeout: Optional[float] = None,
+) -> Response:
+    """Send ``req`` with the shared client; a pooled drop-in for ``urllib``."""
+    return get_client().open(req, data=data, timeout=timeout)
@@ -0,0 +1,316 @@
+"""Download files linked from email bodies.
+
+:class:`LinkDownloader` fetches a set of URLs concurrently with a per-host
+limit, a socket timeout and a maximum size. Bodies are streamed to disk and
+rejected early, from the response headers or the first bytes, when they are
+not of an accepted type. Completed downloads can be kept in a URL-keyed
+cache directory so the same link found in several messages is fetched once.
+"""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+from functools import partial
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+from pathlib import Path
+import re
+import shutil
+import threading
+import time
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+from urllib import request
+from urllib.parse import urlparse
+
+from . import http_client
+from .utils import run_parallel, safe_filename, unique_filename
+
+DEFAULT_WORKERS = 4
+DEFAULT_PER_HOST = 2
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_CACHE_AGE = 7 * 24 * 3600.0
+CHUNK_SIZE = 64 * 1024
+
+# Magic numbers used to name links without an extension and to catch error
+# pages served in place of the expected file.
+_SIGNATURES = [
+    (b"%PDF", ".pdf"),
+    (b"PK\x03\x04", ".zip"),
+    (b"\x89PNG", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF8", ".gif"),
+    (b"<?xml", ".xml"),
+]
+_HTML_START = re.compile(rb"^\s*(<!doctype html|<html|<head|<body)", re.IGNORECASE)
+_DISPOSITION_NAME = re.compile(r'filename="?([^";]+)"?')
+
+
+class _Shared:
+    """Locks shared by the threads using one key, dropped when none is left.
+
+    ``factory`` builds the lock or semaphore of a new key.
+    """
+
+    def __init__(self, factory: Callable[[Any], Any]):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._entries: Dict[Hashable, List[Any]] = {}
+
+    @contextmanager
+    def hold(self, key: Hashable) -> Iterator[None]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [self._factory(key), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._entries[key]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+# requests per host are limited per ``(host, per_host)`` so downloaders with
+# different limits do not inherit each other's
+_host_slots = _Shared(lambda key: threading.BoundedSemaphore(key[1]))
+_url_locks = _Shared(lambda key: threading.Lock())
+_prune_lock = threading.Lock()
+_pruned: Set[str] = set()
+
+
+def _header(resp: Any, name: str) -> str:
+    headers = getattr(resp, "headers", None)
+    if headers is not None:
+        return headers.get(name, "") or ""
+    return getattr(resp, "getheader", lambda x, default="": default)(name) or ""
+
+
+def sniff_extension(head: bytes) -> str:
+    """Return the file extension suggested by the first bytes of a file."""
+    for magic, ext in _SIGNATURES:
+        if head.startswith(magic):
+            return ext
+    if _HTML_START.match(head):
+        return ".html"
+    return ""
+
+
+class LinkRejected(Exception):
+    """Raised when a link does not point to an acceptable file."""
+
+
+class LinkDownloader:
+    """Fetch linked files with bounded concurrency, time and size.
+
+    ``allowed`` is an optional list of accepted extensions such as
+    ``[".pdf"]``. ``cache_dir`` optionally stores completed downloads keyed
+    by URL for ``cache_age`` seconds.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_workers: int = DEFAULT_WORKERS,
+        per_host: int = DEFAULT_PER_HOST,
+        timeout: float = DEFAULT_TIMEOUT,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        allowed: Optional[Sequence[str]] = None,
+        cache_dir: Optional[str] = None,
+        cache_age: float = DEFAULT_CACHE_AGE,
+    ) -> None:
+        self.max_workers = max(1, int(max_workers))
+        self.per_host = max(1, int(per_host))
+        self.timeout = float(timeout)
+        self.max_bytes = int(max_bytes)
+        self.allowed = [a.lower() for a in allowed] if allowed else None
+        self.cache_dir = cache_dir or None
+        self.cache_age = float(cache_age)
+        if self.cache_dir:
+            self._prune_cache()
+
+    def download_all(
+        self, urls: Iterable[str], dest: Path, taken: Optional[Set[str]] = None
+    ) -> List[str]:
+        """Download ``urls`` into ``dest`` and return the saved file names.
+
+        Links that fail, time out, exceed ``max_bytes`` or are rejected by
+        the type check are logged and skipped. Names already used, those in
+        ``taken`` (lower case) included, get a numbered suffix.
+        """
+        urls = list(dict.fromkeys(urls))
+        taken = set() if taken is None else taken
+        names_lock = threading.Lock()
+
+        def reserve(name: str) -> str:
+            with names_lock:
+                return unique_filename(name, taken)
+
+        tasks = [partial(self.download, url, dest, reserve) for url in urls]
+        names: List[str] = []
+        for url, (ok, value) in zip(urls, run_parallel(tasks, max_workers=self.max_workers)):
+            if ok:
+                names.append(value)
+            elif isinstance(value, LinkRejected):
+                logging.debug("Skipping link %s: %s", url, value)
+            else:
+                logging.warning("Unable to download %s: %s", url, value)
+        return names
+
+    def download(
+        self, url: str, dest: Path, reserve: Optional[Callable[[str], str]] = None
+    ) -> str:
+        """Download ``url`` into ``dest`` and return the file name.
+
+        ``reserve`` turns the name derived from the link into the name the
+        file is saved under.
+        """
+        reserve = reserve or (lambda name: name)
+        with _url_locks.hold(url):
+            name = self._from_cache(url, dest, reserve)
+            if name:
+                logging.debug("Using cached download of %s", url)
+                return name
+            host = urlparse(url).hostname or ""
+            with _host_slots.hold((host, self.per_host)):
+                name, saved = self._fetch(url, dest, reserve)
+            self._to_cache(url, dest / saved, name)
+            return saved
+
+    def _accepts(self, name: str) -> bool:
+        ext = Path(name).suffix.lower()
+        return not self.allowed or ext in self.allowed
+
+    def _fetch(self, url: str, dest: Path, reserve: Callable[[str], str]) -> Tuple[str, str]:
+        """Download ``url``; return the link's file name and the saved one."""
+        req = request.Request(url, headers={"User-Agent": "pyzap"})
+        with http_client.urlopen(req, timeout=self.timeout) as resp:
+            length = _header(resp, "Content-Length")
+            if length.isdigit() and int(length) > self.max_bytes:
+                raise LinkRejected(f"size {length} exceeds {self.max_bytes} bytes")
+            name = os.path.basename(urlparse(url).path)
+            if not name or not Path(name).suffix:
+                match = _DISPOSITION_NAME.search(_header(resp, "Content-Disposition"))
+                if match:
+                    name = os.path.basename(match.group(1))
+            name = safe_filename(name) if name else ""
+            # reject by name before reading any of the body
+            if name and Path(name).suffix and not self._accepts(name):
+                raise LinkRejected(f"{name} is not an accepted type")
+
+            head = resp.read(CHUNK_SIZE)
+            sniffed = sniff_extension(head[:64])
+            if not name or not Path(name).suffix:
+                content_type = _header(resp, "Content-Type").split(";")[0].strip()
+                ext = sniffed or mimetypes.guess_extension(content_type) or ""
+                name = safe_filename(f"{name or 'downloaded_file'}{ext}")
+            if sniffed == ".html" and Path(name).suffix.lower() not in (".html", ".htm"):
+                raise LinkRejected(f"{url} returned an HTML page instead of {name}")
+            if not self._accepts(name):
+                raise LinkRejected(f"{name} is not an accepted type")
+
+            dest.mkdir(parents=True, exist_ok=True)
+            # links sharing a file name must not write the same partial file
+            digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+            part = dest / f".{digest}.part"
+            try:
+                with open(part, "wb") as fh:
+                    self._copy(resp, head, fh)
+                saved = reserve(name)
+                os.replace(part, dest / saved)
+            finally:
+                if part.exists():
+                    part.unlink()
+        return name, saved
+
+    def _copy(self, resp: Any, head: bytes, out: BinaryIO) -> None:
+        size = 0
+        chunk = head
+        while chunk:
+            size += len(chunk)
+            if size > self.max_bytes:
+                raise LinkRejected(f"download exceeds {self.max_bytes} bytes")
+            out.write(chunk)
+            chunk = resp.read(CHUNK_SIZE)
+
+    # URL cache -----------------------------------------------------------
+
+    def _cache_paths(self, url: str) -> Tuple[str, str]:
+        digest = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        base = os.path.join(self.cache_dir or "", digest)
+        return f"{base}.bin", f"{base}.json"
+
+    def _from_cache(
+        self, url: str, dest: Path, reserve: Callable[[str], str]
+    ) -> Optional[str]:
+        if not self.cache_dir:
+            return None
+        data_path, meta_path = self._cache_paths(url)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as fh:
+                name = json.load(fh)["name"]
+            if time.time() - os.stat(data_path).st_mtime > self.cache_age:
+                return None
+        except (OSError, ValueError, KeyError):
+            return None
+        if not self._accepts(name):
+            raise LinkRejected(f"{name} is not an accepted type")
+        dest.mkdir(parents=True, exist_ok=True)
+        saved = reserve(name)
+        shutil.copyfile(data_path, dest / saved)
+        return saved
+
+    def _to_cache(self, url: str, path: Path, name: str) -> None:
+        if not self.cache_dir:
+            return
+        data_path, meta_path = self._cache_paths(url)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            shutil.copyfile(path, f"{data_path}.tmp")
+            os.replace(f"{data_path}.tmp", data_path)
+            with open(f"{meta_path}.tmp", "w", encoding="utf-8") as fh:
+                json.dump({"url": url, "name": name}, fh)
+            os.replace(f"{meta_path}.tmp", meta_path)
+        except OSError as exc:
+            logging.warning("Unable to cache download of %s: %s", url, exc)
+
+    def _prune_cache(self) -> None:
+        with _prune_lock:
+            if self.cache_dir in _pruned:
+                return
+            _pruned.add(self.cache_dir)
+        limit = time.time() - self.cache_age
+        try:
+            entries = os.listdir(self.cache_dir)
+        except OSError:
+            return
+        for entry in entries:
+            path = os.path.join(self.cache_dir, entry)
+            try:
+                if os.stat(path).st_mtime < limit:
+                    os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,238 @@
+"""Local cache of raw email messages shared by triggers and archive actions.
+
+Polling triggers already download the full message to inspect it, so they
+store the raw bytes here and the archive actions read them back instead of
+fetching the same message again. Entries live in memory up to a byte budget
+and spill to disk beyond it; both tiers are evicted by size and by age.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, BinaryIO, Dict, Optional, Tuple
+
+from . import state
+
+DEFAULT_MEMORY_BYTES = 32 * 1024 * 1024
+DEFAULT_DISK_BYTES = 512 * 1024 * 1024
+DEFAULT_MAX_AGE = 3600.0
+
+
+def imap_key(host: str, mailbox: str, uidvalidity: Any, uid: Any) -> Tuple[str, ...]:
+    """Return the cache key of an IMAP message."""
+    return ("imap", str(host).lower(), str(mailbox), str(uidvalidity), str(uid))
+
+
+def gmail_key(account: str, msg_id: str) -> Tuple[str, ...]:
+    """Return the cache key of a Gmail API message."""
+    return ("gmail", str(account), str(msg_id))
+
+
+class MessageCache:
+    """Memory-bounded message cache spilling to a disk directory.
+
+    ``memory_bytes`` limits the in-memory tier, ``disk_bytes`` the on-disk
+    tier and ``max_age`` (seconds) the lifetime of any entry. ``disk_dir``
+    defaults to ``message-cache`` in the private state directory (see
+    :mod:`pyzap.state`); an empty value disables the disk tier.
+    """
+
+    def __init__(
+        self,
+        *,
+        memory_bytes: int = DEFAULT_MEMORY_BYTES,
+        disk_dir: Optional[str] = None,
+        disk_bytes: int = DEFAULT_DISK_BYTES,
+        max_age: float = DEFAULT_MAX_AGE,
+        enabled: bool = True,
+    ) -> None:
+        self.memory_bytes = int(memory_bytes)
+        self.disk_bytes = int(disk_bytes)
+        self.max_age = float(max_age)
+        self.enabled = enabled
+        if disk_dir is None:
+            disk_dir = state.path("message-cache")
+        self.disk_dir = disk_dir or None
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._memory_size = 0
+        self._disk: "OrderedDict[str, Tuple[float, int]]" = OrderedDict()
+        self._disk_size = 0
+        if self.disk_dir:
+            self._scan_disk()
+
+    @staticmethod
+    def _digest(key: Tuple[str, ...]) -> str:
+        return hashlib.sha1("\0".join(key).encode("utf-8")).hexdigest()
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.disk_dir or "", f"{digest}.eml")
+
+    def _scan_disk(self) -> None:
+        """Index messages left on disk by a previous run."""
+        try:
+            state.private_dir(self.disk_dir)
+            entries = []
+            for name in os.listdir(self.disk_dir):
+                if not name.endswith(".eml"):
+                    continue
+                stat = os.stat(os.path.join(self.disk_dir, name))
+                entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        except OSError as exc:
+            logging.warning("Message cache directory unavailable: %s", exc)
+            self.disk_dir = None
+            return
+        for mtime, digest, size in sorted(entries):
+            self._disk[digest] = (mtime, size)
+            self._disk_size += size
+
+    def put(self, key: Tuple[str, ...], data: bytes) -> None:
+        """Store the raw bytes of a message."""
+        if not self.enabled:
+            return
+        digest = self._digest(key)
+        now = time.time()
+        with self._lock:
+            self._drop(digest)
+            if len(data) > self.memory_bytes:
+                self._write_disk(digest, data, now)
+            else:
+                self._memory[digest] = (now, data)
+                self._memory_size += len(data)
+                self._spill()
+            self._expire(now)
+
+    def get(self, key: Tuple[str, ...]) -> Optional[bytes]:
+        """Return the cached bytes for ``key`` or ``None`` on a miss."""
+        if not self.enabled:
+            return None
+        digest = self._digest(key)
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            entry = self._memory.get(digest)
+            if entry is not None:
+                self._memory.move_to_end(digest)
+                return entry[1]
+            if digest in self._disk:
+                try:
+                    with open(self._path(digest), "rb") as fh:
+                        return fh.read()
+                except OSError:
+                    self._drop(digest)
+        return None
+
+    def open(self, key: Tuple[str, ...]) -> Optional[BinaryIO]:
+        """Return a binary file object for ``key`` or ``None`` on a miss.
+
+        Disk entries are streamed from their file instead of being read
+        into memory; the caller must close the returned object.
+        """
+        if not self.enabled:
+            return None
+        digest = self._digest(key)
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            entry = self._memory.get(digest)
+            if entry is not None:
+                self._memory.move_to_end(digest)
+                return io.BytesIO(entry[1])
+            if digest in self._disk:
+                try:
+                    return open(self._path(digest), "rb")
+                except OSError:
+                    self._drop(digest)
+        return None
+
+    def discard(self, key: Tuple[str, ...]) -> None:
+        """Remove ``key`` from the cache."""
+        with self._lock:
+            self._drop(self._digest(key))
+
+    def clear(self) -> None:
+        """Remove every cached message."""
+        with self._lock:
+            for digest in list(self._memory) + list(self._disk):
+                self._drop(digest)
+
+    # Internal helpers below expect ``self._lock`` to be held.
+
+    def _drop(self, digest: str) -> None:
+        entry = self._memory.pop(digest, None)
+        if entry is not None:
+            self._memory_size -= len(entry[1])
+        disk_entry = self._disk.pop(digest, None)
+        if disk_entry is not None:
+            self._disk_size -= disk_entry[1]
+            try:
+                os.remove(self._path(digest))
+            except OSError:
+                pass
+
+    def _write_disk(self, digest: str, data: bytes, stamp: float) -> None:
+        if not self.disk_dir or len(data) > self.disk_bytes:
+            return
+        path = self._path(digest)
+        tmp_path = f"{path}.tmp"
+        try:
+            with state.open_private(tmp_path, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            logging.warning("Unable to spill message to cache: %s", exc)
+            return
+        self._disk[digest] = (stamp, len(data))
+        self._disk_size += len(data)
+        while self._disk_size > self.disk_bytes and self._disk:
+            oldest = next(iter(self._disk))
+            self._drop(oldest)
+
+    def _spill(self) -> None:
+        while self._memory_size > self.memory_bytes and self._memory:
+            digest, (stamp, data) = self._memory.popitem(last=False)
+            self._memory_size -= len(data)
+            self._write_disk(digest, data, stamp)
+
+    def _expire(self, now: float) -> None:
+        limit = now - self.max_age
+        for tier in (self._memory, self._disk):
+            expired = [d for d, (stamp, _) in tier.items() if stamp < limit]
+            for digest in expired:
+                self._drop(digest)
+
+
+_cache: Optional[MessageCache] = None
+_cache_lock = threading.Lock()
+
+
+def configure(options: Optional[Dict[str, Any]] = None) -> MessageCache:
+    """Replace the shared cache using ``options`` from the configuration."""
+    global _cache
+    options = dict(options or {})
+    cache = MessageCache(
+        memory_bytes=int(options.get("memory_bytes", DEFAULT_MEMORY_BYTES)),
+        disk_dir=options.get("disk_dir"),
+        disk_bytes=int(options.get("disk_bytes", DEFAULT_DISK_BYTES)),
+        max_age=float(options.get("max_age", DEFAULT_MAX_AGE)),
+        enabled=str(options.get("enabled", True)).lower()
+        not in {"0", "false", "no"},
+    )
+    with _cache_lock:
+        _cache = cache
+    return cache
+
+
+def get_cache() -> MessageCache:
+    """Return the process-wide message cache, creating it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = MessageCache()
+        return _cache
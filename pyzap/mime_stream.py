@@ -0,0 +1,193 @@
+"""Streaming MIME parser used to extract attachments with bounded memory.
+
+``email.message_from_bytes`` keeps the whole message tree in memory and
+``get_payload(decode=True)`` creates another full copy of every part. The
+helpers here read a raw message line by line, parse only the header blocks
+and decode each leaf part incrementally into a caller supplied file object.
+"""
+
+from __future__ import annotations
+
+import binascii
+import re
+from email.message import Message
+from email.parser import BytesHeaderParser
+from typing import BinaryIO, Callable, List, Optional, Tuple
+
+# Longest physical line read at once; longer lines are processed in pieces.
+LINE_LIMIT = 64 * 1024
+# Header blocks larger than this are truncated rather than buffered.
+HEADER_LIMIT = 1024 * 1024
+
+_BASE64_JUNK = re.compile(rb"[^A-Za-z0-9+/=]")
+
+PartHandler = Callable[[Message, bool], Optional[BinaryIO]]
+_Hit = Optional[Tuple[bytes, bool]]
+
+
+class _RawDecoder:
+    def __init__(self, out: BinaryIO):
+        self.out = out
+
+    def write_line(self, pending: bytes, body: bytes, complete: bool) -> None:
+        self.out.write(pending + body)
+
+    def close(self) -> None:
+        pass
+
+
+class _Base64Decoder:
+    def __init__(self, out: BinaryIO):
+        self.out = out
+        self.buf = b""
+
+    def write_line(self, pending: bytes, body: bytes, complete: bool) -> None:
+        self.buf += _BASE64_JUNK.sub(b"", body)
+        usable = len(self.buf) // 4 * 4
+        if usable:
+            self.out.write(binascii.a2b_base64(self.buf[:usable]))
+            self.buf = self.buf[usable:]
+
+    def close(self) -> None:
+        if self.buf:
+            padded = self.buf + b"=" * (-len(self.buf) % 4)
+            try:
+                self.out.write(binascii.a2b_base64(padded))
+            except binascii.Error:
+                pass
+            self.buf = b""
+
+
+class _QuotedPrintableDecoder:
+    def __init__(self, out: BinaryIO):
+        self.out = out
+        self.buf = b""
+        self.soft_break = False
+
+    def write_line(self, pending: bytes, body: bytes, complete: bool) -> None:
+        if not self.buf and self.soft_break:
+            pending = b""
+        if not self.buf:
+            self.out.write(pending)
+        self.buf += body
+        if complete:
+            self._flush()
+
+    def _flush(self) -> None:
+        data = self.buf.rstrip(b" \t")
+        self.buf = b""
+        self.soft_break = data.endswith(b"=")
+        if self.soft_break:
+            data = data[:-1]
+        self.out.write(binascii.a2b_qp(data))
+
+    def close(self) -> None:
+        if self.buf:
+            self._flush()
+
+
+def _decoder(encoding: Optional[str], out: BinaryIO):
+    cte = (encoding or "").strip().lower()
+    if cte == "base64":
+        return _Base64Decoder(out)
+    if cte == "quoted-printable":
+        return _QuotedPrintableDecoder(out)
+    return _RawDecoder(out)
+
+
+class _LineReader:
+    """Read ``fh`` in lines of at most ``LINE_LIMIT`` bytes."""
+
+    def __init__(self, fh: BinaryIO):
+        self.fh = fh
+
+    def readline(self) -> bytes:
+        return self.fh.readline(LINE_LIMIT)
+
+
+def _read_headers(lines: _LineReader) -> Message:
+    buf: List[bytes] = []
+    size = 0
+    while True:
+        line = lines.readline()
+        if not line:
+            break
+        if line in (b"\r\n", b"\n"):
+            break
+        if size < HEADER_LIMIT:
+            buf.append(line)
+            size += len(line)
+    return BytesHeaderParser().parsebytes(b"".join(buf) + b"\r\n")
+
+
+def _consume_body(lines: _LineReader, boundaries: List[bytes], decoder) -> _Hit:
+    """Feed lines to ``decoder`` until a boundary of ``boundaries`` or EOF.
+
+    Returns ``(boundary, is_close_delimiter)`` for the boundary that ended
+    the body or ``None`` at end of input. The line break preceding a
+    boundary belongs to the delimiter and is not passed to the decoder.
+    """
+
+    pending = b""
+    at_line_start = True
+    while True:
+        line = lines.readline()
+        if not line:
+            return None
+        if at_line_start and line.startswith(b"--"):
+            content = line.rstrip()
+            for boundary in reversed(boundaries):
+                delimiter = b"--" + boundary
+                if content == delimiter:
+                    return boundary, False
+                if content == delimiter + b"--":
+                    return boundary, True
+        if line.endswith(b"\r\n"):
+            body, term, complete = line[:-2], b"\r\n", True
+        elif line.endswith(b"\n"):
+            body, term, complete = line[:-1], b"\n", True
+        else:
+            body, term, complete = line, b"", False
+        if decoder is not None:
+            decoder.write_line(pending, body, complete)
+        pending = term
+        at_line_start = complete
+
+
+def _parse_entity(
+    lines: _LineReader,
+    boundaries: List[bytes],
+    on_part: PartHandler,
+    is_root: bool,
+) -> Tuple[Message, _Hit]:
+    headers = _read_headers(lines)
+    boundary = headers.get_boundary() if headers.get_content_maintype() == "multipart" else None
+    if boundary:
+        inner = boundary.encode("ascii", "replace")
+        stack = boundaries + [inner]
+        hit = _consume_body(lines, stack, None)  # preamble
+        while hit is not None and hit == (inner, False):
+            _child, hit = _parse_entity(lines, stack, on_part, False)
+        if hit == (inner, True):
+            hit = _consume_body(lines, boundaries, None)  # epilogue
+        return headers, hit
+
+    sink = on_part(headers, is_root)
+    decoder = _decoder(headers.get("Content-Transfer-Encoding"), sink) if sink else None
+    hit = _consume_body(lines, boundaries, decoder)
+    if decoder is not None:
+        decoder.close()
+    return headers, hit
+
+
+def stream_parts(fh: BinaryIO, on_part: PartHandler) -> Message:
+    """Walk the message in ``fh`` calling ``on_part`` for every leaf part.
+
+    ``on_part`` receives the headers of the part (an ``email.message.Message``
+    without payload) and whether the part is the message root. When it
+    returns a writable binary file the decoded body is written to it; when it
+    returns ``None`` the body is skipped. The root headers are returned.
+    """
+
+    root, _hit = _parse_entity(_LineReader(fh), [], on_part, True)
+    return root
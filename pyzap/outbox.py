@@ -0,0 +1,332 @@
+"""Durable outbox running actions off the workflow thread.
+
+Actions configured with ``"async": true`` are not executed inline. Their
+input payload is recorded in a SQLite database and the workflow moves on
+to the next action. A pool of dispatcher threads executes the recorded
+jobs with retries and exponential backoff. Jobs sharing a key run one at a
+time in the order they were recorded. The key defaults to the action
+itself and can be set per action with an ``async_key`` template such as
+``"{thread_id}"``. Jobs survive restarts: a job interrupted while running
+is executed again when the outbox starts.
+"""
+
+from __future__ import annotations
+
+from collections import defaultdict
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import state
+
+# Database file inside the private state directory, used when no path is set.
+FILE_NAME = "outbox.db"
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF = 2.0
+# Seconds completed jobs are kept for status queries.
+DEFAULT_RETENTION = 86400.0
+MAX_BACKOFF = 3600.0
+
+STATUSES = ("pending", "running", "done", "failed")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    workflow TEXT NOT NULL,
+    action INTEGER NOT NULL,
+    action_type TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, next_attempt, id);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, id);
+"""
+
+# A pending job is ready when no earlier job with its key is unfinished.
+_CLAIM = """
+SELECT id, workflow, action, action_type, payload, attempts FROM jobs AS j
+WHERE status = 'pending' AND next_attempt <= ?
+  AND NOT EXISTS (
+      SELECT 1 FROM jobs AS e
+      WHERE e.key = j.key AND e.id < j.id AND e.status IN ('pending', 'running')
+  )
+ORDER BY id LIMIT 1
+"""
+
+_registry_lock = threading.Lock()
+_actions: Dict[Tuple[str, int], Any] = {}
+
+
+def register(workflow_id: str, index: int, action: Any) -> None:
+    """Make ``action`` available to run the jobs of ``workflow_id``."""
+    with _registry_lock:
+        _actions[(workflow_id, index)] = action
+
+
+def job_key(
+    template: Optional[str], workflow_id: str, index: int, payload: Dict[str, Any]
+) -> str:
+    """Return the ordering key of a job; unknown placeholders are left empty."""
+    if not template:
+        return f"{workflow_id}/{index}"
+    return f"{workflow_id}/{index}/" + str(template).format_map(defaultdict(str, payload))
+
+
+class Outbox:
+    """SQLite job store with a pool of dispatcher threads."""
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        *,
+        workers: int = DEFAULT_WORKERS,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        backoff: float = DEFAULT_BACKOFF,
+        retention: float = DEFAULT_RETENTION,
+    ):
+        if not path:
+            path = os.path.join(state.private_dir(state.root()), FILE_NAME)
+        self.path = path
+        self.workers = max(1, int(workers))
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff = float(backoff)
+        self.retention = float(retention)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        if path != ":memory:" and not os.path.exists(path):
+            # payloads hold message bodies and addresses; SQLite gives its
+            # journal files the permissions of the database
+            state.open_private(path, "a").close()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+
+    # job store ------------------------------------------------------------
+
+    def enqueue(
+        self,
+        workflow_id: str,
+        index: int,
+        action: Any,
+        payload: Dict[str, Any],
+        *,
+        key: Optional[str] = None,
+    ) -> int:
+        """Record a job for ``action`` and return its id."""
+        now = time.time()
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT INTO jobs (workflow, action, action_type, key, payload, created, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    workflow_id,
+                    index,
+                    type(action).__name__,
+                    key or job_key(None, workflow_id, index, payload),
+                    json.dumps(payload, default=str),
+                    now,
+                    now,
+                ),
+            )
+            self._wakeup.notify()
+        self.start()
+        return int(cur.lastrowid)
+
+    def status(self) -> Dict[str, int]:
+        """Return the number of jobs in every state."""
+        counts = dict.fromkeys(STATUSES, 0)
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts.update(rows)
+        return counts
+
+    def jobs(self, status: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        """Return the most recent jobs, optionally only those in ``status``."""
+        query = "SELECT id, workflow, action_type, key, status, attempts, error, updated FROM jobs"
+        args: Tuple[Any, ...] = ()
+        if status:
+            query += " WHERE status = ?"
+            args = (status,)
+        query += " ORDER BY id DESC LIMIT ?"
+        with self._lock:
+            rows = self._db.execute(query, args + (int(limit),)).fetchall()
+        names = ("id", "workflow", "action", "key", "status", "attempts", "error", "updated")
+        return [dict(zip(names, row)) for row in rows]
+
+    def retry_failed(self) -> int:
+        """Queue the failed jobs again and return how many there were.
+
+        Running dispatchers, also those of another process sharing the
+        database, pick them up within a second.
+        """
+        with self._lock:
+            cur = self._db.execute(
+                "UPDATE jobs SET status = 'pending', attempts = 0, next_attempt = 0, updated = ?"
+                " WHERE status = 'failed'",
+                (time.time(),),
+            )
+            self._wakeup.notify_all()
+        return cur.rowcount
+
+    def _claim(self) -> Optional[Tuple[Any, ...]]:
+        """Mark the next ready job as running; caller holds ``_lock``."""
+        row = self._db.execute(_CLAIM, (time.time(),)).fetchone()
+        if row is not None:
+            self._db.execute(
+                "UPDATE jobs SET status = 'running', updated = ? WHERE id = ?",
+                (time.time(), row[0]),
+            )
+        return row
+
+    def _finish(self, job_id: int, attempts: int, error: Optional[str]) -> None:
+        now = time.time()
+        with self._lock:
+            if error is None:
+                self._db.execute(
+                    "UPDATE jobs SET status = 'done', attempts = ?, error = NULL, updated = ?"
+                    " WHERE id = ?",
+                    (attempts, now, job_id),
+                )
+                self._db.execute(
+                    "DELETE FROM jobs WHERE status = 'done' AND updated < ?",
+                    (now - self.retention,),
+                )
+            elif attempts >= self.max_attempts:
+                self._db.execute(
+                    "UPDATE jobs SET status = 'failed', attempts = ?, error = ?, updated = ?"
+                    " WHERE id = ?",
+                    (attempts, error, now, job_id),
+                )
+            else:
+                delay = min(self.backoff * (2 ** (attempts - 1)), MAX_BACKOFF)
+                self._db.execute(
+                    "UPDATE jobs SET status = 'pending', attempts = ?, error = ?,"
+                    " next_attempt = ?, updated = ? WHERE id = ?",
+                    (attempts, error, now + delay, now, job_id),
+                )
+            # the next job with this key may be ready now
+            self._wakeup.notify_all()
+
+    # dispatcher -----------------------------------------------------------
+
+    def _next_wait(self) -> float:
+        row = self._db.execute(
+            "SELECT MIN(next_attempt) FROM jobs WHERE status = 'pending'"
+        ).fetchone()
+        if row[0] is None:
+            return 1.0
+        return min(max(row[0] - time.time(), 0.05), 1.0)
+
+    def _run(self, job: Tuple[Any, ...]) -> Optional[str]:
+        job_id, workflow_id, index, action_type, payload, _attempts = job
+        with _registry_lock:
+            action = _actions.get((workflow_id, index))
+        if action is None or type(action).__name__ != action_type:
+            return f"Action {action_type} of workflow {workflow_id} is no longer configured"
+        try:
+            action.execute(json.loads(payload))
+        except Exception as exc:  # pylint: disable=broad-except
+            logging.exception("Outbox job %s (%s) failed: %s", job_id, action_type, exc)
+            return f"{type(exc).__name__}: {exc}"
+        logging.info("Outbox job %s (%s) completed", job_id, action_type)
+        return None
+
+    def _worker(self) -> None:
+        while not self._stop.is_set():
+            with self._lock:
+                job = self._claim()
+                if job is None:
+                    self._wakeup.wait(self._next_wait())
+                    continue
+            self._finish(job[0], job[5] + 1, self._run(job))
+
+    def start(self) -> None:
+        """Start the dispatcher threads, resuming jobs left running."""
+        with self._lock:
+            if self._threads or self._stop.is_set():
+                return
+            self._db.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+            for number in range(self.workers):
+                thread = threading.Thread(
+                    target=self._worker, name=f"pyzap-outbox-{number}", daemon=True
+                )
+                self._threads.append(thread)
+                thread.start()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait until no job is pending or running; ``False`` on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            counts = self.status()
+            if not counts["pending"] and not counts["running"]:
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Stop the dispatchers after their current job; pending jobs stay stored."""
+        self._stop.set()
+        with self._lock:
+            self._wakeup.notify_all()
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join(timeout)
+        if any(thread.is_alive() for thread in threads):
+            # a job is still running and will record its outcome
+            return
+        with self._lock:
+            self._db.close()
+
+
+_outbox: Optional[Outbox] = None
+_outbox_options: Dict[str, Any] = {}
+_outbox_lock = threading.Lock()
+
+
+def configure(options: Optional[Dict[str, Any]] = None) -> None:
+    """Set the options of the shared outbox, closing one already open."""
+    global _outbox, _outbox_options
+    with _outbox_lock:
+        old, _outbox = _outbox, None
+        _outbox_options = dict(options or {})
+    if old is not None:
+        old.close()
+
+
+def get_outbox() -> Outbox:
+    """Return the process-wide outbox, opening it on first use."""
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            options = _outbox_options
+            _outbox = Outbox(
+                options.get("path"),
+                workers=int(options.get("workers", DEFAULT_WORKERS)),
+                max_attempts=int(options.get("max_attempts", DEFAULT_MAX_ATTEMPTS)),
+                backoff=float(options.get("backoff", DEFAULT_BACKOFF)),
+                retention=float(options.get("retention", DEFAULT_RETENTION)),
+            )
+        return _outbox
+
+
+def close() -> None:
+    """Stop the shared outbox's dispatchers."""
+    global _outbox
+    with _outbox_lock:
+        old, _outbox = _outbox, None
+    if old is not None:
+        old.close()
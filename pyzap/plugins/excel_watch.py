@@ -6,8 +6,11 @@ import json
 import logging
 import os
 import re
+import shutil
+import threading
 from typing import Any, Dict, List
 
+from .. import http_client, smtp_pool
 from ..core import BaseTrigger, BaseAction
 from ..utils import excel_lock
 
@@ -281,11 +284,21 @@ class ExcelWriteRowAction(BaseAction):
 class EmailSendAction(BaseAction):
     """Send an email using SMTP."""
 
+    def __init__(self, params: Dict[str, Any]):
+        super().__init__(params)
+        self._pending: List[Any] = []
+        self._lock = threading.Lock()
+
     def execute(self, data: Dict[str, Any]) -> None:
-        host = self.params.get("host", "localhost")
-        port = int(self.params.get("port", 25))
-        username = self.params.get("username")
-        password = self.params.get("password")
+        """Send one email over a pooled SMTP session.
+
+        Sessions to the same server and account are reused between
+        messages (see :mod:`pyzap.smtp_pool`). ``tls`` enables STARTTLS.
+        With ``batch_size`` above ``1``, messages are collected and sent
+        together once that many are waiting and at the end of each
+        workflow run. Messages of a batch that could not be sent stay
+        queued for the next flush.
+        """
         from_addr = self.params.get("from_addr")
         to_addr = self.params.get("to_addr") or data.get("to")
         subject = self.params.get("subject") or data.get("subject", "")
@@ -293,7 +306,6 @@ class EmailSendAction(BaseAction):
         if not (from_addr and to_addr):
             raise ValueError("from_addr and to_addr required")
 
-        import smtplib
         from email.message import EmailMessage
 
         msg = EmailMessage()
@@ -302,10 +314,40 @@ class EmailSendAction(BaseAction):
         msg["To"] = to_addr
         msg.set_content(str(body))
 
-        with smtplib.SMTP(host, port) as smtp:
-            if username and password:
-                smtp.login(username, password)
-            smtp.send_message(msg)
+        if int(self.params.get("batch_size", 1)) <= 1:
+            smtp_pool.send(self.params, [msg])
+            return
+        with self._lock:
+            self._pending.append(msg)
+            full = len(self._pending) >= int(self.params["batch_size"])
+        if full:
+            try:
+                self.flush()
+            except smtp_pool.SendError as exc:
+                # the message is queued again, so this payload is not lost
+                logging.warning("Batched emails not sent, retrying at the next flush: %s", exc)
+
+    def flush(self) -> None:
+        """Send the batched messages over a single session.
+
+        On failure the unsent messages are queued again before the error is
+        raised. A message the server refused permanently is dropped.
+        """
+        with self._lock:
+            messages, self._pending = self._pending, []
+        if not messages:
+            return
+        logging.info("Sending %d batched emails", len(messages))
+        try:
+            smtp_pool.send(self.params, messages)
+        except smtp_pool.SendError as exc:
+            unsent = messages[exc.sent:]
+            if exc.permanent:
+                logging.error("Dropping email %r refused by the server", unsent[0]["Subject"])
+                unsent = unsent[1:]
+            with self._lock:
+                self._pending[:0] = unsent
+            raise
 
 
 class DBSaveAction(BaseAction):
@@ -379,9 +421,8 @@ class AttachmentDownloadAction(BaseAction):
                     pass
             path = os.path.join(dest, filename)
             if url.startswith("http"):
-                from urllib import request
-
-                request.urlretrieve(url, path)
+                with http_client.urlopen(url) as resp, open(path, "wb") as dst:
+                    shutil.copyfileobj(resp, dst)
             else:
                 try:
                     with open(url, "rb") as src, open(path, "wb") as dst:
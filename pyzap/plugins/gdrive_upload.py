@@ -2,13 +2,88 @@
 
 from __future__ import annotations
 
+from functools import partial
+import hashlib
 import json
 import logging
 import os
-from typing import Any, Dict
-from urllib import request
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from urllib import error, request
 
+from .. import drive_index, google_auth, http_client, state
 from ..core import BaseAction
+from ..utils import run_parallel
+
+UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3/files"
+DEFAULT_RESUMABLE_THRESHOLD = 5 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+# Drive requires every chunk but the last to be a multiple of 256 KiB.
+CHUNK_ALIGNMENT = 256 * 1024
+# Upload session URIs stay valid for a week.
+SESSION_MAX_AGE = 6 * 24 * 3600
+# Session URIs authorise uploads, so they are kept in the private state directory.
+SESSION_FILE_NAME = "gdrive-sessions.json"
+
+DEFAULT_UPLOAD_WORKERS = 4
+
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+_RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+_sessions_lock = threading.Lock()
+
+
+def _open(req: request.Request) -> Tuple[Optional[int], Any, bytes]:
+    """Send ``req`` and return the status, headers and body.
+
+    Error statuses are returned rather than raised because the resumable
+    protocol answers ``308`` for chunks that are not the last one.
+    """
+    try:
+        resp = http_client.urlopen(req)
+    except error.HTTPError as exc:
+        return exc.code, exc.headers, exc.read() or b""
+    with resp:
+        status = None
+        if hasattr(resp, "getcode"):
+            status = resp.getcode()
+        elif hasattr(resp, "status"):
+            status = resp.status
+        return status, getattr(resp, "headers", {}) or {}, resp.read() or b""
+
+
+class RateLimitError(RuntimeError):
+    """Raised when Drive rejects an upload because of its rate limits."""
+
+
+def _rate_limited(status: Optional[int], body: bytes) -> bool:
+    """Return ``True`` for a 429 or a 403 whose reason is a rate limit."""
+    if status == 429:
+        return True
+    if status != 403:
+        return False
+    try:
+        errors = json.loads(body.decode("utf-8", "replace")).get("error", {}).get("errors", [])
+    except (ValueError, AttributeError):
+        return False
+    return any(err.get("reason") in _RATE_LIMIT_REASONS for err in errors)
+
+
+def _file_id(body: bytes) -> Optional[str]:
+    """Return the id from the JSON body of a completed upload, if any."""
+    try:
+        return json.loads(body.decode()).get("id")
+    except (ValueError, AttributeError):
+        return None
+
+
+def _next_offset(headers: Any) -> int:
+    """Return the first byte the server has not received from a ``Range`` header."""
+    value = headers.get("Range", "") if headers else ""
+    if not value or "-" not in value:
+        return 0
+    return int(value.rsplit("-", 1)[1]) + 1
 
 
 class GDriveUploadAction(BaseAction):
@@ -19,24 +94,43 @@ class GDriveUploadAction(BaseAction):
 
         Expected params:
             - ``folder_id``: destination Drive folder
-            - ``token`` (optional): OAuth bearer token. If omitted the
-              ``GDRIVE_TOKEN`` environment variable is used.
+            - ``token_file`` (optional): OAuth token file whose access token
+              is refreshed automatically before it expires. Defaults to the
+              ``GDRIVE_TOKEN_FILE`` environment variable.
+            - ``token`` (optional): static OAuth bearer token used when no
+              token file is configured. If omitted the ``GDRIVE_TOKEN``
+              environment variable is used.
+            - ``resumable_threshold`` (optional): files of at least this many
+              bytes are sent with a resumable upload, defaults to 5 MiB.
+            - ``chunk_size`` (optional): bytes sent per resumable request,
+              rounded down to a multiple of 256 KiB, defaults to 8 MiB.
+            - ``session_file`` (optional): JSON file remembering unfinished
+              upload sessions so a later run resumes them. Defaults to
+              ``gdrive-sessions.json`` in the state directory. The file is
+              written readable only by its owner.
+            - ``max_retries`` (optional): attempts per chunk after network
+              errors or 429/5xx answers, defaults to ``5``.
+            - ``skip_unchanged`` (optional): look the file up by name in the
+              folder first. A file with the same ``md5Checksum`` is not
+              uploaded again and a changed one gets a new revision instead
+              of a duplicate.
 
         The payload should provide either ``file_path`` or ``content`` and an
-        optional ``filename``.
+        optional ``filename``. Files read from ``file_path`` above the
+        threshold are streamed from disk one chunk at a time.
         """
 
         folder_id = self.params.get("folder_id")
-        token = self.params.get("token") or os.environ.get("GDRIVE_TOKEN")
+        token = google_auth.bearer_token(self.params)
         file_path = data.get("file_path")
         filename = data.get("filename")
         content = data.get("content")
+        size = None
 
         if file_path:
             try:
                 filename = filename or os.path.basename(file_path)
-                with open(file_path, "rb") as fh:
-                    content = fh.read()
+                size = os.path.getsize(file_path)
             except FileNotFoundError:
                 logging.error("File %s not found", file_path)
                 raise
@@ -46,7 +140,7 @@ class GDriveUploadAction(BaseAction):
             missing.append("folder_id")
         if not token:
             missing.append("token")
-        if content is None:
+        if content is None and size is None:
             missing.append("content")
 
         if missing:
@@ -56,9 +150,40 @@ class GDriveUploadAction(BaseAction):
             )
 
         filename = filename or "upload.txt"
+        file_id = None
+        digest = None
+        if str(self.params.get("skip_unchanged", False)).lower() in {"1", "true", "yes"}:
+            digest = drive_index.md5_file(file_path) if size is not None else hashlib.md5(content).hexdigest()
+            existing = drive_index.list_files(folder_id, token).get(filename)
+            if existing and existing.get("md5Checksum") == digest:
+                logging.info("%s is unchanged in Google Drive folder %s, skipping", filename, folder_id)
+                return
+            file_id = existing.get("id") if existing else None
+
         logging.info("Uploading %s to Google Drive folder %s", filename, folder_id)
+        # an existing file is updated in place and keeps its folder
+        metadata: Dict[str, Any] = {"name": filename}
+        if not file_id:
+            metadata["parents"] = [folder_id]
+
+        threshold = int(self.params.get("resumable_threshold", DEFAULT_RESUMABLE_THRESHOLD))
+        if size is not None and size and size >= threshold:
+            try:
+                new_id = self._upload_resumable(file_path, size, metadata, token, file_id)
+            except RateLimitError:
+                raise
+            except Exception as exc:  # pylint: disable=broad-except
+                logging.exception("Google Drive upload failed: %s", exc)
+                raise RuntimeError("Google Drive upload failed") from exc
+            if digest:
+                drive_index.record_file(folder_id, filename, new_id or file_id, digest)
+            logging.info("Google Drive upload successful")
+            return
+
+        if size is not None:
+            with open(file_path, "rb") as fh:
+                content = fh.read()
 
-        metadata = {"name": filename, "parents": [folder_id]}
         boundary = "pyzap_boundary"
         body = (
             f"--{boundary}\r\n"
@@ -73,22 +198,234 @@ class GDriveUploadAction(BaseAction):
             "Content-Type": f"multipart/related; boundary={boundary}",
         }
         req = request.Request(
-            "https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart",
+            f"{UPLOAD_URL}/{file_id}?uploadType=multipart" if file_id else f"{UPLOAD_URL}?uploadType=multipart",
             data=body,
             headers=headers,
+            method="PATCH" if file_id else "POST",
         )
 
         try:
-            resp = request.urlopen(req)
-            status = None
-            if hasattr(resp, "getcode"):
-                status = resp.getcode()
-            elif hasattr(resp, "status"):
-                status = resp.status
+            with http_client.urlopen(req) as resp:
+                status = None
+                if hasattr(resp, "getcode"):
+                    status = resp.getcode()
+                elif hasattr(resp, "status"):
+                    status = resp.status
+                response_body = resp.read()
             if status is not None and not 200 <= status < 300:
                 logging.error("Google Drive upload failed with status %s", status)
                 raise RuntimeError("Google Drive upload failed")
             logging.info("Google Drive upload successful")
+            if digest:
+                drive_index.record_file(folder_id, filename, _file_id(response_body) or file_id, digest)
+        except error.HTTPError as exc:
+            if _rate_limited(exc.code, exc.read() or b""):
+                raise RateLimitError("Google Drive rate limit exceeded") from exc
+            logging.exception("Google Drive upload failed: %s", exc)
+            raise RuntimeError("Google Drive upload failed") from exc
         except Exception as exc:  # pylint: disable=broad-except
             logging.exception("Google Drive upload failed: %s", exc)
             raise RuntimeError("Google Drive upload failed") from exc
+
+    # Resumable uploads ----------------------------------------------------
+
+    def _session_file(self) -> str:
+        path = self.params.get("session_file")
+        if not path:
+            path = os.path.join(state.private_dir(state.root()), SESSION_FILE_NAME)
+        return path
+
+    def _load_sessions(self) -> Dict[str, Any]:
+        try:
+            with open(self._session_file(), "r", encoding="utf-8") as fh:
+                sessions = json.load(fh)
+        except (OSError, ValueError):
+            return {}
+        limit = time.time() - SESSION_MAX_AGE
+        return {k: v for k, v in sessions.items() if v.get("created", 0) >= limit}
+
+    def _store_session(self, key: str, uri: Optional[str]) -> None:
+        """Remember (or forget, when ``uri`` is ``None``) the session for ``key``."""
+        path = self._session_file()
+        with _sessions_lock:
+            sessions = self._load_sessions()
+            if uri:
+                sessions[key] = {"uri": uri, "created": time.time()}
+            elif sessions.pop(key, None) is None:
+                return
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                with state.open_private(tmp_path, encoding="utf-8") as fh:
+                    json.dump(sessions, fh)
+                os.replace(tmp_path, path)
+            except OSError as exc:
+                logging.warning("Unable to save Drive upload sessions %s: %s", path, exc)
+
+    def _start_session(
+        self, size: int, metadata: Dict[str, Any], token: str, file_id: Optional[str] = None
+    ) -> str:
+        req = request.Request(
+            f"{UPLOAD_URL}/{file_id}?uploadType=resumable" if file_id else f"{UPLOAD_URL}?uploadType=resumable",
+            data=json.dumps(metadata).encode(),
+            headers={
+                "Authorization": f"Bearer {token}",
+                "Content-Type": "application/json; charset=UTF-8",
+                "X-Upload-Content-Type": "application/octet-stream",
+                "X-Upload-Content-Length": str(size),
+            },
+            method="PATCH" if file_id else "POST",
+        )
+        status, headers, body = _open(req)
+        if _rate_limited(status, body):
+            raise RateLimitError("Google Drive rate limit exceeded")
+        uri = headers.get("Location") if headers else None
+        if status is None or not 200 <= status < 300 or not uri:
+            raise RuntimeError(f"Unable to start resumable upload (status {status})")
+        return uri
+
+    def _query_offset(self, uri: str, size: int, token: str) -> Optional[int]:
+        """Ask the server how much of the upload it has.
+
+        Returns the next offset, ``size`` when the upload is already complete
+        or ``None`` when the session no longer exists.
+        """
+        req = request.Request(
+            uri,
+            data=b"",
+            headers={
+                "Authorization": f"Bearer {token}",
+                "Content-Range": f"bytes */{size}",
+            },
+            method="PUT",
+        )
+        status, headers, _body = _open(req)
+        if status in (200, 201):
+            return size
+        if status == 308:
+            return _next_offset(headers)
+        if status in (404, 410):
+            return None
+        raise RuntimeError(f"Unable to query upload status (status {status})")
+
+    def _upload_resumable(
+        self,
+        file_path: str,
+        size: int,
+        metadata: Dict[str, Any],
+        token: str,
+        file_id: Optional[str] = None,
+    ) -> Optional[str]:
+        """Stream ``file_path`` to Drive in chunks, resuming a stored session.
+
+        Returns the id of the uploaded file when Drive reports it.
+        """
+        chunk_size = int(self.params.get("chunk_size", DEFAULT_CHUNK_SIZE))
+        chunk_size = max(CHUNK_ALIGNMENT, chunk_size // CHUNK_ALIGNMENT * CHUNK_ALIGNMENT)
+        max_retries = int(self.params.get("max_retries", 5))
+        stat = os.stat(file_path)
+        key = "|".join(
+            [
+                os.path.abspath(file_path),
+                str(size),
+                str(stat.st_mtime),
+                file_id or "",
+                json.dumps(metadata, sort_keys=True),
+            ]
+        )
+
+        uri = self._load_sessions().get(key, {}).get("uri")
+        offset = self._query_offset(uri, size, token) if uri else None
+        if offset is None:
+            uri = self._start_session(size, metadata, token, file_id)
+            self._store_session(key, uri)
+            offset = 0
+        else:
+            logging.info("Resuming upload of %s at byte %d", file_path, offset)
+
+        retries = 0
+        new_id = None
+        with open(file_path, "rb") as fh:
+            while offset < size:
+                fh.seek(offset)
+                chunk = fh.read(chunk_size)
+                end = offset + len(chunk) - 1
+                req = request.Request(
+                    uri,
+                    data=chunk,
+                    headers={
+                        "Authorization": f"Bearer {token}",
+                        "Content-Length": str(len(chunk)),
+                        "Content-Range": f"bytes {offset}-{end}/{size}",
+                    },
+                    method="PUT",
+                )
+                try:
+                    status, headers, body = _open(req)
+                except OSError as exc:
+                    status, headers, body = None, None, b""
+                    logging.warning("Drive upload of %s interrupted: %s", file_path, exc)
+                if status in (200, 201):
+                    offset = size
+                    new_id = _file_id(body)
+                elif status == 308:
+                    offset = _next_offset(headers)
+                    retries = 0
+                elif status in (404, 410):
+                    self._store_session(key, None)
+                    raise RuntimeError("Drive upload session expired")
+                elif status is None or status in _RETRY_STATUS or _rate_limited(status, body):
+                    retries += 1
+                    if retries > max_retries:
+                        raise RuntimeError(f"Drive upload failed after {max_retries} retries")
+                    time.sleep(min(2 ** retries, 60))
+                    queried = self._query_offset(uri, size, token)
+                    if queried is None:
+                        self._store_session(key, None)
+                        raise RuntimeError("Drive upload session expired")
+                    offset = queried
+                else:
+                    raise RuntimeError(f"Drive upload failed with status {status}")
+        self._store_session(key, None)
+        logging.debug("Uploaded %s (%d bytes) in resumable mode", file_path, size)
+        return new_id
+
+
+def upload_files(
+    params: Dict[str, Any],
+    files: List[Dict[str, Any]],
+    *,
+    max_workers: int = DEFAULT_UPLOAD_WORKERS,
+    retries: int = 5,
+    backoff: float = 1.0,
+) -> List[Dict[str, Any]]:
+    """Upload ``files`` concurrently with :class:`GDriveUploadAction`.
+
+    Each item of ``files`` is a payload for :meth:`GDriveUploadAction.execute`.
+    Uploads rejected by Drive rate limits are retried after an exponential
+    backoff with jitter, so parallel workers do not retry in lockstep.
+    Returns one ``{"filename", "ok", "error"}`` entry per file, in order.
+    """
+    uploader = GDriveUploadAction(params)
+
+    def _upload(item: Dict[str, Any]) -> None:
+        attempt = 0
+        while True:
+            try:
+                uploader.execute(item)
+                return
+            except RateLimitError:
+                if attempt >= retries:
+                    raise
+                delay = backoff * (2 ** attempt) * (1 + random.random())
+                logging.warning("Drive rate limit hit, retrying in %.1fs", delay)
+                time.sleep(delay)
+                attempt += 1
+
+    outcomes = run_parallel([partial(_upload, item) for item in files], max_workers=max_workers)
+    results: List[Dict[str, Any]] = []
+    for item, (ok, value) in zip(files, outcomes):
+        name = item.get("filename") or os.path.basename(item.get("file_path") or "")
+        if not ok:
+            logging.error("Upload of %s to Google Drive failed: %s", name, value)
+        results.append({"filename": name, "ok": ok, "error": None if ok else str(value)})
+    return results
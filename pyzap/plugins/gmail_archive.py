@@ -3,66 +3,94 @@
 from __future__ import annotations
 
 import base64
+from functools import partial
 import json
-import os
 from pathlib import Path
-from typing import Any, Dict, List, Optional
-from urllib import request
-from urllib.parse import urlparse
+import shutil
+import tempfile
+from typing import Any, Dict, List, Optional, Set
 import re
 import html
 from email.header import decode_header, make_header
 
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-
+from .. import drive_index, google_auth, google_batch
 from ..core import BaseAction
-from .gdrive_upload import GDriveUploadAction
-from ..utils import safe_filename
+from .gdrive_upload import DEFAULT_UPLOAD_WORKERS, upload_files
+from ..google_auth import get_service
+from .. import link_download
+from ..message_cache import get_cache, gmail_key
+from ..utils import run_parallel, safe_filename, unique_filename
+
+SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
+DEFAULT_WORKERS = 4
+# Base64 characters decoded per write; a multiple of 4.
+DECODE_CHUNK = 1024 * 1024
+
+
+def _decode_to_file(data: str, dest: Path) -> None:
+    """Decode base64url ``data`` into ``dest`` one chunk at a time."""
+    with open(dest, "wb") as fh:
+        for start in range(0, len(data), DECODE_CHUNK):
+            chunk = data[start : start + DECODE_CHUNK]
+            fh.write(base64.urlsafe_b64decode(chunk + "=" * (-len(chunk) % 4)))
 
 
 class GmailArchiveAction(BaseAction):
     """Download a Gmail message and attachments and store them."""
 
-    def _collect_text(
-        self,
-        part: Dict[str, Any],
-        *,
-        service: Optional[Any] = None,
-        msg_id: Optional[str] = None,
-    ) -> List[str]:
-        """Recursively collect text parts from a Gmail message payload."""
-
-        text_parts: List[str] = []
-        mime = part.get("mimeType", "")
-        body = part.get("body", {})
-        data = body.get("data")
+    def _text_parts(self, part: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Return the text parts of a Gmail message payload in order."""
 
-        if (not data) and body.get("attachmentId") and service and msg_id:
-            try:
-                raw = (
-                    service.users()
-                    .messages()
-                    .attachments()
-                    .get(userId="me", messageId=msg_id, id=body["attachmentId"])
-                    .execute()
-                )
-                data = raw.get("data")
-            except Exception:
-                data = None
+        parts: List[Dict[str, Any]] = []
+        if part.get("mimeType", "") in ("text/plain", "text/html"):
+            body = part.get("body", {})
+            if body.get("data") or body.get("attachmentId"):
+                parts.append(body)
+        for sub in part.get("parts", []):
+            parts.extend(self._text_parts(sub))
+        return parts
 
-        if data and mime in ("text/plain", "text/html"):
-            try:
-                text = base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
-                text_parts.append(text)
-            except Exception:
-                pass
+    def _fetch_attachment(self, token_file: str, msg_id: str, att_id: str) -> str:
+        """Return the base64url data of an attachment.
 
-        for sub in part.get("parts", []):
-            text_parts.extend(self._collect_text(sub, service=service, msg_id=msg_id))
+        Runs on worker threads, so every call gets the service object of the
+        current thread from the shared cache.
+        """
+        service = self._load_service(token_file)
+        request = (
+            service.users().messages().attachments().get(userId="me", messageId=msg_id, id=att_id)
+        )
+        # parallel downloads are the likeliest to hit per-user rate limits
+        raw = google_batch.execute(request)
+        return raw.get("data") or ""
+
+    def _save_attachment(
+        self, token_file: str, msg_id: str, att_id: str, dest: Path
+    ) -> None:
+        _decode_to_file(self._fetch_attachment(token_file, msg_id, att_id), dest)
 
-        return text_parts
+    def _text(self, token_file: str, msg_id: str, body: Dict[str, Any]) -> str:
+        data = body.get("data")
+        if not data:
+            try:
+                data = self._fetch_attachment(token_file, msg_id, body["attachmentId"])
+            except Exception:  # pylint: disable=broad-except
+                return ""
+        try:
+            return base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
+        except Exception:  # pylint: disable=broad-except
+            return ""
+
+    def _link_downloader(self, ext_filter: Optional[List[str]]) -> link_download.LinkDownloader:
+        """Return a downloader configured from the ``link_*`` params."""
+        return link_download.LinkDownloader(
+            max_workers=int(self.params.get("link_workers", link_download.DEFAULT_WORKERS)),
+            per_host=int(self.params.get("link_per_host", link_download.DEFAULT_PER_HOST)),
+            timeout=float(self.params.get("link_timeout", link_download.DEFAULT_TIMEOUT)),
+            max_bytes=int(self.params.get("link_max_bytes", link_download.DEFAULT_MAX_BYTES)),
+            allowed=ext_filter,
+            cache_dir=self.params.get("link_cache_dir"),
+        )
 
     @staticmethod
     def _strip_replies(text: str) -> str:
@@ -78,34 +106,13 @@ class GmailArchiveAction(BaseAction):
         return "\n".join(lines).strip()
 
     def _load_service(self, token_file: str):
-        creds = Credentials.from_authorized_user_file(
-            token_file,
-            ["https://www.googleapis.com/auth/gmail.readonly"],
-        )
-        if creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        service = build("gmail", "v1", credentials=creds, cache_discovery=False)
-        return service
-
-    def _create_drive_folder(self, name: str, parent: Optional[str], token: str) -> str:
-        metadata = {"name": name, "mimeType": "application/vnd.google-apps.folder"}
-        if parent:
-            metadata["parents"] = [parent]
-        body = json.dumps(metadata).encode()
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-        }
-        req = request.Request("https://www.googleapis.com/drive/v3/files", data=body, headers=headers)
-        with request.urlopen(req) as resp:
-            data = json.loads(resp.read().decode())
-        return data["id"]
+        return get_service("gmail", "v1", token_file, SCOPES)
 
     def execute(self, data: Dict[str, Any]) -> Dict[str, Any]:
         token_file = self.params.get("token_file") or data.get("token_file", "token.json")
         drive_parent = self.params.get("drive_folder_id")
         local_dir = self.params.get("local_dir")
-        token = self.params.get("token") or os.environ.get("GDRIVE_TOKEN")
+        token = None if local_dir else google_auth.bearer_token(self.params, "drive_token_file")
         save_message = bool(self.params.get("save_message", True))
         save_attachments = bool(self.params.get("save_attachments", True))
         download_links = bool(self.params.get("download_links", False))
@@ -122,13 +129,17 @@ class GmailArchiveAction(BaseAction):
         if not local_dir and not drive_parent:
             raise ValueError("Either local_dir or drive_folder_id must be set")
 
-        service = self._load_service(token_file)
-        msg = (
-            service.users()
-            .messages()
-            .get(userId="me", id=msg_id, format="full")
-            .execute()
-        )
+        cached = get_cache().get(gmail_key(token_file, msg_id))
+        if cached is not None:
+            msg = json.loads(cached.decode())
+        else:
+            service = self._load_service(token_file)
+            msg = (
+                service.users()
+                .messages()
+                .get(userId="me", id=msg_id, format="full")
+                .execute()
+            )
 
         headers = {h["name"].lower(): h.get("value", "") for h in msg.get("payload", {}).get("headers", [])}
         sender = headers.get("from", "")
@@ -136,92 +147,98 @@ class GmailArchiveAction(BaseAction):
         date = headers.get("date", "")
         snippet = msg.get("snippet", "")
 
+        try:
+            workers = int(self.params.get("download_workers", DEFAULT_WORKERS))
+        except Exception:
+            workers = DEFAULT_WORKERS
         attachments: List[str] = []
-        files: List[tuple[str, bytes]] = []
-        if save_attachments:
-            for part in msg.get("payload", {}).get("parts", []):
-                raw_name = part.get("filename")
-                att_id = part.get("body", {}).get("attachmentId")
-                if raw_name and att_id:
-                    decoded = str(make_header(decode_header(raw_name)))
-                    if ext_filter and not any(
-                        decoded.lower().endswith(ext) for ext in ext_filter
-                    ):
-                        continue
-                    filename = safe_filename(decoded)
-                    raw = (
-                        service.users()
-                        .messages()
-                        .attachments()
-                        .get(userId="me", messageId=msg_id, id=att_id)
-                        .execute()
-                    )
-                    content = base64.urlsafe_b64decode(raw["data"])
-                    files.append((filename, content))
-                    attachments.append(filename)
-
-        message_text = "\n".join(
-            self._collect_text(
-                msg.get("payload", {}), service=service, msg_id=msg_id
-            )
-        )
-        message_text = self._strip_replies(message_text)
-        message_text = html.unescape(message_text)
-
-        if download_links:
-            urls = set(re.findall(r"https?://[^\s\"<>]+", message_text))
-            urls.update(re.findall(r'href=[\"\'](https?://[^\"\']+)', message_text))
-            for url in urls:
-                try:
-                    with request.urlopen(url) as resp:
-                        headers = getattr(resp, "headers", None)
-                        if headers is not None:
-                            cd = headers.get("Content-Disposition", "")
-                        else:
-                            cd = getattr(resp, "getheader", lambda x, default="": default)("Content-Disposition")
-                        content = resp.read()
-                    parsed = urlparse(url)
-                    name = os.path.basename(parsed.path)
-                    if not name or not Path(name).suffix:
-                        m = re.search(r'filename="?([^";]+)"?', cd)
-                        if m:
-                            name = os.path.basename(m.group(1))
-                    if not name:
-                        name = "downloaded_file"
-                    name = safe_filename(name)
-                    ext = Path(name).suffix.lower()
-                    if ext_filter and ext not in ext_filter:
-                        continue
-                    files.append((name, content))
-                    attachments.append(name)
-                except Exception:
-                    continue
-
-        folder_name = str(msg_id)
-        storage_path = ""
-        need_storage = save_message or bool(files)
-        if need_storage and local_dir:
-            folder = Path(local_dir) / folder_name
-            folder.mkdir(parents=True, exist_ok=True)
-            if save_message:
-                with open(folder / "message.txt", "w", encoding="utf-8") as fh:
-                    fh.write(message_text)
-            for name, content in files:
-                with open(folder / name, "wb") as fh:
-                    fh.write(content)
-            storage_path = str(folder)
-        elif need_storage:
-            if not token:
-                raise ValueError("token required for Google Drive upload")
-            folder_id = self._create_drive_folder(folder_name, drive_parent, token)
-            uploader = GDriveUploadAction({"folder_id": folder_id, "token": token})
-            if save_message:
-                uploader.execute({"content": message_text.encode(), "filename": "message.txt"})
-            for name, content in files:
-                uploader.execute({"content": content, "filename": name})
-            storage_path = folder_id
-
-        file_paths = [str(Path(storage_path) / name) for name, _ in files]
+        stage_root = local_dir if local_dir else None
+        if stage_root:
+            Path(stage_root).mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(prefix=".pyzap-gmail-", dir=stage_root) as tmp:
+            staging = Path(tmp)
+            wanted: List[tuple[str, str]] = []
+            taken: Set[str] = set()
+            if save_attachments:
+                for part in msg.get("payload", {}).get("parts", []):
+                    raw_name = part.get("filename")
+                    att_id = part.get("body", {}).get("attachmentId")
+                    if raw_name and att_id:
+                        decoded = str(make_header(decode_header(raw_name)))
+                        if ext_filter and not any(
+                            decoded.lower().endswith(ext) for ext in ext_filter
+                        ):
+                            continue
+                        # two parts with one name must not share a file
+                        name = unique_filename(safe_filename(decoded), taken)
+                        wanted.append((name, att_id))
+            text_bodies = self._text_parts(msg.get("payload", {}))
+
+            # attachments and text parts are downloaded together on a small
+            # pool; each attachment is decoded straight into its file
+            tasks = [
+                partial(self._save_attachment, token_file, msg_id, att_id, staging / name)
+                for name, att_id in wanted
+            ] + [partial(self._text, token_file, msg_id, body) for body in text_bodies]
+            outcomes = run_parallel(tasks, max_workers=workers)
+            for (name, _att_id), (ok, value) in zip(wanted, outcomes):
+                if not ok:
+                    raise value
+                attachments.append(name)
+            texts = [value for ok, value in outcomes[len(wanted):] if ok and value]
+
+            message_text = "\n".join(texts)
+            message_text = self._strip_replies(message_text)
+            message_text = html.unescape(message_text)
+
+            if download_links:
+                urls = set(re.findall(r"https?://[^\s\"<>]+", message_text))
+                urls.update(re.findall(r'href=[\"\'](https?://[^\"\']+)', message_text))
+                attachments.extend(
+                    self._link_downloader(ext_filter).download_all(sorted(urls), staging, taken)
+                )
+
+            folder_name = str(msg_id)
+            storage_path = ""
+            uploads: List[Dict[str, Any]] = []
+            need_storage = save_message or bool(attachments)
+            if need_storage and local_dir:
+                folder = Path(local_dir) / folder_name
+                folder.mkdir(parents=True, exist_ok=True)
+                if save_message:
+                    with open(folder / "message.txt", "w", encoding="utf-8") as fh:
+                        fh.write(message_text)
+                for name in dict.fromkeys(attachments):
+                    shutil.move(str(staging / name), str(folder / name))
+                storage_path = str(folder)
+            elif need_storage:
+                if not token:
+                    raise ValueError("token required for Google Drive upload")
+                folder_id = drive_index.folder_id(
+                    folder_name, drive_parent, token, cache_file=self.params.get("drive_cache_file")
+                )
+                files = [
+                    {"file_path": str(staging / name), "filename": name}
+                    for name in dict.fromkeys(attachments)
+                ]
+                if save_message:
+                    files.insert(0, {"content": message_text.encode(), "filename": "message.txt"})
+                uploads = upload_files(
+                    {
+                        "folder_id": folder_id,
+                        "token": token,
+                        "token_file": self.params.get("drive_token_file"),
+                        "skip_unchanged": True,
+                    },
+                    files,
+                    max_workers=int(self.params.get("upload_workers", DEFAULT_UPLOAD_WORKERS)),
+                )
+                storage_path = folder_id
+                failed = [u["filename"] for u in uploads if not u["ok"]]
+                if failed and self.params.get("fail_on_upload_error", True):
+                    raise RuntimeError("Google Drive upload failed for %s" % ", ".join(failed))
+
+        file_paths = [str(Path(storage_path) / name) for name in attachments]
 
         return {
             "datetime": date,
@@ -231,4 +248,5 @@ class GmailArchiveAction(BaseAction):
             "attachments": attachments,
             "storage_path": storage_path,
             "attachment_paths": file_paths,
+            "uploads": uploads,
         }
@@ -2,17 +2,25 @@
 
 from __future__ import annotations
 
-import email
 from email.header import decode_header, make_header
+from email.message import Message
 import imaplib
-import os
+import io
+import logging
 from pathlib import Path
-from typing import Any, Dict, List
+import tempfile
+from typing import Any, BinaryIO, Dict, List, Optional
 
+from .. import drive_index, google_auth
 from ..core import BaseAction
-from .gdrive_upload import GDriveUploadAction
+from .gdrive_upload import DEFAULT_UPLOAD_WORKERS, upload_files
+from .imap_poll import account_id
+from ..message_cache import get_cache, imap_key
+from ..mime_stream import stream_parts
 from ..utils import safe_filename
 
+DEFAULT_FETCH_CHUNK = 1024 * 1024
+
 
 class ImapArchiveAction(BaseAction):
     """Download an IMAP message and attachments and store them."""
@@ -25,78 +33,212 @@ class ImapArchiveAction(BaseAction):
         password: str,
         mailbox: str,
         port: int,
-    ) -> email.message.EmailMessage:
+        out: BinaryIO,
+        chunk_size: int = DEFAULT_FETCH_CHUNK,
+        *,
+        uid: Optional[str] = None,
+        uidvalidity: Optional[str] = None,
+    ) -> None:
+        """Download the raw message into ``out`` in ``chunk_size`` pieces.
+
+        The message is addressed by ``uid`` when the payload carries one,
+        otherwise by its sequence number ``msg_id``.
+        """
         with imaplib.IMAP4_SSL(host, port) as client:
             client.login(username, password)
             client.select(mailbox)
-            status, data = client.fetch(msg_id, "(RFC822)")
-            if status != "OK" or not data:
-                raise RuntimeError("IMAP fetch failed")
-            return email.message_from_bytes(data[0][1])  # type: ignore[arg-type]
+            if uid and uidvalidity:
+                _typ, current = client.response("UIDVALIDITY")
+                if current and current[0] and current[0] not in (
+                    str(uidvalidity),
+                    str(uidvalidity).encode(),
+                ):
+                    raise RuntimeError("IMAP UIDVALIDITY of %s changed" % mailbox)
+            offset = 0
+            while True:
+                parts = f"(BODY.PEEK[]<{offset}.{chunk_size}>)"
+                if uid:
+                    status, data = client.uid("FETCH", str(uid), parts)
+                else:
+                    status, data = client.fetch(msg_id, parts)
+                chunk = None
+                if status == "OK" and data and isinstance(data[0], tuple):
+                    chunk = data[0][1]
+                if chunk is None:
+                    if offset == 0:
+                        raise RuntimeError("IMAP fetch failed")
+                    break
+                out.write(chunk)
+                offset += len(chunk)
+                if len(chunk) < chunk_size:
+                    break
+
+    def _cached_message(
+        self, data: Dict[str, Any], host: str, mailbox: str
+    ) -> Optional[BinaryIO]:
+        """Return the message stored by ``imap_poll`` if still cached."""
+        uid = data.get("uid")
+        uidvalidity = data.get("uidvalidity")
+        if not uid or not uidvalidity:
+            return None
+        fh = get_cache().open(imap_key(host, mailbox, uidvalidity, uid))
+        if fh is not None:
+            logging.debug("Using cached IMAP message uid %s", uid)
+        return fh
+
+    def _account_params(self, account: Optional[str]) -> Dict[str, Any]:
+        """Return the params matching a multi-account ``imap_poll`` payload.
+
+        When ``accounts`` is configured the entry whose ``username``,
+        ``host`` and ``mailbox`` match the payload ``account`` supplies the
+        connection settings; other keys fall back to the top-level params.
+        """
+        accounts = self.params.get("accounts")
+        if not account or not accounts:
+            return self.params
+        base = {k: v for k, v in self.params.items() if k != "accounts"}
+        for acc in accounts:
+            merged = {**base, **acc}
+            if account_id(merged) == account:
+                return merged
+        return base
 
     def execute(self, data: Dict[str, Any]) -> Dict[str, Any]:
-        host = self.params.get("host")
-        username = self.params.get("username")
-        password = self.params.get("password")
-        mailbox = self.params.get("mailbox", "INBOX")
+        """Store an IMAP message and its attachments.
+
+        The raw message is read from the shared cache or downloaded in
+        ``fetch_chunk_size`` pieces into a spooled temporary file, then parsed
+        as a stream: each attachment is decoded straight into its destination
+        file (or a temporary file for Drive uploads), so memory use does not
+        grow with attachment size.
+        """
+
+        params = self._account_params(data.get("account"))
+        host = params.get("host")
+        username = params.get("username")
+        password = params.get("password")
+        mailbox = params.get("mailbox", "INBOX")
         try:
-            port = int(self.params.get("port", 993))
+            port = int(params.get("port", 993))
         except Exception:
             port = 993
+        try:
+            chunk_size = int(self.params.get("fetch_chunk_size", DEFAULT_FETCH_CHUNK))
+        except Exception:
+            chunk_size = DEFAULT_FETCH_CHUNK
+        if chunk_size <= 0:
+            chunk_size = DEFAULT_FETCH_CHUNK
         drive_parent = self.params.get("drive_folder_id")
         local_dir = self.params.get("local_dir")
-        token = self.params.get("token") or os.environ.get("GDRIVE_TOKEN")
+        token = None if local_dir else google_auth.bearer_token(self.params, "drive_token_file")
         save_attachments = bool(self.params.get("save_attachments", True))
         msg_id = data.get("id")
+        uid = data.get("uid")
+        uidvalidity = data.get("uidvalidity")
         if not host or not username or not password:
             raise ValueError("IMAP credentials missing")
         if not msg_id:
             raise ValueError("Message id required")
         if not local_dir and not drive_parent:
             raise ValueError("Either local_dir or drive_folder_id must be set")
+        if not local_dir and not token:
+            raise ValueError("token required for Google Drive upload")
+
+        raw = self._cached_message(data, host, mailbox)
+        if raw is None:
+            raw = tempfile.SpooledTemporaryFile(max_size=chunk_size)
+            try:
+                self._fetch_message(
+                    msg_id,
+                    host,
+                    username,
+                    password,
+                    mailbox,
+                    port,
+                    raw,
+                    chunk_size,
+                    uid=uid,
+                    uidvalidity=uidvalidity,
+                )
+            except Exception:
+                raw.close()
+                raise
+            raw.seek(0)
+
+        # sequence numbers are reused after expunges, only a UID names a message
+        stable = bool(uid and uidvalidity)
+        folder_name = f"{uidvalidity}-{uid}" if stable else str(msg_id)
+        if data.get("account"):
+            folder_name = safe_filename(f"{data['account']}-{folder_name}")
+        with tempfile.TemporaryDirectory(prefix="pyzap-imap-") as tmp_dir:
+            folder = Path(local_dir) / folder_name if local_dir else Path(tmp_dir)
+            folder.mkdir(parents=True, exist_ok=True)
+            attachments: List[str] = []
+            uploads: List[Dict[str, Any]] = []
+            snippet_buf = io.BytesIO()
+            open_files: List[BinaryIO] = []
 
-        msg = self._fetch_message(msg_id, host, username, password, mailbox, port)
-        sender = msg.get("From", "")
-        subject = msg.get("Subject", "")
-        date = msg.get("Date", "")
-        snippet = msg.get_payload(decode=True).decode(errors="replace") if msg.get_payload(decode=True) else ""
-
-        attachments: List[str] = []
-        files: List[tuple[str, bytes]] = []
-        if save_attachments:
-            for part in msg.walk():
-                if part.get_content_disposition() == "attachment":
-                    raw_name = part.get_filename() or "attachment"
+            def on_part(headers: Message, is_root: bool) -> Optional[BinaryIO]:
+                if headers.get_content_disposition() == "attachment":
+                    if not save_attachments:
+                        return None
+                    raw_name = headers.get_filename() or "attachment"
                     decoded = str(make_header(decode_header(raw_name)))
                     filename = safe_filename(decoded)
-                    payload = part.get_payload(decode=True) or b""
-                    files.append((filename, payload))
+                    if open_files:
+                        open_files.pop().close()
+                    fh = open(folder / filename, "wb")
+                    open_files.append(fh)
                     attachments.append(filename)
+                    return fh
+                if is_root:
+                    return snippet_buf
+                return None
 
-        folder_name = str(msg_id)
-        storage_path = ""
-        if local_dir:
-            folder = Path(local_dir) / folder_name
-            folder.mkdir(parents=True, exist_ok=True)
-            with open(folder / "message.txt", "w", encoding="utf-8") as fh:
-                fh.write(snippet)
-            for name, content in files:
-                with open(folder / name, "wb") as fh:
-                    fh.write(content)
-            storage_path = str(folder)
-        else:
-            if not token:
-                raise ValueError("token required for Google Drive upload")
-            from .gmail_archive import GmailArchiveAction  # for helper
-
-            action = GmailArchiveAction({"folder_id": drive_parent, "token": token})
-            # create folder via helper
-            folder_id = action._create_drive_folder(folder_name, drive_parent, token)  # type: ignore[attr-defined]
-            uploader = GDriveUploadAction({"folder_id": folder_id, "token": token})
-            uploader.execute({"content": snippet.encode(), "filename": "message.txt"})
-            for name, content in files:
-                uploader.execute({"content": content, "filename": name})
-            storage_path = folder_id
+            try:
+                root = stream_parts(raw, on_part)
+            finally:
+                for fh in open_files:
+                    fh.close()
+                raw.close()
+
+            sender = root.get("From", "")
+            subject = root.get("Subject", "")
+            date = root.get("Date", "")
+            snippet = snippet_buf.getvalue().decode(errors="replace")
+
+            if local_dir:
+                with open(folder / "message.txt", "w", encoding="utf-8") as fh:
+                    fh.write(snippet)
+                storage_path = str(folder)
+            else:
+                if stable:
+                    folder_id = drive_index.folder_id(
+                        folder_name,
+                        drive_parent,
+                        token,
+                        cache_file=self.params.get("drive_cache_file"),
+                    )
+                else:
+                    folder_id = drive_index.new_folder(folder_name, drive_parent, token)
+                files = [{"content": snippet.encode(), "filename": "message.txt"}] + [
+                    {"file_path": str(folder / name), "filename": name}
+                    for name in dict.fromkeys(attachments)
+                ]
+                uploads = upload_files(
+                    {
+                        "folder_id": folder_id,
+                        "token": token,
+                        "token_file": self.params.get("drive_token_file"),
+                        "skip_unchanged": True,
+                    },
+                    files,
+                    max_workers=int(self.params.get("upload_workers", DEFAULT_UPLOAD_WORKERS)),
+                )
+                storage_path = folder_id
+                failed = [u["filename"] for u in uploads if not u["ok"]]
+                if failed and self.params.get("fail_on_upload_error", True):
+                    raise RuntimeError("Google Drive upload failed for %s" % ", ".join(failed))
 
         return {
             "datetime": date,
@@ -105,4 +247,5 @@ class ImapArchiveAction(BaseAction):
             "summary": snippet,
             "attachments": attachments,
             "storage_path": storage_path,
+            "uploads": uploads,
         }
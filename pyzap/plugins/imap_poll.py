@@ -2,17 +2,297 @@
 
 from __future__ import annotations
 
+import datetime as _dt
 import email
+from email.header import decode_header, make_header
+from email.message import Message
+from functools import partial
 import imaplib
+import json
 import logging
-from typing import Any, Dict, List
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 from ..core import BaseTrigger
+from ..formatter import parse_date
+from ..message_cache import get_cache, imap_key
+from ..utils import run_parallel
+
+_UID_RE = re.compile(rb"UID (\d+)")
+_SEQ_RE = re.compile(rb"^(\d+) ")
+_FLAGS_RE = re.compile(rb"FLAGS \(([^)]*)\)")
+_MODSEQ_RE = re.compile(rb"MODSEQ \((\d+)\)")
+
+
+def account_id(config: Dict[str, Any]) -> str:
+    """Return the identifier used for a mailbox in multi-account payloads."""
+    return "%s@%s/%s" % (
+        config.get("username", ""),
+        config.get("host", ""),
+        config.get("mailbox", "INBOX"),
+    )
+
+
+def _response_values(client: imaplib.IMAP4, code: str) -> List[str]:
+    """Return every untagged response ``code`` received since the last call."""
+    try:
+        _typ, data = client.response(code)
+    except Exception:  # pylint: disable=broad-except
+        return []
+    return [
+        value.decode() if isinstance(value, bytes) else str(value)
+        for value in data or []
+        if value
+    ]
+
+
+def _response_value(client: imaplib.IMAP4, code: str) -> Optional[str]:
+    """Return the value of a response code such as ``UIDVALIDITY``."""
+    values = _response_values(client, code)
+    return values[0] if values else None
+
+
+def _uidvalidity(client: imaplib.IMAP4) -> Optional[str]:
+    """Return the UIDVALIDITY reported when the mailbox was selected."""
+    return _response_value(client, "UIDVALIDITY")
+
+
+def _flag_criterion(flag: str) -> str:
+    """Return the IMAP SEARCH criterion matching messages with ``flag``."""
+    system = {
+        "\\seen": "SEEN",
+        "\\flagged": "FLAGGED",
+        "\\answered": "ANSWERED",
+        "\\deleted": "DELETED",
+        "\\draft": "DRAFT",
+    }
+    return system.get(flag.lower(), f"KEYWORD {flag}")
+
+
+def _uid_set_contains(uid_set: str, uid: int) -> bool:
+    """Return ``True`` if ``uid`` is part of an IMAP sequence set."""
+    for item in uid_set.split(","):
+        if ":" in item:
+            low, high = item.split(":", 1)
+            low_n = int(low) if low != "*" else uid
+            high_n = int(high) if high != "*" else uid
+            if min(low_n, high_n) <= uid <= max(low_n, high_n):
+                return True
+        elif item and item != "*" and int(item) == uid:
+            return True
+    return False
+
+
+def _uid_set(uids: List[str]) -> str:
+    """Return a compact IMAP sequence set such as ``3:5,9`` for ``uids``."""
+    numbers = sorted({int(u) for u in uids})
+    ranges: List[str] = []
+    start = prev = numbers[0]
+    for number in numbers[1:] + [None]:
+        if number is not None and number == prev + 1:
+            prev = number
+            continue
+        ranges.append(str(start) if start == prev else f"{start}:{prev}")
+        if number is not None:
+            start = prev = number
+    return ",".join(ranges)
+
+
+def _flag_list(flags: Any) -> str:
+    """Return ``flags`` (a string or list) as a parenthesised IMAP flag list."""
+    if isinstance(flags, str):
+        flags = flags.split()
+    return "(%s)" % " ".join(str(f) for f in flags)
+
+
+def _parse_message(raw: bytes, label: str) -> Tuple[Message, str, bool]:
+    """Return the parsed message, its plain text body and attachment flag."""
+
+    msg = email.message_from_bytes(raw)
+    if msg.is_multipart():
+        body = ""
+        has_attachments = False
+        # Identify attachments via content disposition
+        # (inline with filename is also treated as attachment)
+        for part in msg.walk():
+            cd = part.get_content_disposition()
+            filename = part.get_filename() or part.get_param("name")
+            is_attachment = bool(
+                filename
+                and (
+                    cd in ("attachment", "inline")
+                    or (
+                        cd is None
+                        and not part.get_content_type().startswith("text/")
+                    )
+                )
+            )
+            logging.debug(
+                "Message %s part: content_type=%s, cd=%s, filename=%s, is_attachment=%s",
+                label,
+                part.get_content_type(),
+                cd,
+                filename,
+                is_attachment,
+            )
+            if (
+                part.get_content_type() == "text/plain"
+                and not body
+                and not is_attachment
+            ):
+                payload_bytes = part.get_payload(decode=True)
+                if payload_bytes is not None:
+                    body = payload_bytes.decode(errors="replace")
+            elif is_attachment:
+                has_attachments = True
+    else:
+        payload_bytes = msg.get_payload(decode=True)
+        # Apply the same attachment detection for single-part messages
+        cd = msg.get_content_disposition()
+        filename = msg.get_filename() or msg.get_param("name")
+        is_attachment = bool(
+            filename
+            and (
+                cd in ("attachment", "inline")
+                or (
+                    cd is None
+                    and not msg.get_content_type().startswith("text/")
+                )
+            )
+        )
+        logging.debug(
+            "Message %s single-part: content_type=%s, cd=%s, filename=%s, is_attachment=%s",
+            label,
+            msg.get_content_type(),
+            cd,
+            filename,
+            is_attachment,
+        )
+        if msg.get_content_type() == "text/plain" and not is_attachment:
+            body = (
+                payload_bytes.decode(errors="replace")
+                if payload_bytes is not None
+                else ""
+            )
+        else:
+            body = ""
+        has_attachments = is_attachment
+
+    return msg, body, has_attachments
+
+
+_MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+def _imap_date(value: Any) -> str:
+    """Return ``value`` formatted as an IMAP date (``1-Jun-2025``).
+
+    Accepts ``datetime``/``date`` objects, IMAP dates and the formats
+    understood by :func:`pyzap.formatter.parse_date`. Month names are built
+    by hand because ``%b`` follows the process locale.
+    """
+    if isinstance(value, (_dt.datetime, _dt.date)):
+        day = value
+    else:
+        text = str(value).strip()
+        match = re.fullmatch(r"(\d{1,2})-([A-Za-z]{3})-(\d{4})", text)
+        if match and match.group(2).title() in _MONTHS:
+            return f"{int(match.group(1))}-{match.group(2).title()}-{match.group(3)}"
+        day = parse_date(text)
+    return f"{day.day}-{_MONTHS[day.month - 1]}-{day.year}"
+
+
+def _quote(value: Any) -> str:
+    text = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{text}"'
+
+
+def _compile_search(config: Dict[str, Any], capabilities: Set[str]) -> Tuple[str, Dict[str, str]]:
+    """Translate structured filters into an IMAP SEARCH expression.
+
+    Returns the search string and the filters that must be checked on the
+    client because IMAP cannot express them (non-ASCII text, which plain
+    ``SEARCH`` cannot carry without literals).
+    """
+
+    criteria = [str(config.get("search", "UNSEEN"))]
+    client_side: Dict[str, str] = {}
+    for key, keyword in (("from", "FROM"), ("to", "TO"), ("subject", "SUBJECT")):
+        value = config.get(key)
+        if value is None or value == "":
+            continue
+        if str(value).isascii():
+            criteria.append(f"{keyword} {_quote(value)}")
+        else:
+            client_side[key] = str(value)
+    for key, keyword in (("since", "SINCE"), ("before", "BEFORE")):
+        if config.get(key):
+            criteria.append(f"{keyword} {_imap_date(config[key])}")
+    for key, keyword in (("larger", "LARGER"), ("smaller", "SMALLER")):
+        if config.get(key) is not None:
+            criteria.append(f"{keyword} {int(config[key])}")
+    headers = config.get("header") or {}
+    if isinstance(headers, (list, tuple)):
+        headers = {name: "" for name in headers}
+    for name, value in headers.items():
+        if str(name).isascii() and str(value).isascii():
+            criteria.append(f"HEADER {_quote(name)} {_quote(value)}")
+        else:
+            client_side[f"header:{name}"] = str(value)
+    has_attachment = str(config.get("has_attachment", "")).lower()
+    if "X-GM-EXT-1" in capabilities and has_attachment in {"1", "true", "yes"}:
+        # Gmail can pre-filter attachments; the MIME check below still applies.
+        criteria.append('X-GM-RAW "has:attachment"')
+    return " ".join(criteria), client_side
+
+
+def _matches_client_filters(msg: Message, filters: Dict[str, str]) -> bool:
+    """Check the filters IMAP could not evaluate against a parsed message."""
+    for key, expected in filters.items():
+        if key.startswith("header:"):
+            header = msg.get(key[len("header:"):])
+            if header is None:
+                return False
+            actual = str(make_header(decode_header(str(header))))
+        else:
+            actual = str(make_header(decode_header(str(msg.get(key, "")))))
+        if expected.lower() not in actual.lower():
+            return False
+    return True
 
 
 class ImapPollTrigger(BaseTrigger):
     """Poll an IMAP server for new messages."""
 
+    #: Propagate connection and search errors instead of logging them and
+    #: returning no messages. Used by ``pyzap backfill`` so a failed date
+    #: window is retried rather than recorded as done.
+    raise_errors = False
+
+    def __init__(self, config: Dict[str, Any]):
+        super().__init__(config)
+        self._state_lock = threading.Lock()
+        self._flag_state: Optional[Dict[str, Any]] = None
+        # flag checkpoints waiting for their events to be processed
+        self._flag_staged: Dict[str, Dict[str, Any]] = {}
+        # messages updated by ``on_success`` are only changed once the
+        # workflow succeeded, and flag events only advance the checkpoint
+        # once processed; failed ones must be offered again
+        self.redeliver = any(
+            cfg.get("on_success") or cfg.get("watch_flags") for cfg in self._configs().values()
+        )
+
+    def _configs(self) -> Dict[Optional[str], Dict[str, Any]]:
+        """Return the effective configuration of every mailbox by account id."""
+        accounts = self.config.get("accounts")
+        if not accounts:
+            return {None: self.config}
+        base = {k: v for k, v in self.config.items() if k != "accounts"}
+        configs = [{**base, **acc} for acc in accounts]
+        return {account_id(cfg): cfg for cfg in configs}
+
     def poll(self) -> List[Dict[str, Any]]:
         """Return messages from the configured IMAP server.
 
@@ -22,6 +302,14 @@ class ImapPollTrigger(BaseTrigger):
         - ``port`` (optional): IMAP SSL port, defaults to ``993``.
         - ``mailbox`` (optional): mailbox to select, defaults to ``INBOX``.
         - ``search`` (optional): IMAP search query, defaults to ``UNSEEN``.
+        - ``from``, ``to``, ``subject`` (optional): keep only messages whose
+          header contains the given text. Evaluated by the server.
+        - ``since`` and ``before`` (optional): date bounds such as
+          ``2025-06-01`` or ``1-Jun-2025``, evaluated by the server.
+        - ``larger`` and ``smaller`` (optional): message size bounds in bytes,
+          evaluated by the server.
+        - ``header`` (optional): mapping of header names to text they must
+          contain, or a list of header names that must be present.
         - ``max_results`` (optional): maximum number of messages to return,
           defaults to ``100``.
         - ``has_attachment`` (optional): filter messages by presence of
@@ -30,24 +318,88 @@ class ImapPollTrigger(BaseTrigger):
           without.
         - ``mark_seen`` (optional): mark messages as read when fetching.
           Defaults to ``true``; set to ``false`` to leave them unread.
+        - ``on_success`` (optional): mailbox updates applied once the workflow
+          ran successfully for a message, with the keys ``add_flags``,
+          ``remove_flags`` (for example ``["\\Seen", "$Processed"]``) and
+          ``move_to`` (a mailbox name). All processed messages of a run are
+          updated with one ``UID STORE``/``UID MOVE`` per mailbox. Messages
+          whose workflow failed are left untouched and offered again on the
+          next poll, and ``mark_seen`` defaults to ``false``.
+        - ``watch_flags`` (optional): list of flags or keywords (for example
+          ``\\Flagged``). When set the trigger reports messages that gained
+          one of them since the previous poll instead of running ``search``.
+          Requires a server supporting CONDSTORE.
+        - ``include_vanished`` (optional): with ``watch_flags`` also emit an
+          ``event: vanished`` payload listing expunged UIDs (QRESYNC only).
+        - ``state_file`` (optional): JSON file persisting the mailbox
+          HIGHESTMODSEQ used by ``watch_flags`` between runs.
+        - ``accounts`` (optional): list of account-specific dictionaries with
+          the same keys as above to poll several mailboxes concurrently.
+          Missing keys fall back to the top-level values.
+        - ``max_workers`` (optional): number of accounts polled concurrently,
+          defaults to ``4``.
+        - ``timeout`` (optional): seconds allowed for each account. It also
+          sets the IMAP socket timeout; with ``accounts`` it defaults to
+          ``120``.
+
+        Fetched messages are stored in the shared message cache keyed by
+        host, mailbox, UIDVALIDITY and UID so ``imap_archive`` can reuse them
+        without downloading them again. With ``accounts`` every payload also
+        carries an ``account`` key (``username@host/mailbox``) identifying
+        the mailbox it came from.
         """
 
-        host = self.config.get("host")
-        username = self.config.get("username")
-        password = self.config.get("password")
-        mailbox = self.config.get("mailbox", "INBOX")
-        search = self.config.get("search", "UNSEEN")
+        accounts = self.config.get("accounts")
+        if accounts:
+            return self._poll_accounts(accounts)
+        return self._poll_account(self.config)
+
+    def _poll_accounts(self, accounts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Poll every configured account concurrently and merge the results."""
+
+        base = {k: v for k, v in self.config.items() if k != "accounts"}
+        configs = [{**base, **acc} for acc in accounts]
+        timeout = float(self.config.get("timeout", 120))
+        tasks = [
+            partial(self._poll_account, cfg, account=account_id(cfg)) for cfg in configs
+        ]
+        outcomes = run_parallel(
+            tasks,
+            max_workers=int(self.config.get("max_workers", 4)),
+            timeout=timeout,
+        )
+        results: List[Dict[str, Any]] = []
+        for cfg, (ok, value) in zip(configs, outcomes):
+            if ok:
+                results.extend(value)
+            elif self.raise_errors:
+                raise value
+            else:
+                logging.error("IMAP polling failed for %s: %s", account_id(cfg), value)
+        logging.info("IMAP polling returned %d messages from %d accounts", len(results), len(configs))
+        return results
+
+    def _poll_account(
+        self, config: Dict[str, Any], *, account: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """Poll a single mailbox described by ``config``."""
+
+        host = config.get("host")
+        username = config.get("username")
+        password = config.get("password")
+        mailbox = config.get("mailbox", "INBOX")
+        search = config.get("search", "UNSEEN")
         try:
-            port = int(self.config.get("port", 993))
+            port = int(config.get("port", 993))
         except Exception:
             port = 993
         try:
-            max_results = int(self.config.get("max_results", 100))
+            max_results = int(config.get("max_results", 100))
         except Exception:
             max_results = 100
         truthy = {"1", "true", "yes"}
         falsy = {"0", "false", "no"}
-        has_attachment_cfg = self.config.get("has_attachment")
+        has_attachment_cfg = config.get("has_attachment")
         has_attachment_filter = None
         if has_attachment_cfg is not None:
             lower = str(has_attachment_cfg).lower()
@@ -55,8 +407,10 @@ class ImapPollTrigger(BaseTrigger):
                 has_attachment_filter = True
             elif lower in falsy:
                 has_attachment_filter = False
+        # with ``on_success`` the messages are updated after the workflow
+        # succeeds, so fetching must not mark them as read already
         mark_seen = (
-            str(self.config.get("mark_seen", True)).lower() not in falsy
+            str(config.get("mark_seen", not config.get("on_success"))).lower() not in falsy
         )
 
         logging.info(
@@ -67,96 +421,51 @@ class ImapPollTrigger(BaseTrigger):
         )
 
         if not host or not username or not password:
+            if self.raise_errors:
+                raise ValueError("IMAP configuration incomplete")
             logging.error("IMAP configuration incomplete")
             return []
 
         try:
-            with imaplib.IMAP4_SSL(host, port) as client:
+            if config.get("timeout") is not None:
+                client_ctx = imaplib.IMAP4_SSL(host, port, timeout=float(config["timeout"]))
+            else:
+                client_ctx = imaplib.IMAP4_SSL(host, port)
+            with client_ctx as client:
                 client.login(username, password)
 
                 logging.info("Logged in to %s as %s", host, username)
+                if config.get("watch_flags"):
+                    return self._poll_flag_changes(client, config, account=account)
                 client.select(mailbox)
+                uidvalidity = _uidvalidity(client)
+                cache = get_cache()
+                capabilities = {str(c).upper() for c in getattr(client, "capabilities", ())}
+                search, client_filters = _compile_search(config, capabilities)
+                logging.debug("IMAP search expression: %s", search)
                 status, data = client.search(None, search)
                 if status != "OK":
+                    if self.raise_errors:
+                        raise imaplib.IMAP4.error(f"IMAP search failed: {status}")
                     logging.error("IMAP search failed: %s", status)
                     return []
                 logging.info("IMAP search returned %d messages", len(data[0].split()))
                 messages = []
                 for num in data[0].split()[:max_results]:
-                    fetch_spec = "(RFC822)" if mark_seen else "(BODY.PEEK[])"
+                    fetch_spec = "(UID RFC822)" if mark_seen else "(UID BODY.PEEK[])"
                     status, msg_data = client.fetch(num, fetch_spec)
                     if status != "OK" or not msg_data:
                         continue
-                    msg = email.message_from_bytes(msg_data[0][1])
-                    if msg.is_multipart():
-                        body = ""
-                        has_attachments = False
-                        # Identify attachments via content disposition
-                        # (inline with filename is also treated as attachment)
-                        for part in msg.walk():
-                            cd = part.get_content_disposition()
-                            filename = part.get_filename() or part.get_param("name")
-                            is_attachment = bool(
-                                filename
-                                and (
-                                    cd in ("attachment", "inline")
-                                    or (
-                                        cd is None
-                                        and not part.get_content_type().startswith("text/")
-                                    )
-                                )
-                            )
-                            logging.debug(
-                                "Message %s part: content_type=%s, cd=%s, filename=%s, is_attachment=%s",
-                                num.decode(),
-                                part.get_content_type(),
-                                cd,
-                                filename,
-                                is_attachment,
-                            )
-                            if (
-                                part.get_content_type() == "text/plain"
-                                and not body
-                                and not is_attachment
-                            ):
-                                payload_bytes = part.get_payload(decode=True)
-                                if payload_bytes is not None:
-                                    body = payload_bytes.decode(errors="replace")
-                            elif is_attachment:
-                                has_attachments = True
-                    else:
-                        payload_bytes = msg.get_payload(decode=True)
-                        # Apply the same attachment detection for single-part messages
-                        cd = msg.get_content_disposition()
-                        filename = msg.get_filename() or msg.get_param("name")
-                        is_attachment = bool(
-                            filename
-                            and (
-                                cd in ("attachment", "inline")
-                                or (
-                                    cd is None
-                                    and not msg.get_content_type().startswith("text/")
-                                )
-                            )
-                        )
-                        logging.debug(
-                            "Message %s single-part: content_type=%s, cd=%s, filename=%s, is_attachment=%s",
-                            num.decode(),
-                            msg.get_content_type(),
-                            cd,
-                            filename,
-                            is_attachment,
-                        )
-                        if msg.get_content_type() == "text/plain" and not is_attachment:
-                            body = (
-                                payload_bytes.decode(errors="replace")
-                                if payload_bytes is not None
-                                else ""
-                            )
-                        else:
-                            body = ""
-                        has_attachments = is_attachment
+                    envelope, raw = msg_data[0][0], msg_data[0][1]
+                    match = _UID_RE.search(envelope or b"")
+                    uid = match.group(1).decode() if match else None
+                    if uid and uidvalidity:
+                        cache.put(imap_key(host, mailbox, uidvalidity, uid), raw)
+                    msg, body, has_attachments = _parse_message(raw, num.decode())
 
+                    if client_filters and not _matches_client_filters(msg, client_filters):
+                        logging.debug("Skipping message %s due to client-side filters", num.decode())
+                        continue
                     if (
                         has_attachment_filter is not None
                         and has_attachments != has_attachment_filter
@@ -175,6 +484,12 @@ class ImapPollTrigger(BaseTrigger):
                         "from": msg.get("From", ""),
                         "body": body,
                     }
+                    if uid:
+                        payload["uid"] = uid
+                    if uidvalidity:
+                        payload["uidvalidity"] = uidvalidity
+                    if account:
+                        payload["account"] = account
                     messages.append(payload)
 
                     logging.debug(
@@ -185,5 +500,324 @@ class ImapPollTrigger(BaseTrigger):
                 logging.info("IMAP polling returned %d messages", len(messages))
                 return messages
         except Exception as exc:  # pylint: disable=broad-except
+            if self.raise_errors:
+                raise
             logging.exception("IMAP polling failed: %s", exc)
             return []
+
+    def commit(self, payloads: List[Dict[str, Any]]) -> None:
+        """Apply ``on_success`` and store the staged flag checkpoints.
+
+        Payloads are grouped by mailbox so each one is updated with a single
+        connection and one command per change, whatever the number of
+        messages. Messages from a mailbox whose UIDVALIDITY changed since
+        they were fetched are skipped.
+        """
+
+        configs = self._configs()
+        committed = {str(p["id"]) for p in payloads if p.get("id")}
+        groups: Dict[Optional[str], List[Dict[str, Any]]] = {}
+        for payload in payloads:
+            if payload.get("uid"):
+                groups.setdefault(payload.get("account"), []).append(payload)
+        errors = []
+        try:
+            for account, items in groups.items():
+                config = configs.get(account)
+                if not config or not config.get("on_success"):
+                    continue
+                try:
+                    self._commit_account(config, items)
+                except Exception as exc:  # pylint: disable=broad-except
+                    logging.error(
+                        "IMAP update failed for %s: %s", account or config.get("host"), exc
+                    )
+                    errors.append(exc)
+            if errors:
+                committed = set()
+                raise errors[0]
+        finally:
+            with self._state_lock:
+                staged = list(self._flag_staged)
+            for key in staged:
+                self._finish_flag_checkpoint(key, committed)
+
+    def _commit_account(self, config: Dict[str, Any], payloads: List[Dict[str, Any]]) -> None:
+        """Apply ``on_success`` to ``payloads`` of the mailbox ``config``."""
+
+        actions = config["on_success"]
+        host = config.get("host")
+        mailbox = config.get("mailbox", "INBOX")
+        port = int(config.get("port", 993))
+        if config.get("timeout") is not None:
+            client_ctx = imaplib.IMAP4_SSL(host, port, timeout=float(config["timeout"]))
+        else:
+            client_ctx = imaplib.IMAP4_SSL(host, port)
+        with client_ctx as client:
+            client.login(config.get("username"), config.get("password"))
+            client.select(mailbox)
+            uidvalidity = _uidvalidity(client)
+            uids = [
+                str(p["uid"])
+                for p in payloads
+                if not uidvalidity or str(p.get("uidvalidity") or uidvalidity) == uidvalidity
+            ]
+            if len(uids) < len(payloads):
+                logging.warning(
+                    "UIDVALIDITY of %s changed, skipping %d messages",
+                    mailbox,
+                    len(payloads) - len(uids),
+                )
+            if not uids:
+                return
+            uid_set = _uid_set(uids)
+            capabilities = {str(c).upper() for c in getattr(client, "capabilities", ())}
+
+            def run(command: str, *args: str) -> None:
+                status, data = client.uid(command, uid_set, *args)
+                if status != "OK":
+                    raise imaplib.IMAP4.error(f"UID {command} failed: {data}")
+
+            if actions.get("add_flags"):
+                run("STORE", "+FLAGS.SILENT", _flag_list(actions["add_flags"]))
+            if actions.get("remove_flags"):
+                run("STORE", "-FLAGS.SILENT", _flag_list(actions["remove_flags"]))
+            target = actions.get("move_to")
+            if target:
+                if "MOVE" in capabilities:
+                    run("MOVE", _quote(target))
+                elif "UIDPLUS" in capabilities:
+                    run("COPY", _quote(target))
+                    run("STORE", "+FLAGS.SILENT", "(\\Deleted)")
+                    run("EXPUNGE")
+                else:
+                    # a plain EXPUNGE would also remove every other message
+                    # flagged \Deleted in the mailbox
+                    logging.error(
+                        "IMAP server %s supports neither MOVE nor UIDPLUS, "
+                        "not moving %d messages to %s",
+                        host,
+                        len(uids),
+                        target,
+                    )
+            logging.info("Updated %d IMAP messages in %s", len(uids), mailbox)
+
+    def _load_flag_state(self) -> Dict[str, Any]:
+        """Return the persisted mod-sequence state, loading it on first use."""
+        if self._flag_state is None:
+            self._flag_state = {}
+            state_file = self.config.get("state_file")
+            if state_file and os.path.exists(state_file):
+                try:
+                    with open(state_file, "r", encoding="utf-8") as fh:
+                        self._flag_state = json.load(fh)
+                except Exception as exc:  # pylint: disable=broad-except
+                    logging.warning("Unable to read IMAP state %s: %s", state_file, exc)
+        return self._flag_state
+
+    def _save_flag_state(self, key: str, value: Dict[str, Any]) -> None:
+        with self._state_lock:
+            state = self._load_flag_state()
+            state[key] = value
+            state_file = self.config.get("state_file")
+            if not state_file:
+                return
+            tmp_path = f"{state_file}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as fh:
+                    json.dump(state, fh)
+                os.replace(tmp_path, state_file)
+            except OSError as exc:
+                logging.warning("Unable to write IMAP state %s: %s", state_file, exc)
+
+    def _finish_flag_checkpoint(self, key: str, committed: Set[str]) -> None:
+        """Store the flag checkpoint staged by the last poll of ``key``.
+
+        The new HIGHESTMODSEQ is kept only when every event was
+        ``committed``; otherwise the next poll starts from the old one and
+        reports the failed events again. Messages whose flag event was
+        processed are remembered so they are not reported twice.
+        """
+        with self._state_lock:
+            staged = self._flag_staged.pop(key, None)
+        if staged is None:
+            return
+        events = staged["events"]
+        done = [event_id for event_id in events if event_id in committed]
+        flagged = set(staged["flagged"])
+        flagged.update(events[event_id] for event_id in done if events[event_id] is not None)
+        modseq = staged["highestmodseq"] if len(done) == len(events) else staged["previous"]
+        self._save_flag_state(
+            key,
+            {
+                "uidvalidity": staged["uidvalidity"],
+                "highestmodseq": modseq,
+                "flagged": sorted(flagged),
+            },
+        )
+
+    def _poll_flag_changes(
+        self,
+        client: imaplib.IMAP4,
+        config: Dict[str, Any],
+        *,
+        account: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Return messages that gained a watched flag since the last poll.
+
+        Uses CONDSTORE (RFC 7162): the mailbox HIGHESTMODSEQ is persisted and
+        only messages changed since then are fetched with ``CHANGEDSINCE``,
+        so a poll costs the size of the changes rather than of the mailbox.
+        When the server supports QRESYNC it is enabled so expunged messages
+        are reported through ``VANISHED``. The first poll (or a UIDVALIDITY
+        change) only records the current state and returns nothing.
+        Messages are fetched with ``BODY.PEEK[]`` so the poll itself does not
+        change any flag. The new HIGHESTMODSEQ is stored once the returned
+        events were processed (see :meth:`commit`).
+        """
+
+        host = config.get("host", "")
+        mailbox = config.get("mailbox", "INBOX")
+        watch_flags = config.get("watch_flags")
+        if isinstance(watch_flags, str):
+            watch_flags = [f.strip() for f in watch_flags.split(",") if f.strip()]
+        watched = {str(f).lower() for f in watch_flags}
+        include_vanished = str(config.get("include_vanished", False)).lower() in {
+            "1",
+            "true",
+            "yes",
+        }
+        try:
+            max_results = int(config.get("max_results", 100))
+        except Exception:
+            max_results = 100
+
+        capabilities = {str(c).upper() for c in getattr(client, "capabilities", ())}
+        if not capabilities & {"CONDSTORE", "QRESYNC"}:
+            logging.error("IMAP server %s does not support CONDSTORE", host)
+            return []
+        qresync = "QRESYNC" in capabilities
+        if qresync:
+            client.enable("QRESYNC")
+        client.select(mailbox)
+        uidvalidity = _uidvalidity(client)
+        modseq = _response_value(client, "HIGHESTMODSEQ")
+        if modseq is None:
+            logging.error("IMAP mailbox %s does not keep mod-sequences", mailbox)
+            return []
+
+        key = account_id(config)
+        # the previous poll's events have been processed by now
+        self._finish_flag_checkpoint(key, set())
+        with self._state_lock:
+            state = dict(self._load_flag_state().get(key) or {})
+        if state.get("uidvalidity") != uidvalidity or not state.get("highestmodseq"):
+            flagged = set()
+            for flag in watch_flags:
+                status, data = client.uid("SEARCH", _flag_criterion(str(flag)))
+                if status == "OK" and data and data[0]:
+                    flagged.update(int(u) for u in data[0].split())
+            self._save_flag_state(
+                key,
+                {
+                    "uidvalidity": uidvalidity,
+                    "highestmodseq": modseq,
+                    "flagged": sorted(flagged),
+                },
+            )
+            logging.info("Recorded IMAP HIGHESTMODSEQ %s for %s", modseq, key)
+            return []
+        if str(state["highestmodseq"]) == modseq:
+            logging.info("IMAP mailbox %s unchanged since modseq %s", key, modseq)
+            return []
+
+        known = set(state.get("flagged", []))
+        modifiers = f"(CHANGEDSINCE {state['highestmodseq']}{' VANISHED' if qresync else ''})"
+        status, data = client.uid("FETCH", "1:*", "(UID FLAGS)", modifiers)
+        if status != "OK":
+            logging.error("IMAP CHANGEDSINCE fetch failed: %s", status)
+            return []
+
+        changed = []
+        for item in data or []:
+            line = item[0] if isinstance(item, tuple) else item
+            if not isinstance(line, bytes):
+                continue
+            seq_match = _SEQ_RE.match(line)
+            uid_match = _UID_RE.search(line)
+            flags_match = _FLAGS_RE.search(line)
+            if not (seq_match and uid_match):
+                continue
+            uid = int(uid_match.group(1))
+            flags = flags_match.group(1).decode().split() if flags_match else []
+            modseq_match = _MODSEQ_RE.search(line)
+            changed_at = modseq_match.group(1).decode() if modseq_match else modseq
+            if not any(f.lower() in watched for f in flags):
+                known.discard(uid)
+            elif uid not in known:
+                changed.append((seq_match.group(1).decode(), uid, flags, changed_at))
+        logging.info("IMAP CHANGEDSINCE %s returned %d changes", state["highestmodseq"], len(data or []))
+
+        messages: List[Dict[str, Any]] = []
+        # payload id -> UID of the flag event, ``None`` for VANISHED
+        events: Dict[str, Optional[int]] = {}
+        # large expunges are reported in several VANISHED responses
+        vanished = _response_values(client, "VANISHED") if qresync else []
+        if vanished:
+            uid_set = ",".join(v.split()[-1] for v in vanished)
+            known = {uid for uid in known if not _uid_set_contains(uid_set, uid)}
+            if include_vanished:
+                payload = {
+                    "id": f"vanished-{uidvalidity}-{modseq}",
+                    "event": "vanished",
+                    "uids": uid_set,
+                    "uidvalidity": uidvalidity,
+                }
+                if account:
+                    payload["account"] = account
+                messages.append(payload)
+                events[payload["id"]] = None
+
+        # Changes left unreported are picked up again from the old modseq.
+        next_modseq = modseq if len(changed) <= max_results else state["highestmodseq"]
+        cache = get_cache()
+        for seq, uid, flags, changed_at in changed[:max_results]:
+            status, msg_data = client.uid("FETCH", str(uid), "(BODY.PEEK[])")
+            if status != "OK" or not msg_data or not isinstance(msg_data[0], tuple):
+                next_modseq = state["highestmodseq"]
+                continue
+            raw = msg_data[0][1]
+            if uidvalidity:
+                cache.put(imap_key(host, mailbox, uidvalidity, uid), raw)
+            msg, body, _has_attachments = _parse_message(raw, seq)
+            # a message flagged again later is a new event
+            payload = {
+                "id": f"flags-{uidvalidity}-{uid}-{changed_at}",
+                "subject": msg.get("Subject", ""),
+                "from": msg.get("From", ""),
+                "body": body,
+                "uid": str(uid),
+                "modseq": changed_at,
+                "flags": flags,
+                "event": "flags",
+            }
+            if uidvalidity:
+                payload["uidvalidity"] = uidvalidity
+            if account:
+                payload["account"] = account
+            messages.append(payload)
+            events[payload["id"]] = uid
+
+        checkpoint = {
+            "uidvalidity": uidvalidity,
+            "highestmodseq": next_modseq,
+            "flagged": sorted(known),
+            "previous": state["highestmodseq"],
+            "events": events,
+        }
+        with self._state_lock:
+            self._flag_staged[key] = checkpoint
+        if not events:
+            self._finish_flag_checkpoint(key, set())
+        logging.info("IMAP flag polling returned %d messages", len(messages))
+        return messages
@@ -2,30 +2,238 @@
 
 from __future__ import annotations
 
+import atexit
+import hashlib
 import json
 import logging
 import os
-from typing import Any, Dict
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from urllib import parse, request
 
+from .. import google_auth, http_client, sheets_index, state
 from ..core import BaseAction
 
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 10.0
+# Directory of the spool files inside the private state directory.
+SPOOL_DIR_NAME = "sheets-spool"
+
+_buffers_lock = threading.Lock()
+_buffers: Dict[Tuple[str, Optional[str]], "_RowBuffer"] = {}
+
+
+class _RowBuffer:
+    """Rows waiting to be appended to one ``(sheet_id, range)`` pair.
+
+    Rows are sent with a single ``values:append`` call once ``batch_size``
+    rows are waiting, ``flush_interval`` seconds after the first one arrived,
+    or when :meth:`flush` is called. Rows that cannot be sent are written to
+    a spool file and retried by the next flush.
+    """
+
+    def __init__(self, index: sheets_index.RowIndex, spool_dir: Optional[str]):
+        self.index = index
+        self.lock = threading.RLock()
+        self.rows: List[List[Any]] = []
+        self.keys: set = set()
+        self.token_source: Optional[Callable[[], Optional[str]]] = None
+        self.batch_size = DEFAULT_BATCH_SIZE
+        self.flush_interval = DEFAULT_FLUSH_INTERVAL
+        self._timer: Optional[threading.Timer] = None
+        name = hashlib.sha1(f"{index.sheet_id}\0{index.range}".encode()).hexdigest()[:16]
+        self.spool_path = os.path.join(spool_dir or state.path(SPOOL_DIR_NAME), f"{name}.jsonl")
+
+    def add(self, values: List[Any], token_source: Callable[[], Optional[str]]) -> None:
+        with self.lock:
+            self.token_source = token_source
+            key = self.index.key(values)
+            with self.index.lock:
+                duplicate = key in self.index
+            if duplicate or key in self.keys:
+                logging.info("Row already exists, skipping append")
+                return
+            self.rows.append(values)
+            self.keys.add(key)
+            if len(self.rows) >= self.batch_size:
+                self.flush()
+            elif self._timer is None and self.flush_interval > 0:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _read_spool(self) -> List[List[Any]]:
+        try:
+            with open(self.spool_path, "r", encoding="utf-8") as fh:
+                return [json.loads(line) for line in fh if line.strip()]
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as exc:
+            logging.warning("Unable to read Sheets spool %s: %s", self.spool_path, exc)
+            return []
+
+    def _write_spool(self, rows: List[List[Any]]) -> None:
+        if not rows:
+            if os.path.exists(self.spool_path):
+                os.remove(self.spool_path)
+            return
+        state.private_dir(os.path.dirname(self.spool_path))
+        tmp_path = f"{self.spool_path}.tmp"
+        with state.open_private(tmp_path, "w", encoding="utf-8") as fh:
+            fh.write("".join(json.dumps(row) + "\n" for row in rows))
+        os.replace(tmp_path, self.spool_path)
+
+    def flush(self) -> None:
+        """Append the waiting and spooled rows; spool them again on failure."""
+        with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            rows, self.rows = self._read_spool() + self.rows, []
+            self.keys = set()
+            if not rows or self.token_source is None:
+                return
+            index = self.index
+            try:
+                token = self.token_source()
+                if not token:
+                    raise ValueError("no token configured")
+            except Exception as exc:  # pylint: disable=broad-except
+                logging.error("Unable to obtain a token for sheet %s: %s", index.sheet_id, exc)
+                self._write_spool(rows)
+                return
+            with index.lock:
+                try:
+                    # also catches rows written by an append that failed late
+                    index.refresh(token)
+                except Exception as exc:  # pylint: disable=broad-except
+                    logging.warning("Unable to index sheet %s: %s", index.sheet_id, exc)
+                batch, keys = [], []
+                for row in rows:
+                    key = index.key(row)
+                    if key not in index and key not in keys:
+                        batch.append(row)
+                        keys.append(key)
+                if batch:
+                    try:
+                        _append(index.sheet_id, index.range, batch, token)
+                    except Exception:  # pylint: disable=broad-except
+                        logging.error(
+                            "Spooling %d rows for sheet %s range %s to %s",
+                            len(batch),
+                            index.sheet_id,
+                            index.range,
+                            self.spool_path,
+                        )
+                        self._write_spool(batch)
+                        return
+                    index.add(keys)
+            self._write_spool([])
+
+
+def _append(sheet_id: str, range_: str, rows: List[List[Any]], token: str) -> None:
+    """Append ``rows`` to ``range_`` with one ``values:append`` call."""
+    logging.info("Appending %d rows to sheet %s range %s", len(rows), sheet_id, range_)
+    url = (
+        f"https://sheets.googleapis.com/v4/spreadsheets/{sheet_id}/values/"
+        f"{parse.quote(range_)}:append?valueInputOption=USER_ENTERED"
+    )
+    body = json.dumps({"values": rows}).encode()
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+    }
+    req = request.Request(url, data=body, headers=headers)
+
+    try:
+        with http_client.urlopen(req) as resp:
+            resp.read()
+        logging.info("Google Sheets append successful")
+    except Exception as exc:  # pylint: disable=broad-except
+        logging.exception("Google Sheets append failed: %s", exc)
+        raise RuntimeError("Google Sheets append failed") from exc
+
+
+def flush_all() -> None:
+    """Flush the buffered rows of every sheet."""
+    with _buffers_lock:
+        buffers = list(_buffers.values())
+    for buf in buffers:
+        buf.flush()
+
+
+atexit.register(flush_all)
+
 
 class SheetsAppendAction(BaseAction):
     """Append data to a Google Sheet."""
 
+    def __init__(self, params: Dict[str, Any]):
+        super().__init__(params)
+        self._buffer: Optional[_RowBuffer] = None
+
+    def _get_buffer(self, sheet_id: str, range_: str) -> _RowBuffer:
+        if self._buffer is None:
+            index = sheets_index.get_index(
+                sheet_id,
+                range_,
+                self.params.get("key_columns"),
+                directory=self.params.get("index_dir"),
+                ttl=float(self.params.get("index_ttl", sheets_index.DEFAULT_TTL)),
+            )
+            spool_dir = self.params.get("spool_dir")
+            with _buffers_lock:
+                key = (index.meta_path, spool_dir)
+                buf = _buffers.get(key)
+                if buf is None:
+                    buf = _buffers[key] = _RowBuffer(index, spool_dir)
+            if buf.token_source is None:
+                # lets a flush retry spooled rows before any new row arrives
+                buf.token_source = lambda: google_auth.bearer_token(self.params)
+            buf.batch_size = max(1, int(self.params.get("batch_size", DEFAULT_BATCH_SIZE)))
+            buf.flush_interval = float(
+                self.params.get("flush_interval", DEFAULT_FLUSH_INTERVAL)
+            )
+            self._buffer = buf
+        return self._buffer
+
     def execute(self, data: Dict[str, Any]) -> None:
         """Append ``data`` to the configured Google Sheet.
 
-        Required params are ``sheet_id`` and ``range``. ``token`` can be
-        supplied in params or via the ``GDRIVE_TOKEN`` environment variable.
+        Required params are ``sheet_id`` and ``range``. Credentials come
+        from ``token_file`` (refreshed automatically, see
+        :mod:`pyzap.google_auth`) or a static ``token``; the
+        ``GDRIVE_TOKEN_FILE`` and ``GDRIVE_TOKEN`` environment variables are
+        used when neither is set.
 
         The payload should contain a ``values`` list representing a row.
+
+        Rows already in the sheet are skipped. They are looked up in a local
+        index (see :mod:`pyzap.sheets_index`) rather than by downloading the
+        range on every call:
+
+        - ``key_columns`` (optional): columns identifying a row, as letters
+          or 0-based positions in ``values``. Defaults to every column.
+        - ``index_dir`` (optional): directory holding the index files,
+          defaults to ``sheets-index`` in the state directory.
+        - ``index_ttl`` (optional): seconds the index is trusted when the
+          sheet revision cannot be read from Drive, defaults to ``3600``.
+
+        Rows are buffered and appended together:
+
+        - ``batch_size`` (optional): rows sent in one request, defaults to
+          ``100``. Use ``1`` to append every row immediately.
+        - ``flush_interval`` (optional): seconds a row may wait, defaults to
+          ``10``. Waiting rows are also sent at the end of each workflow run
+          and when pyzap stops.
+        - ``spool_dir`` (optional): directory keeping rows whose append
+          failed until the next flush retries them, defaults to
+          ``sheets-spool`` in the state directory.
         """
 
         sheet_id = self.params.get("sheet_id")
         range_ = self.params.get("range")
-        token = self.params.get("token") or os.environ.get("GDRIVE_TOKEN")
+        token = google_auth.bearer_token(self.params)
         values = data.get("values")
         if values is None:
             fields = self.params.get("fields")
@@ -47,39 +255,20 @@ class SheetsAppendAction(BaseAction):
                 "Google Sheets append configuration missing: %s" % ", ".join(missing)
             )
 
-        logging.info("Appending row to sheet %s range %s", sheet_id, range_)
-
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-        }
-
-        # Check for existing row
-        try:
-            get_url = (
-                f"https://sheets.googleapis.com/v4/spreadsheets/{sheet_id}/values/"
-                f"{parse.quote(range_)}"
-            )
-            get_req = request.Request(get_url, headers={"Authorization": f"Bearer {token}"})
-            with request.urlopen(get_req) as resp:
-                existing = json.loads(resp.read().decode())
-            if values in existing.get("values", []):
-                logging.info("Row already exists, skipping append")
-                return
-        except Exception:
-            pass
-
-        url = (
-            f"https://sheets.googleapis.com/v4/spreadsheets/{sheet_id}/values/"
-            f"{parse.quote(range_)}:append?valueInputOption=USER_ENTERED"
+        logging.info("Queueing row for sheet %s range %s", sheet_id, range_)
+        self._get_buffer(sheet_id, range_).add(
+            list(values), lambda: google_auth.bearer_token(self.params)
         )
-        body = json.dumps({"values": [values]}).encode()
 
-        req = request.Request(url, data=body, headers=headers)
+    def flush(self) -> None:
+        """Append the rows buffered or spooled for this action's sheet.
 
-        try:
-            request.urlopen(req)
-            logging.info("Google Sheets append successful")
-        except Exception as exc:  # pylint: disable=broad-except
-            logging.exception("Google Sheets append failed: %s", exc)
-            raise RuntimeError("Google Sheets append failed") from exc
+        Rows spooled by an earlier process are sent by the first flush, even
+        when no new row arrives after a restart.
+        """
+        sheet_id = self.params.get("sheet_id")
+        range_ = self.params.get("range")
+        if self._buffer is None and sheet_id and range_:
+            self._get_buffer(sheet_id, range_)
+        if self._buffer is not None:
+            self._buffer.flush()
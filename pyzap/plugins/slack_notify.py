@@ -2,11 +2,10 @@
 
 from __future__ import annotations
 
-import json
 import logging
 from typing import Any, Dict
-from urllib import request
 
+from .. import slack_dispatch
 from ..core import BaseAction
 
 
@@ -14,7 +13,26 @@ class SlackNotifyAction(BaseAction):
     """Send a notification to Slack via webhook."""
 
     def execute(self, data: Dict[str, Any]) -> None:
-        """Send a message to the configured Slack webhook."""
+        """Send a message to the configured Slack webhook.
+
+        Configuration options:
+        - ``webhook_url``: Slack incoming webhook URL.
+        - ``rate_limit`` (optional): messages per second sent to the webhook,
+          shared by every action using it. Defaults to ``1``; ``0`` disables
+          the limit.
+        - ``queued`` (optional): deliver from a background queue so the
+          workflow does not wait for Slack. Failed deliveries are retried
+          and logged instead of failing the payload.
+        - ``digest_window`` (optional): seconds during which queued
+          notifications are merged into one message. Implies ``queued``.
+        - ``digest_max`` (optional): most notifications merged into one
+          digest, defaults to ``50``.
+        - ``max_retries`` (optional): retries of a queued message, defaults
+          to ``5``.
+        - ``retry_backoff`` (optional): seconds before the first retry,
+          doubled on each attempt, defaults to ``1``. A 429 answer with
+          ``Retry-After`` waits that long instead.
+        """
 
         webhook = self.params.get("webhook_url")
         text = data.get("text") or data.get("message")
@@ -30,13 +48,28 @@ class SlackNotifyAction(BaseAction):
                 "Slack webhook configuration missing: %s" % ", ".join(missing)
             )
 
-        logging.info("Sending Slack notification")
-
-        body = json.dumps({"text": text}).encode()
-        req = request.Request(webhook, data=body, headers={"Content-Type": "application/json"})
+        dispatcher = slack_dispatch.get_dispatcher(webhook)
+        dispatcher.limiter.rate = float(self.params.get("rate_limit", slack_dispatch.DEFAULT_RATE))
+        digest_window = float(self.params.get("digest_window", 0))
+        queued = str(self.params.get("queued", False)).lower() in {"1", "true", "yes"}
+        if queued or digest_window > 0:
+            dispatcher.digest_window = digest_window
+            dispatcher.digest_max = max(
+                1, int(self.params.get("digest_max", slack_dispatch.DEFAULT_DIGEST_MAX))
+            )
+            dispatcher.max_retries = int(
+                self.params.get("max_retries", slack_dispatch.DEFAULT_RETRIES)
+            )
+            dispatcher.backoff = float(
+                self.params.get("retry_backoff", slack_dispatch.DEFAULT_BACKOFF)
+            )
+            logging.info("Queueing Slack notification")
+            dispatcher.submit(str(text))
+            return
 
+        logging.info("Sending Slack notification")
         try:
-            request.urlopen(req)
+            dispatcher.send(text)
             logging.info("Slack notification sent")
         except Exception as exc:  # pylint: disable=broad-except
             logging.exception("Slack notification failed: %s", exc)
@@ -0,0 +1,220 @@
+"""Webhook push trigger."""
+
+from __future__ import annotations
+
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import ipaddress
+import json
+import logging
+import queue
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from ..core import BaseTrigger
+
+DEFAULT_PORT = 8080
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_MAX_BODY = 1024 * 1024
+
+
+def _is_loopback(host: str) -> bool:
+    """Return ``True`` if ``host`` only accepts connections from this machine."""
+    if host.lower() == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+_servers_lock = threading.Lock()
+_servers: Dict[Tuple[str, int], "_WebhookServer"] = {}
+
+
+class _WebhookServer(ThreadingHTTPServer):
+    """HTTP listener dispatching requests to the trigger registered for a path."""
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int]):
+        super().__init__(address, _WebhookHandler)
+        self.routes: Dict[str, "WebhookTrigger"] = {}
+        self.routes_lock = threading.Lock()
+        self.thread = threading.Thread(
+            target=self.serve_forever, name=f"pyzap-webhook-{address[1]}", daemon=True
+        )
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    server: _WebhookServer
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        logging.debug("Webhook %s - %s", self.address_string(), format % args)
+
+    def _reply(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self) -> None:  # noqa: N802 - required name
+        path = self.path.split("?", 1)[0]
+        with self.server.routes_lock:
+            trigger = self.server.routes.get(path)
+        if trigger is None:
+            self._reply(404, {"error": "unknown path"})
+            return
+        if not trigger.authorized(self.headers):
+            self._reply(401, {"error": "unauthorized"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0 or length > trigger.max_body:
+            self._reply(413, {"error": "payload too large"})
+            return
+        raw = self.rfile.read(length) if length else b""
+        try:
+            payload = json.loads(raw.decode("utf-8")) if raw else {}
+        except ValueError:
+            self._reply(400, {"error": "invalid JSON"})
+            return
+        if not isinstance(payload, dict):
+            payload = {"data": payload}
+        if not trigger.enqueue(payload):
+            self._reply(429, {"error": "queue full"}, {"Retry-After": "1"})
+            return
+        self._reply(202, {"status": "queued"})
+
+
+class WebhookTrigger(BaseTrigger):
+    """Receive events pushed over HTTP instead of polling for them."""
+
+    push = True
+
+    def __init__(self, config: Dict[str, Any]):
+        super().__init__(config)
+        self.host = str(config.get("host", "127.0.0.1"))
+        self.port = int(config.get("port", DEFAULT_PORT))
+        path = str(config.get("path", "/"))
+        self.path = path if path.startswith("/") else f"/{path}"
+        self.secret = config.get("secret")
+        if not self.secret and not _is_loopback(self.host):
+            # anybody on the network could inject events otherwise
+            raise ValueError(f"Webhook trigger listening on {self.host} requires a secret")
+        self.max_body = int(config.get("max_body", DEFAULT_MAX_BODY))
+        self.wait = float(config.get("wait", 5))
+        self.max_batch = int(config.get("max_batch", 100))
+        self.queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(
+            maxsize=int(config.get("queue_size", DEFAULT_QUEUE_SIZE))
+        )
+        self._server: Optional[_WebhookServer] = None
+        self._closed = False
+
+    @property
+    def server_address(self) -> Tuple[str, int]:
+        """Return the address the listener is bound to."""
+        self.start()
+        assert self._server is not None
+        return self._server.server_address[:2]
+
+    def authorized(self, headers: Any) -> bool:
+        """Check the shared secret sent as a bearer token or ``X-Pyzap-Secret``."""
+        if not self.secret:
+            return True
+        supplied = headers.get("X-Pyzap-Secret", "")
+        auth = headers.get("Authorization", "")
+        if not supplied and auth.lower().startswith("bearer "):
+            supplied = auth[7:].strip()
+        return hmac.compare_digest(str(supplied).encode(), str(self.secret).encode())
+
+    def enqueue(self, payload: Dict[str, Any]) -> bool:
+        """Queue ``payload`` for the workflow, returning ``False`` when full."""
+        try:
+            self.queue.put_nowait(payload)
+        except queue.Full:
+            logging.warning("Webhook queue for %s is full, rejecting event", self.path)
+            return False
+        return True
+
+    def start(self) -> None:
+        """Start listening, sharing one server per host and port."""
+        if self._server is not None or self._closed:
+            return
+        key = (self.host, self.port)
+        with _servers_lock:
+            server = _servers.get(key) if self.port else None
+            if server is None:
+                server = _WebhookServer(key)
+                server.thread.start()
+                bound = (self.host, server.server_address[1])
+                _servers[bound] = server
+                logging.info("Webhook listener started on %s:%s", *bound)
+            with server.routes_lock:
+                if self.path in server.routes:
+                    raise ValueError(f"Webhook path {self.path} already in use")
+                server.routes[self.path] = self
+        self._server = server
+
+    def close(self) -> None:
+        """Stop receiving events and shut the listener down when unused."""
+        self._closed = True
+        server, self._server = self._server, None
+        if server is None:
+            return
+        with _servers_lock:
+            with server.routes_lock:
+                server.routes.pop(self.path, None)
+                unused = not server.routes
+            if unused:
+                for key in [k for k, v in _servers.items() if v is server]:
+                    del _servers[key]
+        if unused:
+            server.shutdown()
+            server.server_close()
+
+    def poll(self) -> List[Dict[str, Any]]:
+        """Return the events received since the last call.
+
+        Configuration options:
+        - ``host`` (optional): interface to listen on, defaults to ``127.0.0.1``.
+          Any other than a loopback address requires ``secret``.
+        - ``port`` (optional): TCP port, defaults to ``8080``. Several webhook
+          workflows may share a port with different paths.
+        - ``path`` (optional): URL path accepting ``POST`` requests, defaults
+          to ``/``.
+        - ``secret``: shared secret expected in the ``X-Pyzap-Secret`` header
+          or as an ``Authorization: Bearer`` token. Optional only when
+          listening on a loopback address.
+        - ``queue_size`` (optional): events buffered before the listener
+          answers ``429``, defaults to ``1000``.
+        - ``max_body`` (optional): largest accepted request body in bytes,
+          defaults to 1 MiB.
+        - ``wait`` (optional): seconds to wait for the first event, defaults
+          to ``5``.
+        - ``max_batch`` (optional): events returned per call, defaults to
+          ``100``.
+
+        The JSON body of each request becomes the payload; non-object bodies
+        are wrapped as ``{"data": ...}``. The engine runs webhook workflows on
+        their own thread, so events reach the actions as soon as they arrive.
+        """
+        self.start()
+        if self._closed:
+            return []
+        try:
+            events = [self.queue.get(timeout=self.wait)]
+        except queue.Empty:
+            return []
+        while len(events) < self.max_batch:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return events
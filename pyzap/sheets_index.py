@@ -0,0 +1,279 @@
+"""Local index of the rows already present in Google Sheets ranges.
+
+``sheets_append`` skips rows the sheet already contains. Downloading the
+whole range before every append gets slower as the sheet grows, so the
+action keeps a fingerprint of each row on disk instead. Only the key
+columns are downloaded to seed the index, with a single
+``values:batchGet`` call. After that, each append adds the new row's
+fingerprint to the index.
+
+Drive bumps a spreadsheet's ``version`` on every edit. The index remembers
+the version it expects, counting one for each of its own appends, and is
+reseeded when Drive reports another one because someone else has changed
+the sheet. If the token cannot read Drive metadata, the index is instead
+reseeded once it is older than ``ttl`` seconds.
+"""
+
+from __future__ import annotations
+
+from hashlib import blake2b
+from itertools import zip_longest
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+from urllib import parse, request
+
+from . import http_client, state
+
+SHEETS_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+FILES_URL = "https://www.googleapis.com/drive/v3/files"
+# Directory of the index files inside the private state directory.
+INDEX_DIR_NAME = "sheets-index"
+# Seconds an index is trusted when the sheet revision cannot be read.
+DEFAULT_TTL = 3600.0
+
+_CELL_RE = re.compile(r"^\$?([A-Za-z]+)")
+
+_lock = threading.Lock()
+_indexes: Dict[Tuple[Any, ...], "RowIndex"] = {}
+
+
+def _get(url: str, token: str) -> Dict[str, Any]:
+    req = request.Request(url, headers={"Authorization": f"Bearer {token}"})
+    with http_client.urlopen(req) as resp:
+        return json.loads(resp.read().decode() or "{}")
+
+
+def column_number(letters: str) -> int:
+    """Return the 1-based number of column ``letters`` (``A`` is 1)."""
+    number = 0
+    for char in letters.upper():
+        number = number * 26 + ord(char) - ord("A") + 1
+    return number
+
+
+def column_letters(number: int) -> str:
+    """Return the letters of the 1-based column ``number``."""
+    letters = ""
+    while number > 0:
+        number, rest = divmod(number - 1, 26)
+        letters = chr(ord("A") + rest) + letters
+    return letters
+
+
+def split_range(range_: str) -> Tuple[str, int]:
+    """Return the sheet name of ``range_`` and the number of its first column."""
+    sheet, _, cells = range_.rpartition("!")
+    match = _CELL_RE.match(cells)
+    return sheet, column_number(match.group(1)) if match else 1
+
+
+def fingerprint(values: Iterable[Any]) -> str:
+    """Return a short digest identifying a row by its cell values.
+
+    Cells are compared as the text Sheets shows, and trailing empty cells are
+    ignored because the API omits them.
+    """
+    cells = ["" if v is None else str(v).strip() for v in values]
+    while cells and not cells[-1]:
+        cells.pop()
+    return blake2b(json.dumps(cells).encode(), digest_size=10).hexdigest()
+
+
+class RowIndex:
+    """Fingerprints of the rows of one ``(sheet_id, range)`` pair.
+
+    ``key_columns`` lists the columns identifying a row, as letters (``"A"``)
+    or 0-based positions within the appended row. By default every column is
+    part of the key. Callers hold :attr:`lock` around :meth:`refresh`, the
+    membership test and :meth:`add`, so concurrent appends to the same range
+    see each other's rows.
+    """
+
+    def __init__(
+        self,
+        sheet_id: str,
+        range_: str,
+        key_columns: Optional[Sequence[Union[str, int]]] = None,
+        *,
+        directory: Optional[str] = None,
+        ttl: float = DEFAULT_TTL,
+    ):
+        self.sheet_id = sheet_id
+        self.range = range_
+        self.ttl = float(ttl)
+        self.lock = threading.RLock()
+        self.sheet, first = split_range(range_)
+        self.positions: Optional[List[int]] = None
+        if key_columns:
+            self.positions = [
+                k if isinstance(k, int) else column_number(str(k)) - first for k in key_columns
+            ]
+            if any(p < 0 for p in self.positions):
+                raise ValueError(f"Key columns {key_columns} lie before range {range_}")
+        self._first = first
+        name = blake2b(
+            json.dumps([sheet_id, range_, self.positions]).encode(), digest_size=12
+        ).hexdigest()
+        directory = directory or state.path(INDEX_DIR_NAME)
+        self.meta_path = os.path.join(directory, f"{name}.json")
+        self.rows_path = os.path.join(directory, f"{name}.rows")
+        self.version: Optional[str] = None
+        self.seeded = 0.0
+        self.rows: Set[str] = set()
+        self._load()
+
+    # persistence ----------------------------------------------------------
+
+    def _load(self) -> None:
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as fh:
+                meta = json.load(fh)
+            with open(self.rows_path, "r", encoding="utf-8") as fh:
+                rows = {line.strip() for line in fh if line.strip()}
+        except (OSError, ValueError):
+            return
+        self.version = meta.get("version")
+        self.seeded = float(meta.get("seeded", 0))
+        self.rows = rows
+
+    def _write(self, path: str, text: str) -> None:
+        state.private_dir(os.path.dirname(path))
+        tmp_path = f"{path}.tmp"
+        with state.open_private(tmp_path, "w", encoding="utf-8") as fh:
+            fh.write(text)
+        os.replace(tmp_path, path)
+
+    def _save_meta(self) -> None:
+        meta = {
+            "sheet_id": self.sheet_id,
+            "range": self.range,
+            "version": self.version,
+            "seeded": self.seeded,
+        }
+        try:
+            self._write(self.meta_path, json.dumps(meta))
+        except OSError as exc:
+            logging.warning("Unable to save sheet index %s: %s", self.meta_path, exc)
+
+    # remote ---------------------------------------------------------------
+
+    def revision(self, token: str) -> Optional[str]:
+        """Return the spreadsheet's Drive ``version``, or ``None`` if unavailable."""
+        url = f"{FILES_URL}/{parse.quote(self.sheet_id)}?fields=version"
+        try:
+            return _get(url, token).get("version")
+        except Exception as exc:  # pylint: disable=broad-except
+            logging.debug("Unable to read revision of sheet %s: %s", self.sheet_id, exc)
+            return None
+
+    def _a1(self, columns: str) -> str:
+        if not self.sheet:
+            return columns
+        return f"{self.sheet}!{columns}"
+
+    def _fetch_rows(self, token: str) -> List[List[Any]]:
+        """Download the key columns of every row in the sheet."""
+        base = f"{SHEETS_URL}/{parse.quote(self.sheet_id)}/values"
+        if self.positions is None:
+            # Whole rows are needed; the sheet's used area is one request.
+            url = f"{base}/{parse.quote(self.sheet or self.range)}"
+            offset = self._first - 1 if self.sheet else 0
+            return [row[offset:] for row in _get(url, token).get("values", [])]
+        ranges = []
+        for pos in self.positions:
+            letters = column_letters(self._first + pos)
+            ranges.append(("ranges", self._a1(f"{letters}:{letters}")))
+        query = parse.urlencode(ranges + [("majorDimension", "COLUMNS")])
+        columns = [
+            (vr.get("values") or [[]])[0]
+            for vr in _get(f"{base}:batchGet?{query}", token).get("valueRanges", [])
+        ]
+        return [list(row) for row in zip_longest(*columns, fillvalue="")]
+
+    # index ----------------------------------------------------------------
+
+    def key(self, values: Sequence[Any]) -> str:
+        """Return the fingerprint of ``values`` as appended to the range."""
+        if self.positions is not None:
+            values = [values[p] if p < len(values) else "" for p in self.positions]
+        return fingerprint(values)
+
+    def _row_key(self, row: Sequence[Any]) -> str:
+        # rows from ``_fetch_rows`` already hold only the key columns
+        return fingerprint(row) if self.positions is not None else self.key(row)
+
+    def refresh(self, token: str) -> None:
+        """Reseed the index if the sheet changed since it was last seen."""
+        version = self.revision(token)
+        if version is not None:
+            stale = version != self.version
+        else:
+            stale = time.time() - self.seeded > self.ttl
+        if not stale:
+            return
+        rows = self._fetch_rows(token)
+        self.rows = {self._row_key(row) for row in rows}
+        self.version = version
+        self.seeded = time.time()
+        logging.debug(
+            "Seeded index of sheet %s range %s with %d rows", self.sheet_id, self.range, len(rows)
+        )
+        try:
+            self._write(self.rows_path, "".join(f"{fp}\n" for fp in sorted(self.rows)))
+        except OSError as exc:
+            logging.warning("Unable to save sheet index %s: %s", self.rows_path, exc)
+        self._save_meta()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.rows
+
+    def add(self, keys: Iterable[str]) -> None:
+        """Record the rows of one append and the sheet revision it produced."""
+        new = [k for k in keys if k not in self.rows]
+        self.rows.update(new)
+        if new:
+            try:
+                state.private_dir(os.path.dirname(self.rows_path))
+                with state.open_private(self.rows_path, "a", encoding="utf-8") as fh:
+                    fh.write("".join(f"{k}\n" for k in new))
+            except OSError as exc:
+                logging.warning("Unable to save sheet index %s: %s", self.rows_path, exc)
+        if self.version is not None:
+            # our own append bumps the version by one; any other value seen by
+            # the next refresh means someone else edited the sheet as well
+            try:
+                self.version = str(int(self.version) + 1)
+            except ValueError:
+                self.version = None
+        self._save_meta()
+
+
+def get_index(
+    sheet_id: str,
+    range_: str,
+    key_columns: Optional[Sequence[Union[str, int]]] = None,
+    *,
+    directory: Optional[str] = None,
+    ttl: float = DEFAULT_TTL,
+) -> RowIndex:
+    """Return the shared index of ``range_`` in spreadsheet ``sheet_id``."""
+    directory = directory or state.path(INDEX_DIR_NAME)
+    key = (sheet_id, range_, tuple(key_columns or ()), directory)
+    with _lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = RowIndex(
+                sheet_id, range_, key_columns, directory=directory, ttl=ttl
+            )
+        return index
+
+
+def clear() -> None:
+    """Forget every index loaded in this process; files on disk are kept."""
+    with _lock:
+        _indexes.clear()
@@ -0,0 +1,196 @@
+"""Rate limited, queued delivery of Slack webhook messages.
+
+Slack accepts roughly one message per second on an incoming webhook. Every
+webhook gets a dispatcher here that spaces its messages out. Queued
+notifications are posted by a background thread, so a burst of payloads
+does not block the workflow. In digest mode, the notifications arriving
+within a time window are merged into a single message. Failed posts are
+retried with exponential backoff, or after the ``Retry-After`` delay Slack
+sends with a 429 answer, and queued messages are drained when the
+process exits.
+"""
+
+from __future__ import annotations
+
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
+from urllib import error, request
+
+from . import http_client
+
+DEFAULT_RATE = 1.0
+DEFAULT_DIGEST_MAX = 50
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 1.0
+DEFAULT_QUEUE_SIZE = 1000
+# Seconds spent delivering queued messages when the process exits.
+DRAIN_TIMEOUT = 30.0
+
+_lock = threading.Lock()
+_dispatchers: Dict[str, "Dispatcher"] = {}
+
+
+def post(webhook: str, text: str) -> None:
+    """Post ``text`` to ``webhook`` once."""
+    body = json.dumps({"text": text}).encode()
+    req = request.Request(webhook, data=body, headers={"Content-Type": "application/json"})
+    with http_client.urlopen(req) as resp:
+        resp.read()
+
+
+class RateLimiter:
+    """Space calls at least ``1 / rate`` seconds apart; ``0`` disables it."""
+
+    def __init__(self, rate: float = DEFAULT_RATE):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self) -> None:
+        interval = 1.0 / self.rate if self.rate > 0 else 0.0
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def digest(texts: List[str]) -> str:
+    """Merge several notifications into one message."""
+    if len(texts) == 1:
+        return texts[0]
+    return f"{len(texts)} notifications\n" + "\n".join(f"• {t}" for t in texts)
+
+
+class Dispatcher:
+    """Queue and rate limiter of one webhook."""
+
+    def __init__(self, webhook: str):
+        self.webhook = webhook
+        self.limiter = RateLimiter()
+        self.digest_window = 0.0
+        self.digest_max = DEFAULT_DIGEST_MAX
+        self.max_retries = DEFAULT_RETRIES
+        self.backoff = DEFAULT_BACKOFF
+        self.queue: "queue.Queue[str]" = queue.Queue(maxsize=DEFAULT_QUEUE_SIZE)
+        self._thread: Optional[threading.Thread] = None
+        self._draining = False
+
+    def send(self, text: str) -> None:
+        """Post ``text`` on the calling thread, respecting the rate limit."""
+        self.limiter.wait()
+        post(self.webhook, text)
+
+    def submit(self, text: str) -> None:
+        """Queue ``text`` for the background thread.
+
+        Blocks while the queue is full, which slows a burst down to the
+        rate Slack accepts.
+        """
+        with _lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="pyzap-slack", daemon=True
+                )
+                self._thread.start()
+        self.queue.put(text)
+
+    def _collect(self) -> List[str]:
+        texts = [self.queue.get()]
+        if self.digest_window <= 0:
+            return texts
+        deadline = time.monotonic() + self.digest_window
+        while len(texts) < self.digest_max:
+            remaining = deadline - time.monotonic()
+            waiting = remaining > 0 and not self._draining
+            try:
+                texts.append(self.queue.get(waiting, remaining if waiting else None))
+            except queue.Empty:
+                if not waiting:
+                    break
+        return texts
+
+    def _deliver(self, text: str) -> None:
+        attempt = 0
+        while True:
+            try:
+                self.send(text)
+                logging.info("Slack notification sent")
+                return
+            except Exception as exc:  # pylint: disable=broad-except
+                if attempt >= self.max_retries:
+                    logging.error(
+                        "Dropping Slack notification after %d attempts: %s", attempt + 1, exc
+                    )
+                    return
+                delay = _retry_after(exc)
+                if delay is None:
+                    delay = self.backoff * (2 ** attempt)
+                logging.warning("Slack notification failed (%s), retrying in %.1fs", exc, delay)
+                time.sleep(delay)
+                attempt += 1
+
+    def _run(self) -> None:
+        while True:
+            texts = self._collect()
+            try:
+                self._deliver(digest(texts))
+            finally:
+                for _ in texts:
+                    self.queue.task_done()
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until the queued messages were delivered; ``False`` on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+
+def _retry_after(exc: Exception) -> Optional[float]:
+    """Return the ``Retry-After`` seconds of a 429 answer, capped, if it has one."""
+    if not isinstance(exc, error.HTTPError) or exc.code != 429 or exc.headers is None:
+        return None
+    value = exc.headers.get("Retry-After", "").strip()
+    if not value.isdigit():
+        return None
+    return min(float(value), http_client.MAX_RETRY_AFTER)
+
+
+def get_dispatcher(webhook: str) -> Dispatcher:
+    """Return the dispatcher shared by every action posting to ``webhook``."""
+    with _lock:
+        dispatcher = _dispatchers.get(webhook)
+        if dispatcher is None:
+            dispatcher = _dispatchers[webhook] = Dispatcher(webhook)
+        return dispatcher
+
+
+def drain(timeout: float = DRAIN_TIMEOUT) -> bool:
+    """Deliver every queued message without waiting for digest windows."""
+    with _lock:
+        dispatchers = list(_dispatchers.values())
+    deadline = time.monotonic() + timeout
+    done = True
+    for dispatcher in dispatchers:
+        dispatcher._draining = True
+        try:
+            done = dispatcher.join(max(0.0, deadline - time.monotonic())) and done
+        finally:
+            dispatcher._draining = False
+    if not done:
+        logging.warning("Undelivered Slack notifications left in the queue")
+    return done
+
+
+atexit.register(drain)
@@ -0,0 +1,167 @@
+"""Pool of authenticated SMTP sessions.
+
+Opening an SMTP connection costs a TCP handshake, often STARTTLS and a
+login, so ``email_send`` and the engine's admin alerts reuse sessions kept
+here. A session that was idle for a while is checked with ``NOOP`` before
+it is reused, and one idle for too long is closed. If the server drops a
+reused session mid-send, the message is sent again over a new connection.
+"""
+
+from __future__ import annotations
+
+import atexit
+from email.message import EmailMessage
+import logging
+import smtplib
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Sessions idle longer than this are closed instead of reused.
+IDLE_TIMEOUT = 120.0
+# Sessions idle longer than this are checked with NOOP before reuse.
+NOOP_AFTER = 15.0
+# Idle sessions kept per server and account.
+MAX_IDLE = 2
+
+_Key = Tuple[str, int, Optional[str], bool]
+
+_lock = threading.Lock()
+_idle: Dict[_Key, List[Tuple[float, Any]]] = {}
+
+
+class SendError(smtplib.SMTPException):
+    """A message of a batch could not be sent.
+
+    ``sent`` counts the messages before it that were delivered; the failing
+    message and the ones after it were not. ``permanent`` is true when the
+    server refused the message itself with a 5xx reply, so sending it again
+    would fail the same way.
+    """
+
+    def __init__(self, sent: int, error: BaseException):
+        super().__init__(f"SMTP send failed after {sent} messages: {error}")
+        self.sent = sent
+        self.permanent = isinstance(error, smtplib.SMTPRecipientsRefused) or (
+            isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+        )
+
+
+def _key(settings: Dict[str, Any]) -> _Key:
+    return (
+        str(settings.get("host", "localhost")),
+        int(settings.get("port", 25)),
+        settings.get("username"),
+        bool(settings.get("tls")),
+    )
+
+
+def _connect(settings: Dict[str, Any]) -> Any:
+    host, port, username, use_tls = _key(settings)
+    logging.debug("Opening SMTP session to %s:%s", host, port)
+    smtp = smtplib.SMTP(host, port)
+    try:
+        if use_tls:
+            smtp.starttls()
+        if username and settings.get("password"):
+            smtp.login(username, settings["password"])
+    except BaseException:
+        _close(smtp)
+        raise
+    return smtp
+
+
+def _close(smtp: Any) -> None:
+    for name in ("quit", "close"):
+        method = getattr(smtp, name, None)
+        if method is None:
+            continue
+        try:
+            method()
+            return
+        except Exception:  # pylint: disable=broad-except
+            continue
+
+
+def _healthy(smtp: Any) -> bool:
+    noop = getattr(smtp, "noop", None)
+    if noop is None:
+        return True
+    try:
+        return noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
+
+
+def _acquire(key: _Key) -> Optional[Any]:
+    """Return a usable idle session for ``key``, or ``None``."""
+    while True:
+        with _lock:
+            sessions = _idle.get(key)
+            if not sessions:
+                return None
+            since, smtp = sessions.pop()
+        idle = time.monotonic() - since
+        if idle < NOOP_AFTER or (idle < IDLE_TIMEOUT and _healthy(smtp)):
+            return smtp
+        _close(smtp)
+
+
+def _release(key: _Key, smtp: Any) -> None:
+    with _lock:
+        sessions = _idle.setdefault(key, [])
+        if len(sessions) < MAX_IDLE:
+            sessions.append((time.monotonic(), smtp))
+            return
+    _close(smtp)
+
+
+def send(settings: Dict[str, Any], messages: Iterable[EmailMessage]) -> None:
+    """Send ``messages`` over one pooled session to the server in ``settings``.
+
+    ``settings`` holds ``host``, ``port``, ``username``, ``password`` and
+    ``tls``. The session returns to the pool afterwards. A failure raises
+    :class:`SendError` after the session has been discarded, telling how
+    many messages were sent before it.
+    """
+    key = _key(settings)
+    sent = 0
+    try:
+        smtp = _acquire(key)
+        reused = smtp is not None
+        if smtp is None:
+            smtp = _connect(settings)
+    except Exception as exc:
+        raise SendError(sent, exc) from exc
+    try:
+        for message in messages:
+            try:
+                smtp.send_message(message)
+            except smtplib.SMTPServerDisconnected:
+                if not reused:
+                    raise
+                # the server closed the idle session; retry once on a new one
+                logging.debug("SMTP session to %s:%s dropped, reconnecting", key[0], key[1])
+                _close(smtp)
+                smtp = _connect(settings)
+                reused = False
+                smtp.send_message(message)
+            sent += 1
+    except BaseException as exc:
+        _close(smtp)
+        if isinstance(exc, Exception):
+            raise SendError(sent, exc) from exc
+        raise
+    _release(key, smtp)
+
+
+def close_all() -> None:
+    """Close every idle session."""
+    with _lock:
+        sessions = [smtp for entries in _idle.values() for _, smtp in entries]
+        _idle.clear()
+    for smtp in sessions:
+        _close(smtp)
+
+
+atexit.register(close_all)
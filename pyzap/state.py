@@ -0,0 +1,70 @@
+"""Private directory holding pyzap's local state.
+
+Caches, upload sessions, indexes and spooled rows contain raw emails, upload
+credentials and sheet data, so they are kept in a per-user directory next to
+the configuration file rather than in the shared system temp directory.
+Directories are created with mode ``0o700`` and files with ``0o600``.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+from typing import IO, Optional
+
+DIR_NAME = ".pyzap"
+
+_lock = threading.Lock()
+_root: Optional[str] = None
+
+
+def configure(config_path: Optional[str] = None, directory: Optional[str] = None) -> str:
+    """Set the state directory and return it.
+
+    ``directory`` wins when given; otherwise the state lives in a ``.pyzap``
+    folder next to ``config_path``.
+    """
+    global _root
+    if directory:
+        root = os.path.abspath(os.path.expanduser(directory))
+    elif config_path:
+        root = os.path.join(os.path.dirname(os.path.abspath(config_path)), DIR_NAME)
+    else:
+        root = os.path.join(os.path.expanduser("~"), DIR_NAME)
+    with _lock:
+        _root = root
+    return root
+
+
+def root() -> str:
+    """Return the state directory, ``~/.pyzap`` when none was configured."""
+    with _lock:
+        if _root is not None:
+            return _root
+    return configure()
+
+
+def path(*parts: str) -> str:
+    """Return the path of ``parts`` inside the state directory."""
+    return os.path.join(root(), *parts)
+
+
+def private_dir(directory: str) -> str:
+    """Create ``directory`` readable only by the current user."""
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    return directory
+
+
+def open_private(filename: str, mode: str = "w", encoding: Optional[str] = None) -> IO:
+    """Open ``filename`` for writing, creating it with mode ``0o600``.
+
+    ``mode`` is ``"w"``, ``"a"`` or their binary variants.
+    """
+    flags = os.O_WRONLY | os.O_CREAT
+    flags |= os.O_APPEND if mode.startswith("a") else os.O_TRUNC
+    fd = os.open(filename, flags, 0o600)
+    try:
+        return os.fdopen(fd, mode, encoding=encoding)
+    except BaseException:
+        os.close(fd)
+        raise
@@ -1,9 +1,12 @@
 from __future__ import annotations
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import contextmanager
-from typing import Iterator
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+import math
 import os
 import re
+import threading
 import time
 
 try:
@@ -67,3 +70,86 @@ def safe_filename(name: str, max_length: int = 100) -> str:
         base, ext = os.path.splitext(name)
         name = base[: max_length - len(ext)] + ext
     return name
+
+
+def unique_filename(name: str, taken: Set[str]) -> str:
+    """Return ``name``, suffixed with `` (1)``, `` (2)``... if already in ``taken``.
+
+    The returned name is added to ``taken``; names are compared without
+    regard to case.
+    """
+    base, ext = os.path.splitext(name)
+    candidate = name
+    number = 0
+    while candidate.lower() in taken:
+        number += 1
+        candidate = f"{base} ({number}){ext}"
+    taken.add(candidate.lower())
+    return candidate
+
+
+def run_parallel(
+    tasks: Sequence[Callable[[], Any]],
+    *,
+    max_workers: int = 4,
+    timeout: Optional[float] = None,
+) -> List[Tuple[bool, Any]]:
+    """Run ``tasks`` on a bounded thread pool and collect their outcomes.
+
+    Returns one ``(ok, value)`` tuple per task in the original order where
+    ``value`` is the task result or the exception it raised. Each task may
+    run for at most ``timeout`` seconds once started; tasks still running
+    after that are abandoned and reported as :class:`TimeoutError`.
+    """
+
+    if not tasks:
+        return []
+    workers = max(1, min(int(max_workers), len(tasks)))
+    results: List[Tuple[bool, Any]] = [
+        (False, TimeoutError("task did not complete"))
+    ] * len(tasks)
+    started: Dict[int, float] = {}
+    lock = threading.Lock()
+
+    def _run(index: int, func: Callable[[], Any]) -> Any:
+        with lock:
+            started[index] = time.monotonic()
+        return func()
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pyzap")
+    futures = {executor.submit(_run, i, func): i for i, func in enumerate(tasks)}
+    pending = set(futures)
+    # Hung tasks keep their worker busy, so queued tasks get a hard deadline.
+    deadline = None
+    if timeout is not None:
+        deadline = time.monotonic() + timeout * math.ceil(len(tasks) / workers) + 1
+    try:
+        while pending:
+            done, pending = wait(
+                pending,
+                timeout=0.1 if timeout is not None else None,
+                return_when=FIRST_COMPLETED,
+            )
+            for fut in done:
+                try:
+                    results[futures[fut]] = (True, fut.result())
+                except Exception as exc:  # pylint: disable=broad-except
+                    results[futures[fut]] = (False, exc)
+            if timeout is None:
+                continue
+            now = time.monotonic()
+            for fut in list(pending):
+                index = futures[fut]
+                with lock:
+                    start = started.get(index)
+                expired = start is not None and now - start > timeout
+                if expired or now > deadline:
+                    fut.cancel()
+                    pending.discard(fut)
+                    results[index] = (
+                        False,
+                        TimeoutError(f"task timed out after {timeout} seconds"),
+                    )
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
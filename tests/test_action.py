@@ -1,3 +1,4 @@
+import io
 import json
 import urllib.request
 import sys
@@ -10,6 +11,7 @@ ROOT = Path(__file__).resolve().parents[1]
 if str(ROOT) not in sys.path:
     sys.path.insert(0, str(ROOT))
 
+from pyzap import google_auth, http_client
 from pyzap.plugins.slack_notify import SlackNotifyAction
 from pyzap.plugins.sheets_append import SheetsAppendAction
 from pyzap.plugins.gdrive_upload import GDriveUploadAction
@@ -36,7 +38,7 @@ def _patch_urlopen(monkeypatch, store):
         store['req'] = req
         store.setdefault('reqs', []).append(req)
         return DummyResponse()
-    monkeypatch.setattr(urllib.request, 'urlopen', fake)
+    monkeypatch.setattr(http_client, 'urlopen', fake)
 
 
 def _setup_openpyxl(monkeypatch):
@@ -188,6 +190,7 @@ def _setup_gmail(monkeypatch):
     }
     for name, mod in modules.items():
         monkeypatch.setitem(sys.modules, name, mod)
+    google_auth.clear()
 
 
 def _setup_gmail_html(monkeypatch):
@@ -297,6 +300,7 @@ def _setup_gmail_html(monkeypatch):
     }
     for name, mod in modules.items():
         monkeypatch.setitem(sys.modules, name, mod)
+    google_auth.clear()
 
 
 def _setup_gmail_bad_filename(monkeypatch):
@@ -400,6 +404,7 @@ def _setup_gmail_bad_filename(monkeypatch):
     }
     for name, mod in modules.items():
         monkeypatch.setitem(sys.modules, name, mod)
+    google_auth.clear()
 
     return bad_name
 
@@ -414,7 +419,7 @@ def test_slack_notify(monkeypatch):
     assert json.loads(req.data.decode()) == {'text': 'hi'}
 
 
-def test_sheets_append(monkeypatch):
+def test_sheets_append(monkeypatch, tmp_path):
     store = {}
     def fake(req):
         store.setdefault('reqs', []).append(req)
@@ -423,15 +428,19 @@ def test_sheets_append(monkeypatch):
         store['req'] = req
         return DummyResponse()
 
-    monkeypatch.setattr(urllib.request, 'urlopen', fake)
-    action = SheetsAppendAction({'sheet_id': 'SID', 'range': 'Sheet1!A1', 'token': 'T'})
+    monkeypatch.setattr(http_client, 'urlopen', fake)
+    action = SheetsAppendAction(
+        {'sheet_id': 'SID', 'range': 'Sheet1!A1', 'token': 'T', 'index_dir': str(tmp_path)}
+    )
     action.execute({'values': ['a', 'b']})
+    assert 'req' not in store
+    action.flush()
     req = store['req']
     assert 'SID' in req.full_url
     assert 'Sheet1%21A1' in req.full_url
     assert req.headers['Authorization'] == 'Bearer T'
     assert json.loads(req.data.decode()) == {'values': [['a', 'b']]}
-    assert len(store['reqs']) == 2
+    assert len([r for r in store['reqs'] if r.data is not None]) == 1
 
 
 def test_gdrive_upload(monkeypatch, tmp_path):
@@ -451,12 +460,84 @@ def test_gdrive_upload_status_error(monkeypatch):
     def fake(req):
         return DummyResponse(status=400)
 
-    monkeypatch.setattr(urllib.request, 'urlopen', fake)
+    monkeypatch.setattr(http_client, 'urlopen', fake)
     action = GDriveUploadAction({'folder_id': 'FID', 'token': 'TT'})
     with pytest.raises(RuntimeError):
         action.execute({'content': b'data'})
 
 
+def test_gdrive_upload_resumable_resumes_session(monkeypatch, tmp_path):
+    import stat
+    import urllib.error
+    from pyzap import state as pyzap_state
+    from pyzap.plugins import gdrive_upload
+
+    # sessions are kept in the private state directory by default
+    pyzap_state.configure(str(tmp_path / 'config.json'))
+    sessions = tmp_path / '.pyzap' / 'gdrive-sessions.json'
+
+    monkeypatch.setattr(gdrive_upload.time, 'sleep', lambda s: None)
+    chunk = gdrive_upload.CHUNK_ALIGNMENT
+    data = bytes(range(256)) * (chunk * 3 // 256 - 100)
+    file_path = tmp_path / 'scan.pdf'
+    file_path.write_bytes(data)
+    received = bytearray()
+    calls = []
+    state = {'fail': True}
+
+    def fake(req):
+        method = req.get_method()
+        rng = req.headers.get('Content-range', '')
+        calls.append((method, rng))
+        if method == 'POST':
+            assert 'uploadType=resumable' in req.full_url
+            assert req.headers['X-upload-content-length'] == str(len(data))
+            resp = DummyResponse()
+            resp.headers = {'Location': 'https://upload/session/1'}
+            return resp
+        assert req.full_url == 'https://upload/session/1'
+        if rng.startswith('bytes */'):
+            raise urllib.error.HTTPError(
+                req.full_url, 308, 'Resume Incomplete', {'Range': 'bytes=0-%d' % (len(received) - 1)}, None
+            )
+        start = int(rng.split()[1].split('-')[0])
+        if start > 0 and state['fail']:
+            raise urllib.error.URLError('connection reset')
+        assert start == len(received)
+        assert len(req.data) <= chunk
+        received.extend(req.data)
+        if len(received) < len(data):
+            raise urllib.error.HTTPError(
+                req.full_url, 308, 'Resume Incomplete', {'Range': 'bytes=0-%d' % (len(received) - 1)}, None
+            )
+        return DummyResponse()
+
+    monkeypatch.setattr(http_client, 'urlopen', fake)
+    params = {
+        'folder_id': 'FID',
+        'token': 'TT',
+        'resumable_threshold': 1024,
+        'chunk_size': chunk,
+        'max_retries': 0,
+    }
+    with pytest.raises(RuntimeError):
+        GDriveUploadAction(params).execute({'file_path': str(file_path)})
+    assert len(received) == chunk
+    assert 'session/1' in sessions.read_text()
+    assert stat.S_IMODE(sessions.stat().st_mode) == 0o600
+    assert stat.S_IMODE(sessions.parent.stat().st_mode) == 0o700
+
+    # a new run resumes the stored session after the first chunk
+    state['fail'] = False
+    calls.clear()
+    GDriveUploadAction(params).execute({'file_path': str(file_path)})
+    assert bytes(received) == data
+    assert calls[0] == ('PUT', 'bytes */%d' % len(data))
+    assert [c[0] for c in calls].count('POST') == 0
+    assert calls[1][1].startswith('bytes %d-' % chunk)
+    assert json.loads(sessions.read_text()) == {}
+
+
 def test_slack_notify_error(monkeypatch):
     called = False
 
@@ -465,7 +546,7 @@ def test_slack_notify_error(monkeypatch):
         called = True
         raise urllib.error.URLError("fail")
 
-    monkeypatch.setattr(urllib.request, "urlopen", fake)
+    monkeypatch.setattr(http_client, "urlopen", fake)
     action = SlackNotifyAction({"webhook_url": "http://example.com"})
     with pytest.raises(RuntimeError):
         action.execute({"text": "hi"})
@@ -480,7 +561,7 @@ def test_slack_notify_missing(monkeypatch):
         called = True
         return DummyResponse()
 
-    monkeypatch.setattr(urllib.request, "urlopen", fake)
+    monkeypatch.setattr(http_client, "urlopen", fake)
     action = SlackNotifyAction({"webhook_url": ""})
     with pytest.raises(ValueError):
         action.execute({})
@@ -548,20 +629,14 @@ def test_gmail_archive_links(monkeypatch, tmp_path):
     module = importlib.reload(module)
     action_cls = module.GmailArchiveAction
 
-    class DummyLinkResponse:
-        def read(self):
-            return b'linked'
-
-        def __enter__(self):
-            return self
-
-        def __exit__(self, exc_type, exc, tb):
-            pass
+    class DummyLinkResponse(io.BytesIO):
+        def __init__(self):
+            super().__init__(b'linked')
 
-    def fake_urlopen(req):
+    def fake_urlopen(req, timeout=None):
         return DummyLinkResponse()
 
-    monkeypatch.setattr(urllib.request, 'urlopen', fake_urlopen)
+    monkeypatch.setattr(http_client, 'urlopen', fake_urlopen)
     action = action_cls({
         'token_file': 'token.json',
         'local_dir': str(tmp_path),
@@ -584,17 +659,11 @@ def test_gmail_archive_links_no_attachments(monkeypatch, tmp_path):
     module = importlib.reload(module)
     action_cls = module.GmailArchiveAction
 
-    class DummyLinkResponse:
-        def read(self):
-            return b'linked'
-
-        def __enter__(self):
-            return self
-
-        def __exit__(self, exc_type, exc, tb):
-            pass
+    class DummyLinkResponse(io.BytesIO):
+        def __init__(self):
+            super().__init__(b'linked')
 
-    monkeypatch.setattr(urllib.request, 'urlopen', lambda req: DummyLinkResponse())
+    monkeypatch.setattr(http_client, 'urlopen', lambda req, timeout=None: DummyLinkResponse())
     action = action_cls({
         'token_file': 'token.json',
         'local_dir': str(tmp_path),
@@ -649,22 +718,14 @@ def test_gmail_archive_html_link_header(monkeypatch, tmp_path):
     module = importlib.reload(module)
     action_cls = module.GmailArchiveAction
 
-    class DummyLinkResponse:
+    class DummyLinkResponse(io.BytesIO):
         def __init__(self):
+            super().__init__(b'linked')
             self.headers = {
                 'Content-Disposition': 'attachment; filename="file.pdf"'
             }
 
-        def read(self):
-            return b'linked'
-
-        def __enter__(self):
-            return self
-
-        def __exit__(self, exc_type, exc, tb):
-            pass
-
-    monkeypatch.setattr(urllib.request, 'urlopen', lambda req: DummyLinkResponse())
+    monkeypatch.setattr(http_client, 'urlopen', lambda req, timeout=None: DummyLinkResponse())
     action = action_cls({
         'token_file': 'token.json',
         'local_dir': str(tmp_path),
@@ -807,6 +868,79 @@ def test_imap_archive_skip_attachments(monkeypatch, tmp_path):
     assert captured['port'] == 321
 
 
+def test_imap_archive_ignores_invalid_chunk_size(monkeypatch, tmp_path):
+    from pyzap.plugins import imap_archive
+
+    requested = []
+
+    class DummyIMAP:
+        def __init__(self, host, port):
+            pass
+
+        def login(self, u, p):
+            pass
+
+        def select(self, mbox):
+            pass
+
+        def fetch(self, num, parts):
+            requested.append(parts)
+            return ("OK", [(b"1", b"Subject: s\r\n\r\nbody")])
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            pass
+
+    monkeypatch.setattr(imaplib, 'IMAP4_SSL', lambda host, port=993: DummyIMAP(host, port))
+    action = imap_archive.ImapArchiveAction({
+        'host': 'h', 'username': 'u', 'password': 'p', 'local_dir': str(tmp_path),
+        'fetch_chunk_size': 0,
+    })
+    result = action.execute({'id': '1'})
+    assert result['subject'] == 's'
+    assert requested == ["(BODY.PEEK[]<0.%d>)" % imap_archive.DEFAULT_FETCH_CHUNK]
+
+
+def test_imap_archive_fetches_flag_events_by_uid(monkeypatch, tmp_path):
+    from pyzap.plugins.imap_archive import ImapArchiveAction
+
+    calls = []
+
+    class DummyIMAP:
+        def __init__(self, host, port):
+            pass
+
+        def login(self, u, p):
+            pass
+
+        def select(self, mbox):
+            pass
+
+        def response(self, code):
+            return (code, [b"9"])
+
+        def uid(self, command, *args):
+            calls.append((command,) + args)
+            return ("OK", [(b"2 (UID 7 BODY[]<0> {20}", b"Subject: s\r\n\r\nbody")])
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            pass
+
+    monkeypatch.setattr(imaplib, 'IMAP4_SSL', lambda host, port=993: DummyIMAP(host, port))
+    action = ImapArchiveAction({'host': 'h', 'username': 'u', 'password': 'p', 'local_dir': str(tmp_path)})
+    result = action.execute({'id': 'flags-9-7-120', 'uid': '7', 'uidvalidity': '9'})
+    assert result['subject'] == 's'
+    assert calls[0][:2] == ('FETCH', '7')
+
+    with pytest.raises(RuntimeError):
+        action.execute({'id': 'flags-8-7-120', 'uid': '7', 'uidvalidity': '8'})
+
+
 def test_excel_append(monkeypatch, tmp_path):
     _setup_openpyxl(monkeypatch)
     import importlib
@@ -909,7 +1043,7 @@ def test_excel_append_missing_dependency(monkeypatch, tmp_path):
         action.execute({'values': [1, 2]})
 
 
-def test_sheets_append_skip_duplicate(monkeypatch):
+def test_sheets_append_skip_duplicate(monkeypatch, tmp_path):
     store = {}
 
     def fake(req):
@@ -919,10 +1053,13 @@ def test_sheets_append_skip_duplicate(monkeypatch):
         store['req'] = req
         pytest.fail('Should not append when row already exists')
 
-    monkeypatch.setattr(urllib.request, 'urlopen', fake)
-    action = SheetsAppendAction({'sheet_id': 'SID', 'range': 'Sheet1!A1', 'token': 'T'})
+    monkeypatch.setattr(http_client, 'urlopen', fake)
+    action = SheetsAppendAction(
+        {'sheet_id': 'SID', 'range': 'Sheet1!A1', 'token': 'T', 'index_dir': str(tmp_path)}
+    )
     action.execute({'values': ['x', 'y']})
-    assert len(store['reqs']) == 1
+    action.flush()
+    assert all(r.data is None for r in store['reqs'])
 
 
 def test_excel_append_skip_duplicate(monkeypatch, tmp_path):
@@ -1695,3 +1832,154 @@ def test_pdf_split_parse_invoice_date_format(monkeypatch, tmp_path):
     files = sorted(out_dir.glob('*.pdf'))
     assert len(files) == 1
     assert files[0].name == '20250723.pdf'
+
+
+def test_imap_archive_uses_polled_message(monkeypatch, tmp_path):
+    from pyzap import message_cache
+    from pyzap.plugins.imap_poll import ImapPollTrigger
+    from pyzap.plugins.imap_archive import ImapArchiveAction
+
+    message_cache.configure({"disk_dir": str(tmp_path / "cache")})
+    raw = (
+        b"Subject: s\r\nFrom: f\r\nDate: d\r\n"
+        b"Content-Type: multipart/mixed; boundary=ab\r\n\r\n"
+        b"--ab\r\nContent-Type: text/plain\r\n\r\nbody\r\n"
+        b"--ab\r\nContent-Type: text/plain; name=att.txt\r\n"
+        b"Content-Disposition: attachment; filename=att.txt\r\n\r\nfile\r\n"
+        b"--ab--"
+    )
+    fetches = []
+
+    class DummyIMAP:
+        def __init__(self, host, port):
+            pass
+
+        def login(self, u, p):
+            pass
+
+        def select(self, mbox):
+            pass
+
+        def response(self, code):
+            return (code, [b"77"])
+
+        def search(self, charset, query):
+            return ("OK", [b"1"])
+
+        def fetch(self, num, parts):
+            fetches.append(parts)
+            return ("OK", [(b"1 (UID 42 RFC822 {%d}" % len(raw), raw)])
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            pass
+
+    monkeypatch.setattr(imaplib, 'IMAP4_SSL', lambda host, port=993: DummyIMAP(host, port))
+    try:
+        trigger = ImapPollTrigger({'host': 'h', 'username': 'u', 'password': 'p'})
+        msgs = trigger.poll()
+        assert msgs[0]['uid'] == '42'
+        assert msgs[0]['uidvalidity'] == '77'
+
+        action = ImapArchiveAction({'host': 'h', 'username': 'u', 'password': 'p', 'local_dir': str(tmp_path)})
+        result = action.execute(msgs[0])
+        assert (tmp_path / '77-42' / 'att.txt').exists()
+        assert result['attachments'] == ['att.txt']
+        assert len(fetches) == 1
+    finally:
+        message_cache.configure()
+
+
+def test_gmail_archive_renames_duplicate_attachments(monkeypatch, tmp_path):
+    import base64
+    import importlib
+    import json
+    import pyzap.plugins.gmail_archive as module
+    from pyzap.message_cache import gmail_key
+
+    _setup_gmail(monkeypatch)
+    module = importlib.reload(module)
+    msg = {
+        "snippet": "",
+        "payload": {
+            "headers": [],
+            "parts": [
+                {"filename": "a.txt", "body": {"attachmentId": "1"}},
+                {"filename": "A.txt", "body": {"attachmentId": "2"}},
+                {"filename": "a.txt", "body": {"attachmentId": "3"}},
+            ],
+        },
+    }
+    module.get_cache().put(gmail_key("t", "dup"), json.dumps(msg).encode())
+
+    def fake_fetch(self, token_file, msg_id, att_id):
+        return base64.urlsafe_b64encode(b"file " + att_id.encode()).decode()
+
+    monkeypatch.setattr(module.GmailArchiveAction, "_fetch_attachment", fake_fetch)
+    action = module.GmailArchiveAction({"token_file": "t", "local_dir": str(tmp_path)})
+    result = action.execute({"id": "dup"})
+    assert result["attachments"] == ["a.txt", "A (1).txt", "a (2).txt"]
+    folder = tmp_path / "dup"
+    assert (folder / "a.txt").read_bytes() == b"file 1"
+    assert (folder / "A (1).txt").read_bytes() == b"file 2"
+    assert (folder / "a (2).txt").read_bytes() == b"file 3"
+
+
+def test_gmail_archive_downloads_parts_concurrently(monkeypatch, tmp_path):
+    import base64
+    import importlib
+    import threading
+    import pyzap.plugins.gmail_archive as module
+
+    _setup_gmail(monkeypatch)
+    module = importlib.reload(module)
+    module.get_cache().clear()
+    started = []
+    barrier = threading.Barrier(2, timeout=5)
+
+    def fake_fetch(self, token_file, msg_id, att_id):
+        started.append(att_id)
+        barrier.wait()  # both downloads must be in flight at once
+        payload = b"file" if att_id == "1" else b"body text"
+        return base64.urlsafe_b64encode(payload).decode()
+
+    monkeypatch.setattr(module.GmailArchiveAction, "_fetch_attachment", fake_fetch)
+    monkeypatch.setattr(module, "DECODE_CHUNK", 4)
+    action = module.GmailArchiveAction({"token_file": "t", "local_dir": str(tmp_path)})
+    result = action.execute({"id": "m1"})
+    assert sorted(started) == ["1", "2"]
+    assert (tmp_path / "m1" / "a.txt").read_bytes() == b"file"
+    assert (tmp_path / "m1" / "message.txt").read_text() == "body text"
+    assert result["attachments"] == ["a.txt"]
+    assert [p.name for p in tmp_path.iterdir()] == ["m1"]
+
+
+def test_gmail_archive_attachment_retries_rate_limit(monkeypatch):
+    import types
+    import pyzap.plugins.gmail_archive as module
+    from pyzap import google_batch
+
+    sleeps = []
+    monkeypatch.setattr(google_batch.time, "sleep", sleeps.append)
+    attempts = []
+
+    class RateLimited(Exception):
+        resp = types.SimpleNamespace(status=429)
+
+    class Get:
+        def execute(self):
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise RateLimited("429")
+            return {"data": "ZmlsZQ"}
+
+    attachments = types.SimpleNamespace(get=lambda userId, messageId, id: Get())
+    messages = types.SimpleNamespace(attachments=lambda: attachments)
+    service = types.SimpleNamespace(users=lambda: types.SimpleNamespace(messages=lambda: messages))
+    monkeypatch.setattr(module.GmailArchiveAction, "_load_service", lambda self, token: service)
+
+    action = module.GmailArchiveAction({"token_file": "t", "local_dir": "x"})
+    assert action._fetch_attachment("t", "m1", "1") == "ZmlsZQ"
+    assert len(attempts) == 2 and sleeps == [google_batch.DEFAULT_BACKOFF]
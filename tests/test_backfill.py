@@ -0,0 +1,100 @@
+import imaplib
+import json
+import os
+import stat
+import sys
+import threading
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from pyzap import core
+from pyzap.backfill import backfill, date_windows
+from pyzap.plugins.imap_poll import ImapPollTrigger
+
+
+def test_date_windows():
+    windows = date_windows("2025-06-01", "2025-06-16", 7)
+    assert [(a.isoformat(), b.isoformat()) for a, b in windows] == [
+        ("2025-06-01", "2025-06-08"),
+        ("2025-06-08", "2025-06-15"),
+        ("2025-06-15", "2025-06-16"),
+    ]
+
+
+def test_backfill_windows_checkpointed(monkeypatch, tmp_path):
+    searches = []
+    handled = []
+    fail = {"2-Jun-2025"}
+    lock = threading.Lock()
+
+    class DummyIMAP:
+        def __init__(self, host, port):
+            self.query = None
+
+        def login(self, user, pwd):
+            pass
+
+        def select(self, mbox):
+            pass
+
+        def search(self, charset, query):
+            with lock:
+                searches.append(query)
+            self.query = query
+            return ("OK", [b"1"])
+
+        def fetch(self, num, parts):
+            assert parts == "(UID BODY.PEEK[])"
+            since = self.query.split()[4]
+            return ("OK", [(b"1 (UID 1)", ("Subject: %s\r\n\r\nBody" % since).encode())])
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            pass
+
+    class Record(core.BaseAction):
+        def execute(self, data):
+            if data["subject"] in fail:
+                raise RuntimeError("boom")
+            with lock:
+                handled.append(data["subject"])
+
+    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda host, port=993: DummyIMAP(host, port))
+    monkeypatch.setitem(core.TRIGGERS, "imap_poll", ImapPollTrigger)
+    monkeypatch.setitem(core.ACTIONS, "record", Record)
+    cfg = tmp_path / "config.json"
+    cfg.write_text(json.dumps({"workflows": [{
+        "id": "mail",
+        "trigger": {"type": "imap_poll", "host": "h", "username": "u", "password": "p",
+                    "search": "UNSEEN", "from": "sdi"},
+        "actions": [{"type": "record"}],
+    }]}))
+    checkpoint = tmp_path / "ckpt.json"
+
+    summary = backfill(str(cfg), "mail", "2025-06-01", "2025-06-04", parallel=3,
+                       window_days=1, checkpoint_file=str(checkpoint))
+    assert summary == {"done": 2, "skipped": 0, "failed": 1}
+    assert sorted(searches) == [
+        'ALL FROM "sdi" SINCE %d-Jun-2025 BEFORE %d-Jun-2025' % (d, d + 1) for d in (1, 2, 3)
+    ]
+    assert sorted(handled) == ["1-Jun-2025", "3-Jun-2025"]
+
+    # only the failed window runs again
+    fail.clear()
+    searches.clear()
+    summary = backfill(str(cfg), "mail", "2025-06-01", "2025-06-04",
+                       window_days=1, checkpoint_file=str(checkpoint))
+    assert summary == {"done": 1, "skipped": 2, "failed": 0}
+    assert searches == ['ALL FROM "sdi" SINCE 2-Jun-2025 BEFORE 3-Jun-2025']
+    assert len(json.loads(checkpoint.read_text())["done"]) == 3
+
+    # without --checkpoint the file is kept private next to the config
+    backfill(str(cfg), "mail", "2025-06-01", "2025-06-02", window_days=1)
+    default = tmp_path / ".pyzap" / "backfill-mail.json"
+    assert json.loads(default.read_text())["done"] == ["2025-06-01/2025-06-02"]
+    assert stat.S_IMODE(os.stat(default).st_mode) == 0o600
@@ -1,4 +1,5 @@
 import json
+import smtplib
 import sys
 from pathlib import Path
 import threading
@@ -101,7 +102,7 @@ def test_notify_admin(monkeypatch, tmp_path):
             sent["to"] = msg["To"]
             sent["subject"] = msg["Subject"]
 
-    monkeypatch.setattr(core.smtplib, "SMTP", DummySMTP)
+    monkeypatch.setattr(smtplib, "SMTP", DummySMTP)
 
     engine.notify_admin("wf1")
 
@@ -257,3 +258,168 @@ def test_load_plugins(monkeypatch, tmp_path):
 
     assert set(core.TRIGGERS.keys()) == {"foo"}
     assert set(core.ACTIONS.keys()) == {"bar"}
+
+
+def test_workflow_seen_ids_per_account(monkeypatch):
+    class AccountTrigger(core.BaseTrigger):
+        def poll(self):
+            return [{"id": "1", "account": "a"}, {"id": "1", "account": "b"}]
+
+    monkeypatch.setitem(core.TRIGGERS, "acc", AccountTrigger)
+    monkeypatch.setitem(core.ACTIONS, "dummy", DummyAction)
+    wf = core.Workflow({"id": "wf", "trigger": {"type": "acc"}, "actions": [{"type": "dummy"}]})
+    wf.run()
+    wf.run()
+    assert len(wf.actions[0].executed) == 2
+
+
+def test_workflow_consumes_streaming_trigger(monkeypatch):
+    processed = []
+
+    class StreamTrigger(core.BaseTrigger):
+        def poll(self):
+            for i in range(3):
+                yield {"id": str(i)}
+                # each payload is handled before the next one is produced
+                assert processed == [str(n) for n in range(i + 1)]
+
+    class Record(core.BaseAction):
+        def execute(self, data):
+            processed.append(data["id"])
+
+    monkeypatch.setitem(core.TRIGGERS, "stream", StreamTrigger)
+    monkeypatch.setitem(core.ACTIONS, "record", Record)
+    wf = core.Workflow(
+        {"id": "s", "trigger": {"type": "stream"}, "actions": [{"type": "record"}]}
+    )
+    wf.run()
+    assert processed == ["0", "1", "2"]
+
+
+def test_engine_runs_push_workflows_on_thread(monkeypatch, tmp_path):
+    import queue as queue_mod
+
+    events = queue_mod.Queue()
+    handled = queue_mod.Queue()
+
+    class PushTrigger(core.BaseTrigger):
+        push = True
+        closed = False
+
+        def poll(self):
+            try:
+                return [events.get(timeout=0.05)]
+            except queue_mod.Empty:
+                return []
+
+        def close(self):
+            PushTrigger.closed = True
+
+    class Record(core.BaseAction):
+        def execute(self, data):
+            handled.put(data["id"])
+
+    monkeypatch.setitem(core.TRIGGERS, "push", PushTrigger)
+    monkeypatch.setitem(core.ACTIONS, "record", Record)
+    cfg = tmp_path / "cfg.json"
+    cfg.write_text(json.dumps({"workflows": [
+        {"id": "p", "trigger": {"type": "push"}, "actions": [{"type": "record"}]}
+    ]}))
+    engine = core.WorkflowEngine(str(cfg))
+    engine.run_all()
+    engine.run_all()  # does not start a second thread
+    events.put({"id": "e1"})
+    assert handled.get(timeout=2) == "e1"
+    assert len(engine._push_threads) == 1
+    engine.stop()
+    assert PushTrigger.closed
+    engine._push_threads["p"].join(timeout=2)
+    assert not engine._push_threads["p"].is_alive()
+
+
+def test_workflow_commits_successful_payloads(monkeypatch):
+    committed = []
+
+    class AckTrigger(core.BaseTrigger):
+        redeliver = True
+
+        def poll(self):
+            return [{"id": "1"}, {"id": "2"}]
+
+        def commit(self, payloads):
+            committed.append([p["id"] for p in payloads])
+
+    class FailOnTwo(core.BaseAction):
+        def __init__(self, params):
+            super().__init__(params)
+            self.executed = []
+
+        def execute(self, data):
+            self.executed.append(data["id"])
+            if data["id"] == "2":
+                raise RuntimeError("boom")
+
+    monkeypatch.setitem(core.TRIGGERS, "ack", AckTrigger)
+    monkeypatch.setitem(core.ACTIONS, "fail2", FailOnTwo)
+    wf = core.Workflow({"id": "a", "trigger": {"type": "ack"}, "actions": [{"type": "fail2"}]})
+    wf.run()
+    wf.run()
+    # only the successful payload is committed, the failed one is retried
+    assert committed == [["1"]]
+    assert wf.actions[0].executed == ["1", "2", "2"]
+
+
+def test_workflow_flushes_actions_before_commit(monkeypatch):
+    events = []
+
+    class AckTrigger(core.BaseTrigger):
+        def poll(self):
+            return [{"id": "1"}, {"id": "2"}]
+
+        def commit(self, payloads):
+            events.append("commit")
+
+    class Buffered(core.BaseAction):
+        def execute(self, data):
+            events.append(data["id"])
+
+        def flush(self):
+            events.append("flush")
+
+    monkeypatch.setitem(core.TRIGGERS, "ack", AckTrigger)
+    monkeypatch.setitem(core.ACTIONS, "buffered", Buffered)
+    wf = core.Workflow({"id": "a", "trigger": {"type": "ack"}, "actions": [{"type": "buffered"}]})
+    wf.run()
+    assert events == ["1", "2", "flush", "commit"]
+
+
+def test_notify_admin_coalesces_alerts(monkeypatch, tmp_path):
+    config = {
+        "admin_email": "admin@example.com",
+        "smtp": {"host": "alerts.test", "coalesce": 60},
+        "workflows": [],
+    }
+    cfg_path = tmp_path / "config.json"
+    cfg_path.write_text(json.dumps(config))
+    engine = core.WorkflowEngine(str(cfg_path))
+
+    sent = []
+
+    class DummySMTP:
+        def __init__(self, host, port):
+            pass
+
+        def send_message(self, msg):
+            sent.append((msg["Subject"], msg.get_content()))
+
+    monkeypatch.setattr(smtplib, "SMTP", DummySMTP)
+    engine.notify_admin("wf1")
+    engine.notify_admin("wf2")
+    engine.notify_admin("wf1")
+    engine.flush_alerts()
+    assert sent == []
+
+    engine.stop()
+    assert len(sent) == 1
+    assert sent[0][0] == "PyZap: 2 workflows failed"
+    assert "wf1" in sent[0][1] and "wf2" in sent[0][1]
@@ -0,0 +1,266 @@
+import hashlib
+import io
+import json
+import sys
+from pathlib import Path
+from urllib import parse
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from pyzap import drive_index, http_client
+from pyzap.plugins.gdrive_upload import GDriveUploadAction
+
+
+class FakeDrive:
+    """Minimal Drive REST fake recording the calls it receives."""
+
+    def __init__(self):
+        self.files = {}
+        self.calls = []
+
+    def __call__(self, req, timeout=None):
+        url = parse.urlsplit(req.full_url)
+        method = req.get_method()
+        self.calls.append((method, url.path))
+        query = dict(parse.parse_qsl(url.query))
+        if url.path == "/drive/v3/files" and method == "GET":
+            parent = query["q"].split("'")[-4] if "name =" in query["q"] else query["q"].split("'")[1]
+            found = [
+                f for f in self.files.values()
+                if f["parent"] == parent and ("name =" not in query["q"] or "'%s'" % f["name"] in query["q"])
+            ]
+            body = {"files": [{"id": f["id"], "name": f["name"], "md5Checksum": f.get("md5")} for f in found]}
+        elif url.path == "/drive/v3/files" and method == "POST":
+            meta = json.loads(req.data)
+            body = self._add(meta["name"], meta.get("parents", ["root"])[0])
+        elif url.path.startswith("/drive/v3/files/"):
+            file_id = url.path.rsplit("/", 1)[1]
+            body = {"id": file_id, "trashed": file_id not in self.files}
+        elif url.path == "/upload/drive/v3/files":
+            meta, content = self._parts(req.data)
+            body = self._add(meta["name"], meta["parents"][0], content)
+        else:
+            file_id = url.path.rsplit("/", 1)[1]
+            _meta, content = self._parts(req.data)
+            self.files[file_id]["md5"] = hashlib.md5(content).hexdigest()
+            body = {"id": file_id}
+        return io.BytesIO(json.dumps(body).encode())
+
+    def _add(self, name, parent, content=None):
+        file_id = "id%d" % (len(self.files) + 1)
+        self.files[file_id] = {"id": file_id, "name": name, "parent": parent}
+        if content is not None:
+            self.files[file_id]["md5"] = hashlib.md5(content).hexdigest()
+        return {"id": file_id}
+
+    @staticmethod
+    def _parts(data):
+        head, rest = data.split(b"\r\n\r\n", 1)
+        meta_raw, rest = rest.split(b"\r\n--pyzap_boundary\r\n", 1)
+        content = rest.split(b"\r\n\r\n", 1)[1].rsplit(b"\r\n--pyzap_boundary--", 1)[0]
+        return json.loads(meta_raw), content
+
+
+def test_folder_ids_reused_and_persisted(monkeypatch, tmp_path):
+    drive = FakeDrive()
+    monkeypatch.setattr(http_client, "urlopen", drive)
+    drive_index.clear()
+    cache = str(tmp_path / "folders.json")
+    drive.files["old"] = {"id": "old", "name": "msg1", "parent": "P"}
+
+    # an existing folder is found instead of creating a twin
+    assert drive_index.folder_id("msg1", "P", "T", cache_file=cache) == "old"
+    new_id = drive_index.folder_id("msg2", "P", "T", cache_file=cache)
+    assert drive_index.folder_id("msg2", "P", "T", cache_file=cache) == new_id
+    assert [c[0] for c in drive.calls] == ["GET", "GET", "POST"]
+
+    # a new process checks the persisted id once instead of searching
+    drive_index.clear()
+    drive.calls.clear()
+    assert drive_index.folder_id("msg2", "P", "T", cache_file=cache) == new_id
+    assert drive.calls == [("GET", "/drive/v3/files/%s" % new_id)]
+    drive_index.clear()
+
+
+def test_upload_skips_unchanged_files(monkeypatch, tmp_path):
+    drive = FakeDrive()
+    monkeypatch.setattr(http_client, "urlopen", drive)
+    drive_index.clear()
+    drive.files["f1"] = {"id": "f1", "name": "a.pdf", "parent": "F", "md5": hashlib.md5(b"same").hexdigest()}
+    drive.files["f2"] = {"id": "f2", "name": "b.pdf", "parent": "F", "md5": "stale"}
+    uploader = GDriveUploadAction({"folder_id": "F", "token": "T", "skip_unchanged": True})
+
+    uploader.execute({"content": b"same", "filename": "a.pdf"})
+    uploader.execute({"content": b"new", "filename": "b.pdf"})
+    uploader.execute({"content": b"c", "filename": "c.pdf"})
+    uploader.execute({"content": b"c", "filename": "c.pdf"})
+    # one listing, no upload for a.pdf, b.pdf updated in place, c.pdf once
+    assert drive.calls == [
+        ("GET", "/drive/v3/files"),
+        ("PATCH", "/upload/drive/v3/files/f2"),
+        ("POST", "/upload/drive/v3/files"),
+    ]
+    assert drive.files["f2"]["md5"] == hashlib.md5(b"new").hexdigest()
+    assert sorted(f["name"] for f in drive.files.values()) == ["a.pdf", "b.pdf", "c.pdf"]
+    drive_index.clear()
+
+
+def test_upload_files_concurrent_with_rate_limit_backoff(monkeypatch):
+    import threading
+    import urllib.error
+    from pyzap.plugins import gdrive_upload
+
+    lock = threading.Lock()
+    state = {"active": 0, "max": 0, "limited": False}
+    sleeps = []
+
+    def fake(req, timeout=None):
+        name = FakeDrive._parts(req.data)[0]["name"]
+        with lock:
+            state["active"] += 1
+            state["max"] = max(state["max"], state["active"])
+        threading.Event().wait(0.05)
+        with lock:
+            state["active"] -= 1
+        if name == "limited.pdf" and not state["limited"]:
+            state["limited"] = True
+            body = json.dumps({"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}).encode()
+            raise urllib.error.HTTPError(req.full_url, 403, "Forbidden", {}, io.BytesIO(body))
+        if name == "broken.pdf":
+            raise urllib.error.HTTPError(req.full_url, 400, "Bad Request", {}, io.BytesIO(b"{}"))
+        return io.BytesIO(b'{"id": "x"}')
+
+    monkeypatch.setattr(http_client, "urlopen", fake)
+    monkeypatch.setattr(gdrive_upload.time, "sleep", sleeps.append)
+    files = [{"content": b"x", "filename": name} for name in ("a.pdf", "limited.pdf", "broken.pdf", "b.pdf")]
+    results = gdrive_upload.upload_files({"folder_id": "F", "token": "T"}, files, max_workers=4)
+    assert [(r["filename"], r["ok"]) for r in results] == [
+        ("a.pdf", True),
+        ("limited.pdf", True),
+        ("broken.pdf", False),
+        ("b.pdf", True),
+    ]
+    assert results[2]["error"]
+    assert len(sleeps) == 1
+    assert state["max"] > 1
+
+
+def test_imap_archive_names_drive_folders_by_uid(monkeypatch):
+    import imaplib
+
+    from pyzap.plugins.imap_archive import ImapArchiveAction
+
+    class DummyIMAP:
+        def __init__(self, host, port):
+            pass
+
+        def login(self, u, p):
+            pass
+
+        def select(self, mbox):
+            pass
+
+        def response(self, code):
+            return (code, [b"77"])
+
+        def uid(self, command, uid, parts):
+            return ("OK", [(b"1 (UID %s BODY[]<0> {20}" % uid.encode(), b"Subject: %s\r\n\r\nbody" % uid.encode())])
+
+        def fetch(self, num, parts):
+            return ("OK", [(b"1", b"Subject: seq\r\n\r\nbody")])
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            pass
+
+    drive = FakeDrive()
+    monkeypatch.setattr(http_client, "urlopen", drive)
+    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda host, port=993: DummyIMAP(host, port))
+    drive_index.clear()
+    action = ImapArchiveAction({
+        "host": "h", "username": "u", "password": "p", "drive_folder_id": "P", "token": "T",
+    })
+
+    # sequence number 1 is reused by another message after an expunge
+    first = action.execute({"id": "1", "uid": "42", "uidvalidity": "77"})
+    second = action.execute({"id": "1", "uid": "43", "uidvalidity": "77"})
+    assert first["storage_path"] != second["storage_path"]
+    # without a UID the sequence number names nothing, so nothing is reused
+    third = action.execute({"id": "1"})
+    fourth = action.execute({"id": "1"})
+    assert third["storage_path"] != fourth["storage_path"]
+    folders = sorted(f["name"] for f in drive.files.values() if f["parent"] == "P")
+    assert folders == ["1", "1", "77-42", "77-43"]
+    drive_index.clear()
+
+
+def test_imap_archive_raises_on_failed_upload(monkeypatch):
+    import imaplib
+    import urllib.error
+
+    import pytest
+
+    from pyzap.plugins.imap_archive import ImapArchiveAction
+
+    class DummyIMAP:
+        def __init__(self, host, port):
+            pass
+
+        def login(self, u, p):
+            pass
+
+        def select(self, mbox):
+            pass
+
+        def fetch(self, num, parts):
+            return ("OK", [(b"1", b"Subject: s\r\n\r\nbody")])
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            pass
+
+    class BrokenDrive(FakeDrive):
+        def __call__(self, req, timeout=None):
+            if "/upload/" in req.full_url:
+                raise urllib.error.HTTPError(req.full_url, 400, "Bad Request", {}, io.BytesIO(b"{}"))
+            return super().__call__(req, timeout)
+
+    monkeypatch.setattr(http_client, "urlopen", BrokenDrive())
+    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda host, port=993: DummyIMAP(host, port))
+    drive_index.clear()
+    params = {"host": "h", "username": "u", "password": "p", "drive_folder_id": "P", "token": "T"}
+
+    # the payload must not count as archived when nothing reached Drive
+    with pytest.raises(RuntimeError, match="message.txt"):
+        ImapArchiveAction(params).execute({"id": "1"})
+    result = ImapArchiveAction({**params, "fail_on_upload_error": False}).execute({"id": "1"})
+    assert [(u["filename"], u["ok"]) for u in result["uploads"]] == [("message.txt", False)]
+    drive_index.clear()
+
+
+def test_caches_drop_least_recently_used(monkeypatch):
+    drive = FakeDrive()
+    monkeypatch.setattr(http_client, "urlopen", drive)
+    monkeypatch.setattr(drive_index, "MAX_FOLDERS", 2)
+    monkeypatch.setattr(drive_index, "MAX_LISTINGS", 2)
+    drive_index.clear()
+    ids = [drive_index.folder_id(name, "P", "T") for name in ("a", "b")]
+    assert drive_index.folder_id("a", "P", "T") == ids[0]
+    drive_index.folder_id("c", "P", "T")
+    # "b" was used least recently and is looked up again
+    assert set(drive_index._folders) == {("P", "a"), ("P", "c")}
+    assert ids[1] not in drive_index._verified
+    drive.calls.clear()
+    assert drive_index.folder_id("b", "P", "T") == ids[1]
+    assert drive.calls == [("GET", "/drive/v3/files")]
+
+    for folder in ("F1", "F2", "F3"):
+        drive_index.list_files(folder, "T")
+    assert len(drive_index._listings) == 2
+    drive_index.clear()
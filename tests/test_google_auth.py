@@ -0,0 +1,149 @@
+import datetime as dt
+import json
+import os
+import sys
+import types
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from pyzap import google_auth
+
+
+def _setup(monkeypatch, expiry):
+    loads = []
+    builds = []
+    refreshes = []
+
+    class DummyCreds:
+        expired = False
+        refresh_token = "r"
+        # scopes the token endpoint grants on refresh; None grants the requested ones
+        grant = None
+
+        def __init__(self, token, scopes=None):
+            self.token = token
+            self.expiry = expiry
+            self.scopes = scopes
+            self.granted_scopes = scopes
+
+        def refresh(self, request):
+            refreshes.append(self.token)
+            self.token = "fresh"
+            self.expiry = dt.datetime.utcnow() + dt.timedelta(hours=1)
+            self.granted_scopes = DummyCreds.grant or self.scopes
+
+        def to_json(self):
+            info = {"token": self.token, "expiry": self.expiry.isoformat()}
+            if self.scopes:
+                info["scopes"] = self.scopes
+            return json.dumps(info)
+
+        @staticmethod
+        def from_authorized_user_file(path, scopes):
+            with open(path, encoding="utf-8") as fh:
+                info = json.load(fh)
+            creds = DummyCreds(info["token"], scopes)
+            if "expiry" in info:
+                creds.expiry = dt.datetime.fromisoformat(info["expiry"])
+            loads.append(creds.token)
+            return creds
+
+    def build(api, version, credentials=None, cache_discovery=True):
+        builds.append((api, credentials.token))
+        return object()
+
+    creds_mod = types.ModuleType("google.oauth2.credentials")
+    creds_mod.Credentials = DummyCreds
+    req_mod = types.ModuleType("google.auth.transport.requests")
+    req_mod.Request = object
+    disc = types.ModuleType("googleapiclient.discovery")
+    disc.build = build
+    monkeypatch.setitem(sys.modules, "google.oauth2.credentials", creds_mod)
+    monkeypatch.setitem(sys.modules, "google.auth.transport.requests", req_mod)
+    monkeypatch.setitem(sys.modules, "googleapiclient.discovery", disc)
+    google_auth.clear()
+    return loads, builds, refreshes
+
+
+def test_service_cached_per_token_file(monkeypatch, tmp_path):
+    expiry = dt.datetime.utcnow() + dt.timedelta(hours=1)
+    loads, builds, refreshes = _setup(monkeypatch, expiry)
+    token = tmp_path / "token.json"
+    token.write_text(json.dumps({"token": "a"}))
+
+    first = google_auth.get_service("gmail", "v1", str(token), ["s"])
+    second = google_auth.get_service("gmail", "v1", str(token), ["s"])
+    assert first is second
+    assert loads == ["a"] and builds == [("gmail", "a")] and refreshes == []
+
+    # a re-authorised token file is picked up
+    token.write_text(json.dumps({"token": "b"}))
+    os.utime(token, (1, 1))
+    third = google_auth.get_service("gmail", "v1", str(token), ["s"])
+    assert third is not first
+    assert loads == ["a", "b"]
+
+
+def test_refreshes_before_expiry_and_saves_token(monkeypatch, tmp_path):
+    expiry = dt.datetime.utcnow() + dt.timedelta(seconds=60)
+    loads, builds, refreshes = _setup(monkeypatch, expiry)
+    token = tmp_path / "token.json"
+    token.write_text(json.dumps({"token": "old"}))
+
+    creds = google_auth.get_credentials(str(token), ["s"])
+    assert refreshes == ["old"]
+    assert creds.token == "fresh"
+    assert json.loads(token.read_text())["token"] == "fresh"
+    assert not (tmp_path / "token.json.tmp").exists()
+
+    # the written token does not cause a reload
+    google_auth.get_credentials(str(token), ["s"])
+    assert loads == ["old"] and refreshes == ["old"]
+
+
+def test_token_file_refreshed_once_for_all_plugins(monkeypatch, tmp_path):
+    expiry = dt.datetime.utcnow() + dt.timedelta(seconds=60)
+    loads, builds, refreshes = _setup(monkeypatch, expiry)
+    token = tmp_path / "token.json"
+    token.write_text(json.dumps({"token": "old"}))
+    monkeypatch.delenv("GDRIVE_TOKEN_FILE", raising=False)
+
+    # REST plugins and the Gmail service share one refresh of the file
+    assert google_auth.bearer_token({"token_file": str(token), "token": "static"}) == "fresh"
+    google_auth.get_service("gmail", "v1", str(token), ["s"])
+    assert refreshes == ["old"]
+    assert builds == [("gmail", "fresh")]
+
+    assert google_auth.bearer_token({"token": "static"}) == "static"
+    monkeypatch.setenv("GDRIVE_TOKEN_FILE", str(token))
+    assert google_auth.bearer_token({}) == "fresh"
+
+
+def test_refresh_keeps_the_scopes_of_the_token_file(monkeypatch, tmp_path):
+    expiry = dt.datetime.utcnow() + dt.timedelta(seconds=60)
+    loads, builds, refreshes = _setup(monkeypatch, expiry)
+    token = tmp_path / "token.json"
+    scopes = ["gmail.modify", "gmail.readonly"]
+    token.write_text(json.dumps({"token": "old", "scopes": scopes}))
+
+    # polling asks for readonly only, the later commit needs modify
+    google_auth.get_service("gmail", "v1", str(token), ["gmail.readonly"])
+    assert json.loads(token.read_text())["scopes"] == scopes
+    creds = google_auth.get_credentials(str(token), ["gmail.modify"])
+    assert creds.scopes == scopes and creds.token == "fresh"
+    assert refreshes == ["old"]
+
+
+def test_narrowed_token_is_not_written_back(monkeypatch, tmp_path):
+    expiry = dt.datetime.utcnow() + dt.timedelta(seconds=60)
+    loads, builds, refreshes = _setup(monkeypatch, expiry)
+    # the token endpoint grants less than the file records
+    sys.modules["google.oauth2.credentials"].Credentials.grant = ["gmail.readonly"]
+    token = tmp_path / "token.json"
+    token.write_text(json.dumps({"token": "old", "scopes": ["gmail.modify", "gmail.readonly"]}))
+
+    google_auth.get_credentials(str(token), ["gmail.readonly"])
+    assert json.loads(token.read_text())["token"] == "old"
@@ -0,0 +1,99 @@
+import io
+import sys
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from pyzap import http_client
+from pyzap.link_download import LinkDownloader
+
+
+class FakeResponse(io.BytesIO):
+    def __init__(self, body, headers=None):
+        super().__init__(body)
+        self.headers = headers or {}
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        return super().read(size)
+
+
+def test_links_checked_before_download(monkeypatch, tmp_path):
+    responses = {
+        "http://h/a.pdf": FakeResponse(b"%PDF-1.4 data"),
+        "http://h/b.exe": FakeResponse(b"MZ"),
+        "http://h/error.pdf": FakeResponse(b"<!DOCTYPE html><p>login</p>"),
+        "http://h/big.pdf": FakeResponse(b"", {"Content-Length": "999"}),
+        "http://h/download?id=7": FakeResponse(b"%PDF-1.7"),
+    }
+    seen = {}
+
+    def fake_urlopen(req, timeout=None):
+        seen[req.full_url] = timeout
+        return responses[req.full_url]
+
+    monkeypatch.setattr(http_client, "urlopen", fake_urlopen)
+    downloader = LinkDownloader(allowed=[".pdf"], max_bytes=100, timeout=5)
+    names = downloader.download_all(list(responses), tmp_path)
+    assert names == ["a.pdf", "download.pdf"]
+    assert (tmp_path / "a.pdf").read_bytes() == b"%PDF-1.4 data"
+    assert (tmp_path / "download.pdf").read_bytes() == b"%PDF-1.7"
+    # rejected by name or size without reading the body
+    assert responses["http://h/b.exe"].reads == 0
+    assert responses["http://h/big.pdf"].reads == 0
+    assert set(seen.values()) == {5}
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.pdf", "download.pdf"]
+
+
+def test_links_cached_and_limited_per_host(monkeypatch, tmp_path):
+    active = {"now": 0, "max": 0}
+    lock = threading.Lock()
+    calls = []
+
+    def fake_urlopen(req, timeout=None):
+        calls.append(req.full_url)
+        with lock:
+            active["now"] += 1
+            active["max"] = max(active["max"], active["now"])
+        time.sleep(0.05)
+        with lock:
+            active["now"] -= 1
+        return FakeResponse(b"%PDF " + req.full_url.encode())
+
+    monkeypatch.setattr(http_client, "urlopen", fake_urlopen)
+    cache = tmp_path / "cache"
+    urls = [f"http://sdi.example/f{i}.pdf" for i in range(4)]
+    downloader = LinkDownloader(max_workers=4, per_host=2, cache_dir=str(cache))
+    assert len(downloader.download_all(urls, tmp_path / "one")) == 4
+    assert active["max"] == 2
+
+    calls.clear()
+    again = LinkDownloader(cache_dir=str(cache))
+    assert again.download_all(urls[:1], tmp_path / "two") == ["f0.pdf"]
+    assert calls == []
+    assert (tmp_path / "two" / "f0.pdf").read_bytes() == b"%PDF " + urls[0].encode()
+
+
+def test_links_with_same_name_saved_separately(monkeypatch, tmp_path):
+    from pyzap import link_download
+
+    barrier = threading.Barrier(2, timeout=5)
+
+    def fake_urlopen(req, timeout=None):
+        barrier.wait()  # both downloads write at the same time
+        return FakeResponse(b"%PDF " + req.full_url.encode())
+
+    monkeypatch.setattr(http_client, "urlopen", fake_urlopen)
+    urls = ["http://a.example/doc.pdf", "http://b.example/doc.pdf"]
+    names = LinkDownloader(max_workers=2).download_all(urls, tmp_path, {"doc (1).pdf"})
+    assert sorted(names) == ["doc (2).pdf", "doc.pdf"]
+    contents = {(tmp_path / name).read_bytes() for name in names}
+    assert contents == {b"%PDF " + url.encode() for url in urls}
+    # per-URL and per-host locks are released once unused
+    assert len(link_download._url_locks) == 0
+    assert len(link_download._host_slots) == 0
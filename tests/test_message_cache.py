@@ -0,0 +1,64 @@
+import stat
+import sys
+from pathlib import Path
+
+# Ensure project root on path for test imports
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from pyzap import message_cache, state
+from pyzap.message_cache import MessageCache, imap_key
+
+
+def test_cache_spills_to_disk(tmp_path):
+    cache = MessageCache(memory_bytes=10, disk_dir=str(tmp_path))
+    cache.put(imap_key("h", "INBOX", "1", "1"), b"a" * 8)
+    cache.put(imap_key("h", "INBOX", "1", "2"), b"b" * 8)
+    # first entry no longer fits in memory and lives on disk
+    assert len(list(tmp_path.glob("*.eml"))) == 1
+    assert cache.get(imap_key("h", "INBOX", "1", "1")) == b"a" * 8
+    assert cache.get(imap_key("h", "INBOX", "1", "2")) == b"b" * 8
+
+
+def test_cache_evicts_by_disk_size(tmp_path):
+    cache = MessageCache(memory_bytes=0, disk_dir=str(tmp_path), disk_bytes=10)
+    cache.put(("k", "1"), b"x" * 6)
+    cache.put(("k", "2"), b"y" * 6)
+    assert cache.get(("k", "1")) is None
+    assert cache.get(("k", "2")) == b"y" * 6
+
+
+def test_cache_evicts_by_age(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(message_cache.time, "time", lambda: now[0])
+    cache = MessageCache(disk_dir=str(tmp_path), max_age=60)
+    cache.put(("k", "1"), b"data")
+    now[0] += 30
+    assert cache.get(("k", "1")) == b"data"
+    now[0] += 60
+    assert cache.get(("k", "1")) is None
+
+
+def test_cache_reloads_disk_entries(tmp_path):
+    first = MessageCache(memory_bytes=0, disk_dir=str(tmp_path))
+    first.put(("k", "1"), b"persisted")
+    second = MessageCache(disk_dir=str(tmp_path))
+    assert second.get(("k", "1")) == b"persisted"
+
+
+def test_cache_disabled(tmp_path):
+    cache = MessageCache(disk_dir=str(tmp_path), enabled=False)
+    cache.put(("k", "1"), b"data")
+    assert cache.get(("k", "1")) is None
+
+
+def test_cache_defaults_to_private_state_dir(tmp_path):
+    state.configure(str(tmp_path / "config.json"))
+    cache = MessageCache(memory_bytes=0)
+    cache.put(("k", "1"), b"raw email")
+    disk_dir = tmp_path / ".pyzap" / "message-cache"
+    assert cache.disk_dir == str(disk_dir)
+    assert stat.S_IMODE(disk_dir.stat().st_mode) == 0o700
+    (entry,) = disk_dir.glob("*.eml")
+    assert stat.S_IMODE(entry.stat().st_mode) == 0o600
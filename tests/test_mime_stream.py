@@ -0,0 +1,64 @@
+import base64
+import email
+import io
+import sys
+from pathlib import Path
+
+# Ensure project root on path for test imports
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from pyzap.mime_stream import stream_parts
+
+
+def _collect(raw):
+    parts = []
+
+    def on_part(headers, is_root):
+        buf = io.BytesIO()
+        parts.append((headers.get_content_type(), headers.get_filename(), buf))
+        return buf
+
+    root = stream_parts(io.BytesIO(raw), on_part)
+    return root, [(ct, name, buf.getvalue()) for ct, name, buf in parts]
+
+
+def test_stream_parts_matches_email_parser():
+    payload = bytes(range(256)) * 50
+    encoded = base64.encodebytes(payload)
+    raw = (
+        b"Subject: s\r\nFrom: f\r\n"
+        b"Content-Type: multipart/mixed; boundary=outer\r\n\r\n"
+        b"preamble\r\n"
+        b"--outer\r\n"
+        b"Content-Type: multipart/alternative; boundary=inner\r\n\r\n"
+        b"--inner\r\nContent-Type: text/plain\r\n"
+        b"Content-Transfer-Encoding: quoted-printable\r\n\r\n"
+        b"caf=C3=A9 soft=\r\nbreak\r\nsecond line\r\n"
+        b"--inner\r\nContent-Type: text/html\r\n\r\n<p>x</p>\r\n"
+        b"--inner--\r\n"
+        b"--outer\r\nContent-Type: application/pdf\r\n"
+        b"Content-Disposition: attachment; filename=\"a.pdf\"\r\n"
+        b"Content-Transfer-Encoding: base64\r\n\r\n"
+        + encoded.replace(b"\n", b"\r\n")
+        + b"--outer--\r\nepilogue\r\n"
+    )
+    root, parts = _collect(raw)
+    assert root["Subject"] == "s"
+
+    expected = [
+        (p.get_content_type(), p.get_filename(), p.get_payload(decode=True))
+        for p in email.message_from_bytes(raw).walk()
+        if not p.is_multipart()
+    ]
+    assert [(ct, name) for ct, name, _ in parts] == [(ct, name) for ct, name, _ in expected]
+    assert parts[0][2].replace(b"\r\n", b"\n") == expected[0][2].replace(b"\r\n", b"\n")
+    assert parts[1][2] == expected[1][2]
+    assert parts[2][2] == payload == expected[2][2]
+
+
+def test_stream_parts_single_part():
+    raw = b"Subject: s\r\n\r\nline one\r\nline two"
+    root, parts = _collect(raw)
+    assert parts == [("text/plain", None, b"line one\r\nline two")]
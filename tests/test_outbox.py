@@ -0,0 +1,92 @@
+import os
+import stat
+import sys
+import threading
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from pyzap import core, outbox, state
+
+
+def _workflow(monkeypatch, tmp_path, action_cls, **action_def):
+    class ListTrigger(core.BaseTrigger):
+        def poll(self):
+            return [{"id": str(i), "thread": "t%d" % (i % 2)} for i in range(4)]
+
+    monkeypatch.setitem(core.TRIGGERS, "list", ListTrigger)
+    monkeypatch.setitem(core.ACTIONS, "slow", action_cls)
+    outbox.configure({"path": str(tmp_path / "outbox.db"), "workers": 3, "backoff": 0})
+    definition = {
+        "id": "wf",
+        "trigger": {"type": "list"},
+        "actions": [{"type": "slow", "async": True, **action_def}],
+    }
+    return core.Workflow(definition)
+
+
+def test_async_action_runs_off_the_workflow_thread(monkeypatch, tmp_path):
+    release = threading.Event()
+    done = []
+
+    class Slow(core.BaseAction):
+        def execute(self, data):
+            release.wait(5)
+            done.append(data["id"])
+
+    wf = _workflow(monkeypatch, tmp_path, Slow)
+    try:
+        # the workflow does not wait for the action
+        assert wf.run() == 0
+        assert done == []
+        box = outbox.get_outbox()
+        assert box.status()["pending"] + box.status()["running"] == 4
+        release.set()
+        assert box.wait(5)
+        # one key per action: jobs ran in order
+        assert done == ["0", "1", "2", "3"]
+        assert box.status()["done"] == 4
+    finally:
+        outbox.close()
+
+
+def test_outbox_retries_in_order_per_key(monkeypatch, tmp_path):
+    calls = []
+
+    class Flaky(core.BaseAction):
+        def execute(self, data):
+            calls.append(data["id"])
+            if data["id"] == "0" and calls.count("0") < 3:
+                raise RuntimeError("endpoint down")
+            if data["id"] == "1":
+                raise RuntimeError("always fails")
+
+    wf = _workflow(monkeypatch, tmp_path, Flaky, async_key="{thread}")
+    try:
+        wf.run()
+        box = outbox.get_outbox()
+        assert box.wait(5)
+        # job 2 shares job 0's key and waits for its retries
+        assert calls.index("2") > len(calls) - 1 - calls[::-1].index("0")
+        assert box.status() == {"pending": 0, "running": 0, "done": 3, "failed": 1}
+        failed = box.jobs("failed")
+        assert [j["key"] for j in failed] == ["wf/0/t1"]
+        assert "always fails" in failed[0]["error"]
+        assert box.retry_failed() == 1
+    finally:
+        outbox.close()
+
+
+def test_outbox_defaults_to_private_state_dir(tmp_path):
+    state.configure(str(tmp_path / "config.json"))
+    box = outbox.Outbox()
+    try:
+        box.enqueue("wf", 0, object(), {"body": "secret"})
+    finally:
+        box.close()
+    path = tmp_path / ".pyzap" / outbox.FILE_NAME
+    assert box.path == str(path)
+    assert stat.S_IMODE(os.stat(path.parent).st_mode) == 0o700
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
@@ -0,0 +1,205 @@
+import io
+import json
+import os
+import stat
+import sys
+from pathlib import Path
+from urllib import parse
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from pyzap import http_client, sheets_index, state
+from pyzap.plugins import sheets_append
+from pyzap.plugins.sheets_append import SheetsAppendAction
+
+
+class FakeSheet:
+    """Minimal Sheets and Drive REST fake for one spreadsheet."""
+
+    def __init__(self, rows=None):
+        self.rows = [list(r) for r in rows or []]
+        self.version = 1
+        self.calls = []
+
+    def edit(self, *rows):
+        self.rows.extend(list(r) for r in rows)
+        self.version += 1
+
+    def __call__(self, req, timeout=None):
+        url = parse.urlsplit(req.full_url)
+        path = parse.unquote(url.path)
+        self.calls.append(path.rsplit("/", 1)[-1])
+        if path.startswith("/drive/v3/files/"):
+            body = {"version": str(self.version)}
+        elif path.endswith(":batchGet"):
+            ranges = [v for k, v in parse.parse_qsl(url.query) if k == "ranges"]
+            body = {"valueRanges": []}
+            for a1 in ranges:
+                col = sheets_index.column_number(a1.split("!")[1].split(":")[0]) - 1
+                values = [r[col] if col < len(r) else "" for r in self.rows]
+                body["valueRanges"].append({"range": a1, "values": [values]})
+        elif path.endswith(":append"):
+            self.edit(*json.loads(req.data)["values"])
+            body = {}
+        else:
+            body = {"values": self.rows}
+        return io.BytesIO(json.dumps(body).encode())
+
+
+def _action(tmp_path, **params):
+    params = {
+        "sheet_id": "SID",
+        "range": "Sheet1!A1",
+        "token": "T",
+        "index_dir": str(tmp_path),
+        "spool_dir": str(tmp_path / "spool"),
+        "batch_size": 1,
+        **params,
+    }
+    return SheetsAppendAction(params)
+
+
+def test_index_seeds_key_columns_once(monkeypatch, tmp_path):
+    sheets_index.clear()
+    sheet = FakeSheet([["id", "name"], ["1", "old"]])
+    monkeypatch.setattr(http_client, "urlopen", sheet)
+    action = _action(tmp_path, key_columns=["A"])
+
+    action.execute({"values": ["1", "changed"]})
+    action.execute({"values": ["2", "new"]})
+    action.execute({"values": ["2", "again"]})
+
+    assert sheet.rows == [["id", "name"], ["1", "old"], ["2", "new"]]
+    assert sheet.calls.count("values:batchGet") == 1
+    assert "Sheet1" not in sheet.calls
+
+
+def test_index_reseeds_after_outside_edit(monkeypatch, tmp_path):
+    sheets_index.clear()
+    sheet = FakeSheet()
+    monkeypatch.setattr(http_client, "urlopen", sheet)
+    _action(tmp_path).execute({"values": ["a", 1]})
+
+    # a fresh process reuses the index saved on disk
+    sheets_index.clear()
+    sheet.calls.clear()
+    _action(tmp_path).execute({"values": ["a", "1"]})
+    assert sheet.calls == []
+
+    sheet.edit(["b", "2"])
+    _action(tmp_path).execute({"values": ["b", "2"]})
+    assert sheet.rows == [["a", 1], ["b", "2"]]
+    assert sheet.calls.count("Sheet1") == 1
+
+
+def test_index_reseeds_after_edit_racing_an_append(monkeypatch, tmp_path):
+    sheets_index.clear()
+    sheet = FakeSheet()
+    edits = [["b"]]
+
+    def racing(req, timeout=None):
+        resp = sheet(req)
+        if req.data is not None and edits:
+            # someone edits the sheet right after our first append
+            sheet.edit(edits.pop())
+        return resp
+
+    monkeypatch.setattr(http_client, "urlopen", racing)
+    action = _action(tmp_path)
+    action.execute({"values": ["a"]})
+    # the append itself costs no Drive metadata read
+    assert sheet.calls == ["SID", "Sheet1", "Sheet1!A1:append"]
+
+    action.execute({"values": ["b"]})
+    assert sheet.rows == [["a"], ["b"]]
+    assert sheet.calls.count("Sheet1") == 2
+
+
+def test_index_defaults_to_private_state_dir(monkeypatch, tmp_path):
+    sheets_index.clear()
+    state.configure(str(tmp_path / "config.json"))
+    monkeypatch.setattr(http_client, "urlopen", FakeSheet())
+    action = _action(tmp_path)
+    del action.params["index_dir"]
+    action.execute({"values": ["a"]})
+
+    directory = tmp_path / ".pyzap" / sheets_index.INDEX_DIR_NAME
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+    files = list(directory.iterdir())
+    assert {f.suffix for f in files} == {".json", ".rows"}
+    assert all(stat.S_IMODE(os.stat(f).st_mode) == 0o600 for f in files)
+    sheets_index.clear()
+
+
+def test_spool_defaults_to_private_state_dir(monkeypatch, tmp_path):
+    sheets_index.clear()
+    state.configure(str(tmp_path / "config.json"))
+
+    def down(req, timeout=None):
+        raise OSError("offline")
+
+    monkeypatch.setattr(http_client, "urlopen", down)
+    # keep the spooled row away from the flush at exit
+    monkeypatch.setattr(sheets_append, "_buffers", {})
+    action = _action(tmp_path)
+    del action.params["spool_dir"]
+    action.execute({"values": ["a"]})
+
+    directory = tmp_path / ".pyzap" / sheets_append.SPOOL_DIR_NAME
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+    [spool] = directory.iterdir()
+    assert stat.S_IMODE(os.stat(spool).st_mode) == 0o600
+    assert spool.read_text(encoding="utf-8") == '["a"]\n'
+    sheets_index.clear()
+
+
+def test_rows_are_batched_and_spooled(monkeypatch, tmp_path):
+    sheets_index.clear()
+    sheet = FakeSheet()
+    appends = []
+
+    def flaky(req, timeout=None):
+        if req.data is not None:
+            appends.append(json.loads(req.data)["values"])
+            if len(appends) == 1:
+                raise OSError("quota exceeded")
+        return sheet(req)
+
+    monkeypatch.setattr(http_client, "urlopen", flaky)
+    action = _action(tmp_path, batch_size=3, flush_interval=0)
+    action.execute({"values": ["a"]})
+    action.execute({"values": ["b"]})
+    assert appends == []
+    action.execute({"values": ["c"]})
+    assert appends == [[["a"], ["b"], ["c"]]]
+    assert sheet.rows == []
+    assert (tmp_path / "spool").exists()
+
+    action.execute({"values": ["d"]})
+    action.flush()
+    assert appends[1] == [["a"], ["b"], ["c"], ["d"]]
+    assert sheet.rows == [["a"], ["b"], ["c"], ["d"]]
+    assert list((tmp_path / "spool").iterdir()) == []
+
+
+def test_spooled_rows_sent_after_restart_without_new_rows(monkeypatch, tmp_path):
+    sheets_index.clear()
+    monkeypatch.setattr(sheets_append, "_buffers", {})
+    sheet = FakeSheet()
+
+    def down(req, timeout=None):
+        raise OSError("offline")
+
+    monkeypatch.setattr(http_client, "urlopen", down)
+    _action(tmp_path).execute({"values": ["a"]})
+    assert len(list((tmp_path / "spool").iterdir())) == 1
+
+    # a new process only runs the end-of-cycle flush
+    sheets_index.clear()
+    monkeypatch.setattr(sheets_append, "_buffers", {})
+    monkeypatch.setattr(http_client, "urlopen", sheet)
+    _action(tmp_path).flush()
+    assert sheet.rows == [["a"]]
+    assert list((tmp_path / "spool").iterdir()) == []
@@ -0,0 +1,85 @@
+import io
+import json
+import sys
+import urllib.error
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from pyzap import http_client, slack_dispatch
+from pyzap.plugins.slack_notify import SlackNotifyAction
+
+
+class FakeSlack:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.texts = []
+
+    def __call__(self, req, timeout=None):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("connection reset")
+        self.texts.append(json.loads(req.data)["text"])
+        return io.BytesIO(b"ok")
+
+
+def test_digest_merges_queued_notifications(monkeypatch):
+    slack = FakeSlack()
+    monkeypatch.setattr(http_client, "urlopen", slack)
+    action = SlackNotifyAction(
+        {"webhook_url": "http://slack.test/digest", "digest_window": 0.2, "rate_limit": 0}
+    )
+    for text in ("a", "b", "c"):
+        action.execute({"text": text})
+    assert slack.texts == []
+
+    assert slack_dispatch.get_dispatcher("http://slack.test/digest").join(timeout=5)
+    assert slack.texts == ["3 notifications\n• a\n• b\n• c"]
+
+
+def test_queued_notification_is_retried(monkeypatch):
+    slack = FakeSlack(failures=2)
+    monkeypatch.setattr(http_client, "urlopen", slack)
+    action = SlackNotifyAction(
+        {
+            "webhook_url": "http://slack.test/retry",
+            "queued": True,
+            "retry_backoff": 0,
+            "rate_limit": 0,
+        }
+    )
+    action.execute({"text": "hi"})
+    assert slack_dispatch.drain(timeout=5)
+    assert slack.texts == ["hi"]
+
+
+def test_rate_limiter_spaces_calls(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(slack_dispatch.time, "sleep", sleeps.append)
+    limiter = slack_dispatch.RateLimiter(2)
+    for _ in range(3):
+        limiter.wait()
+    assert len(sleeps) == 2
+    assert sleeps[1] > sleeps[0] > 0.4
+
+
+def test_rate_limited_post_waits_for_retry_after(monkeypatch):
+    calls = []
+
+    def limited(req, timeout=None):
+        calls.append(json.loads(req.data)["text"])
+        if len(calls) == 1:
+            headers = {"Retry-After": "7"}
+            raise urllib.error.HTTPError(req.full_url, 429, "Too Many Requests", headers, io.BytesIO(b""))
+        return io.BytesIO(b"ok")
+
+    sleeps = []
+    monkeypatch.setattr(http_client, "urlopen", limited)
+    monkeypatch.setattr(slack_dispatch.time, "sleep", sleeps.append)
+    dispatcher = slack_dispatch.Dispatcher("http://slack.test/limited")
+    dispatcher.limiter.rate = 0
+    dispatcher._deliver("hi")
+    assert calls == ["hi", "hi"]
+    assert sleeps == [7.0]
@@ -0,0 +1,138 @@
+import smtplib
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from pyzap import smtp_pool
+from pyzap.plugins.excel_watch import EmailSendAction
+
+
+class FakeServer:
+    """Factory for fake SMTP sessions recording what each one did."""
+
+    def __init__(self):
+        self.sessions = []
+        # subject -> error raised when a message with it is sent
+        self.errors = {}
+
+    def __call__(self, host, port):
+        session = FakeSession(host, port, self.errors)
+        self.sessions.append(session)
+        return session
+
+
+class FakeSession:
+    def __init__(self, host, port, errors=None):
+        self.host = host
+        self.errors = errors or {}
+        self.calls = []
+        self.sent = []
+        self.dropped = False
+        self.noop_code = 250
+
+    def starttls(self):
+        self.calls.append("starttls")
+
+    def login(self, username, password):
+        self.calls.append("login")
+
+    def noop(self):
+        self.calls.append("noop")
+        return (self.noop_code, b"OK")
+
+    def send_message(self, msg):
+        if self.dropped:
+            raise smtplib.SMTPServerDisconnected("gone")
+        if msg["Subject"] in self.errors:
+            raise self.errors.pop(msg["Subject"])
+        self.sent.append(msg["Subject"])
+
+    def quit(self):
+        self.calls.append("quit")
+
+
+@pytest.fixture
+def server(monkeypatch):
+    fake = FakeServer()
+    monkeypatch.setattr(smtplib, "SMTP", fake)
+    smtp_pool.close_all()
+    yield fake
+    smtp_pool.close_all()
+
+
+def _action(**params):
+    return EmailSendAction(
+        {
+            "host": "mail.test",
+            "username": "u",
+            "password": "p",
+            "tls": True,
+            "from_addr": "a@test",
+            "to_addr": "b@test",
+            **params,
+        }
+    )
+
+
+def test_sessions_are_reused(server):
+    action = _action()
+    for i in range(3):
+        action.execute({"subject": "m%d" % i})
+    assert len(server.sessions) == 1
+    assert server.sessions[0].calls == ["starttls", "login"]
+    assert server.sessions[0].sent == ["m0", "m1", "m2"]
+
+
+def test_dropped_or_unhealthy_sessions_are_replaced(server, monkeypatch):
+    action = _action()
+    action.execute({"subject": "first"})
+    server.sessions[0].dropped = True
+    action.execute({"subject": "second"})
+    assert len(server.sessions) == 2
+    assert server.sessions[1].sent == ["second"]
+
+    monkeypatch.setattr(smtp_pool, "NOOP_AFTER", 0.0)
+    server.sessions[1].noop_code = 421
+    action.execute({"subject": "third"})
+    assert server.sessions[1].calls[-2:] == ["noop", "quit"]
+    assert server.sessions[2].sent == ["third"]
+
+
+def test_batched_emails_share_one_send(server):
+    action = _action(batch_size=10)
+    action.execute({"subject": "a"})
+    action.execute({"subject": "b"})
+    assert server.sessions == []
+    action.flush()
+    assert [s.sent for s in server.sessions] == [["a", "b"]]
+
+
+
+def test_unsent_batch_is_queued_again(server):
+    action = _action(batch_size=10)
+    for subject in ("a", "b", "c"):
+        action.execute({"subject": subject})
+    server.errors["b"] = smtplib.SMTPDataError(451, b"try again later")
+    with pytest.raises(smtp_pool.SendError) as info:
+        action.flush()
+    assert info.value.sent == 1
+    assert server.sessions[0].sent == ["a"]
+
+    # the next flush sends what the failed batch left behind
+    action.flush()
+    assert server.sessions[1].sent == ["b", "c"]
+
+
+def test_refused_email_is_dropped_from_batch(server):
+    action = _action(batch_size=2)
+    server.errors["a"] = smtplib.SMTPRecipientsRefused({"b@test": (550, b"no such user")})
+    action.execute({"subject": "a"})
+    # a full batch failing does not fail the payload that filled it
+    action.execute({"subject": "b"})
+    action.flush()
+    assert [s.sent for s in server.sessions] == [[], ["b"]]
@@ -0,0 +1,34 @@
+import os
+import stat
+import sys
+from pathlib import Path
+
+# Ensure project root on path for test imports
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from pyzap import state
+
+
+def _mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def test_state_dir_next_to_config(tmp_path):
+    config = tmp_path / "conf" / "config.json"
+    assert state.configure(str(config)) == str(tmp_path / "conf" / ".pyzap")
+    assert state.path("cache") == str(tmp_path / "conf" / ".pyzap" / "cache")
+    assert state.configure(str(config), str(tmp_path / "other")) == str(tmp_path / "other")
+
+
+def test_private_files_and_dirs(tmp_path):
+    directory = state.private_dir(str(tmp_path / "private"))
+    assert _mode(directory) == 0o700
+    filename = os.path.join(directory, "secret.json")
+    with state.open_private(filename, encoding="utf-8") as fh:
+        fh.write("one\n")
+    with state.open_private(filename, "a", encoding="utf-8") as fh:
+        fh.write("two\n")
+    assert _mode(filename) == 0o600
+    assert Path(filename).read_text(encoding="utf-8") == "one\ntwo\n"
@@ -1,3 +1,4 @@
+import json
 import sys
 import types
 import imaplib
@@ -10,6 +11,8 @@ ROOT = Path(__file__).resolve().parents[1]
 if str(ROOT) not in sys.path:
     sys.path.insert(0, str(ROOT))
 
+from pyzap import google_auth
+
 
 def _setup_google(monkeypatch, success=True):
     """Create stub google modules for Gmail trigger tests."""
@@ -90,6 +93,7 @@ def _setup_google(monkeypatch, success=True):
     }
     for name, mod in modules.items():
         monkeypatch.setitem(sys.modules, name, mod)
+    google_auth.clear()
 
 
 def _setup_openpyxl(monkeypatch):
@@ -576,7 +580,7 @@ def test_imap_poll_mark_seen_true(monkeypatch):
 
         def fetch(self, num, parts):
             self.parts.append(parts)
-            if parts == "(RFC822)":
+            if parts == "(UID RFC822)":
                 self.seen = True
             return ("OK", [(num, b"Subject: s\r\nFrom: f\r\n\r\nBody")])
 
@@ -591,7 +595,7 @@ def test_imap_poll_mark_seen_true(monkeypatch):
     trigger.poll()
     client = captured["client"]
     assert client.seen
-    assert client.parts == ["(RFC822)"]
+    assert client.parts == ["(UID RFC822)"]
 
 
 def test_imap_poll_mark_seen_false(monkeypatch):
@@ -616,7 +620,7 @@ def test_imap_poll_mark_seen_false(monkeypatch):
 
         def fetch(self, num, parts):
             self.parts.append(parts)
-            if parts == "(RFC822)":
+            if parts == "(UID RFC822)":
                 self.seen = True
             return ("OK", [(num, b"Subject: s\r\nFrom: f\r\n\r\nBody")])
 
@@ -631,7 +635,7 @@ def test_imap_poll_mark_seen_false(monkeypatch):
     trigger.poll()
     client = captured["client"]
     assert not client.seen
-    assert client.parts == ["(BODY.PEEK[])"]
+    assert client.parts == ["(UID BODY.PEEK[])"]
 
 
 def test_imap_poll_missing_config():
@@ -706,3 +710,829 @@ def test_excel_poll_missing_dependency(monkeypatch):
     trigger = ExcelPollTrigger({"file": "book.xlsx"})
     with pytest.raises(RuntimeError):
         trigger.poll()
+
+
+def test_gmail_poll_accounts_parallel_isolated(monkeypatch):
+    """Accounts are polled concurrently and failures do not affect others."""
+    _setup_google(monkeypatch, success=True)
+    import importlib
+    import threading
+    import time
+    module = importlib.import_module("pyzap.plugins.gmail_poll")
+    module = importlib.reload(module)
+    GmailPollTrigger = module.GmailPollTrigger
+
+    active = {"now": 0, "max": 0}
+    lock = threading.Lock()
+
+    def fake_poll(self, token_path, query, max_results, stages=None):
+        with lock:
+            active["now"] += 1
+            active["max"] = max(active["max"], active["now"])
+        time.sleep(0.2)
+        with lock:
+            active["now"] -= 1
+        if token_path == "bad.json":
+            raise RuntimeError("boom")
+        return [{"id": token_path, "token_file": token_path}]
+
+    monkeypatch.setattr(GmailPollTrigger, "_poll_account", fake_poll)
+    trigger = GmailPollTrigger(
+        {
+            "accounts": [
+                {"token_file": "a.json"},
+                {"token_file": "bad.json"},
+                {"token_file": "b.json"},
+            ],
+            "max_workers": 3,
+        }
+    )
+    msgs = trigger.poll()
+    assert [m["id"] for m in msgs] == ["a.json", "b.json"]
+    assert active["max"] == 3
+
+
+def test_gmail_poll_accounts_timeout(monkeypatch):
+    _setup_google(monkeypatch, success=True)
+    import importlib
+    import time
+    module = importlib.import_module("pyzap.plugins.gmail_poll")
+    module = importlib.reload(module)
+    GmailPollTrigger = module.GmailPollTrigger
+
+    def fake_poll(self, token_path, query, max_results, stages=None):
+        if token_path == "slow.json":
+            time.sleep(1)
+        stages[token_path] = {"history_id": "9", "carry": [], "returned": [token_path]}
+        return [{"id": token_path}]
+
+    monkeypatch.setattr(GmailPollTrigger, "_poll_account", fake_poll)
+    trigger = GmailPollTrigger(
+        {
+            "accounts": [{"token_file": "slow.json"}, {"token_file": "fast.json"}],
+            "timeout": 0.2,
+        }
+    )
+    start = time.monotonic()
+    msgs = trigger.poll()
+    assert [m["id"] for m in msgs] == ["fast.json"]
+    assert time.monotonic() - start < 0.9
+    # the abandoned poll must not stage a checkpoint past undelivered mail
+    time.sleep(1)
+    assert list(trigger._staged) == ["fast.json"]
+
+
+def test_imap_poll_accounts(monkeypatch):
+    from pyzap.plugins.imap_poll import ImapPollTrigger
+
+    class DummyIMAP:
+        def __init__(self, host, port):
+            self.host = host
+
+        def login(self, user, pwd):
+            if user == "bad":
+                raise imaplib.IMAP4.error("auth failed")
+
+        def select(self, mbox):
+            pass
+
+        def search(self, charset, query):
+            return ("OK", [b"1"])
+
+        def fetch(self, num, parts):
+            return ("OK", [(b"1", b"Subject: " + self.host.encode() + b"\r\nFrom: f\r\n\r\nBody")])
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            pass
+
+    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda host, port=993: DummyIMAP(host, port))
+    trigger = ImapPollTrigger(
+        {
+            "password": "p",
+            "accounts": [
+                {"host": "h1", "username": "u1"},
+                {"host": "h2", "username": "bad"},
+                {"host": "h3", "username": "u3", "mailbox": "Fatture"},
+            ],
+        }
+    )
+    msgs = trigger.poll()
+    assert [m["subject"] for m in msgs] == ["h1", "h3"]
+    assert [m["account"] for m in msgs] == ["u1@h1/INBOX", "u3@h3/Fatture"]
+
+
+def test_imap_poll_watch_flags_condstore(monkeypatch, tmp_path):
+    from pyzap.plugins.imap_poll import ImapPollTrigger
+
+    state = {"modseq": b"100", "calls": []}
+
+    class DummyIMAP:
+        capabilities = ("IMAP4REV1", "CONDSTORE", "QRESYNC")
+
+        def __init__(self, host, port):
+            self.untagged = {}
+
+        def login(self, user, pwd):
+            pass
+
+        def enable(self, cap):
+            state["calls"].append(("ENABLE", cap))
+
+        def select(self, mbox):
+            self.untagged = {"UIDVALIDITY": b"9", "HIGHESTMODSEQ": state["modseq"]}
+
+        def response(self, code):
+            value = self.untagged.pop(code, None)
+            return (code, value if isinstance(value, list) else [value])
+
+        def uid(self, command, *args):
+            state["calls"].append((command,) + args)
+            if command == "SEARCH":
+                return ("OK", [b"5"])
+            if args[0] == "1:*":
+                self.untagged["VANISHED"] = [b"(EARLIER) 3:4", b"(EARLIER) 11"]
+                return (
+                    "OK",
+                    [
+                        b"1 (UID 5 FLAGS (\\Seen \\Flagged) MODSEQ (110))",
+                        b"2 (UID 7 FLAGS (\\Flagged) MODSEQ (120))",
+                        b"3 (UID 8 FLAGS (\\Seen) MODSEQ (130))",
+                    ],
+                )
+            return ("OK", [(b"2 (UID 7 BODY[] {20}", b"Subject: s\r\n\r\nBody"), b")"])
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            pass
+
+    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda host, port=993: DummyIMAP(host, port))
+    state_file = tmp_path / "modseq.json"
+    config = {
+        "host": "h",
+        "username": "u",
+        "password": "p",
+        "watch_flags": ["\\Flagged"],
+        "include_vanished": True,
+        "state_file": str(state_file),
+    }
+
+    # first poll only records the baseline
+    assert ImapPollTrigger(config).poll() == []
+    assert ("SEARCH", "FLAGGED") in state["calls"]
+
+    state["modseq"] = b"130"
+    state["calls"].clear()
+    trigger = ImapPollTrigger(config)
+    assert trigger.redeliver
+    msgs = trigger.poll()
+    assert ("FETCH", "1:*", "(UID FLAGS)", "(CHANGEDSINCE 100 VANISHED)") in state["calls"]
+    assert msgs[0] == {
+        "id": "vanished-9-130",
+        "event": "vanished",
+        "uids": "3:4,11",
+        "uidvalidity": "9",
+    }
+    assert msgs[1]["uid"] == "7"
+    assert msgs[1]["id"] == "flags-9-7-120"
+    assert msgs[1]["event"] == "flags"
+    assert msgs[1]["subject"] == "s"
+    assert len(msgs) == 2
+
+    # nothing is recorded before the events were processed
+    saved = json.loads(state_file.read_text())["u@h/INBOX"]
+    assert saved["highestmodseq"] == "100"
+    assert saved["flagged"] == [5]
+
+    # the vanished event failed: the old modseq is kept so it comes again,
+    # but the processed flag event is not reported twice
+    trigger.commit([msgs[1]])
+    saved = json.loads(state_file.read_text())["u@h/INBOX"]
+    assert saved["highestmodseq"] == "100"
+    assert saved["flagged"] == [5, 7]
+    msgs = trigger.poll()
+    assert [m["id"] for m in msgs] == ["vanished-9-130"]
+
+    trigger.commit(msgs)
+    saved = json.loads(state_file.read_text())["u@h/INBOX"]
+    assert saved["highestmodseq"] == "130"
+    assert saved["flagged"] == [5, 7]
+
+
+def test_imap_poll_watch_flags_requires_condstore(monkeypatch):
+    from pyzap.plugins.imap_poll import ImapPollTrigger
+
+    class DummyIMAP:
+        capabilities = ("IMAP4REV1",)
+
+        def __init__(self, host, port):
+            pass
+
+        def login(self, user, pwd):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            pass
+
+    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda host, port=993: DummyIMAP(host, port))
+    trigger = ImapPollTrigger(
+        {"host": "h", "username": "u", "password": "p", "watch_flags": "\\Flagged"}
+    )
+    assert trigger.poll() == []
+
+
+def test_imap_poll_filters_pushed_to_search(monkeypatch):
+    from pyzap.plugins.imap_poll import ImapPollTrigger
+
+    captured = {}
+
+    class DummyIMAP:
+        def __init__(self, host, port):
+            pass
+
+        def login(self, user, pwd):
+            pass
+
+        def select(self, mbox):
+            pass
+
+        def search(self, charset, query):
+            captured["query"] = query
+            return ("OK", [b"1 2"])
+
+        def fetch(self, num, parts):
+            subject = "=?utf-8?q?Fattura_n=C2=B0_1?=" if num == b"1" else "Promo"
+            raw = ("Subject: %s\r\nFrom: f\r\n\r\nBody" % subject).encode()
+            return ("OK", [(num, raw)])
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            pass
+
+    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda host, port=993: DummyIMAP(host, port))
+    trigger = ImapPollTrigger(
+        {
+            "host": "h",
+            "username": "u",
+            "password": "p",
+            "from": "notifiche@01s.eu",
+            "subject": "fattura n°",
+            "since": "2025-06-01",
+            "before": "15/06/2025",
+            "larger": 1000,
+            "header": {"X-Priority": "1"},
+        }
+    )
+    msgs = trigger.poll()
+    assert captured["query"] == (
+        'UNSEEN FROM "notifiche@01s.eu" SINCE 1-Jun-2025 BEFORE 15-Jun-2025 '
+        'LARGER 1000 HEADER "X-Priority" "1"'
+    )
+    # the non-ASCII subject filter is evaluated on the client
+    assert [m["id"] for m in msgs] == ["1"]
+
+
+def test_gmail_poll_uses_batch_requests(monkeypatch):
+    _setup_google(monkeypatch)
+    import importlib
+    import pyzap.plugins.gmail_poll as gp
+    from pyzap import google_batch
+
+    importlib.reload(gp)
+    monkeypatch.setattr(google_batch.time, "sleep", lambda s: None)
+
+    class RateLimited(Exception):
+        def __init__(self):
+            super().__init__("429")
+            self.resp = types.SimpleNamespace(status=429)
+
+    class Get:
+        def __init__(self, msg_id):
+            self.msg_id = msg_id
+
+    batches = []
+    throttled = set()
+
+    class Batch:
+        def __init__(self, callback):
+            self.callback = callback
+            self.items = []
+
+        def add(self, request, request_id):
+            self.items.append((request, request_id))
+
+        def execute(self):
+            batches.append(len(self.items))
+            for request, request_id in self.items:
+                if request.msg_id == "3" and "3" not in throttled:
+                    throttled.add("3")
+                    self.callback(request_id, None, RateLimited())
+                elif request.msg_id == "4":
+                    self.callback(request_id, None, RuntimeError("gone"))
+                else:
+                    self.callback(request_id, {"id": request.msg_id}, None)
+
+    class Execute:
+        def __init__(self, data):
+            self.data = data
+
+        def execute(self):
+            return self.data
+
+    class Messages:
+        def list(self, userId="me", q=None, maxResults=None):
+            return Execute({"messages": [{"id": str(i)} for i in range(1, 6)]})
+
+        def get(self, userId="me", id=None, format="full"):
+            return Get(id)
+
+    class Service:
+        def users(self):
+            return types.SimpleNamespace(messages=Messages)
+
+        def new_batch_http_request(self, callback=None):
+            return Batch(callback)
+
+    monkeypatch.setattr(sys.modules["googleapiclient.discovery"], "build", lambda *a, **k: Service())
+    trigger = gp.GmailPollTrigger({"token_file": "t.json", "batch_size": 3})
+    msgs = trigger.poll()
+    assert [m["id"] for m in msgs] == ["1", "2", "3", "5"]
+    # two batches for five messages, plus one retry for the throttled item
+    assert batches == [3, 2, 1]
+
+
+def test_gmail_poll_history_mode(monkeypatch, tmp_path):
+    _setup_google(monkeypatch)
+    import importlib
+    import pyzap.plugins.gmail_poll as gp
+
+    importlib.reload(gp)
+
+    class NotFound(Exception):
+        resp = types.SimpleNamespace(status=404)
+
+    class Execute:
+        def __init__(self, data):
+            self.data = data
+
+        def execute(self):
+            if isinstance(self.data, Exception):
+                raise self.data
+            return self.data
+
+    store = {
+        "1": {"labelIds": ["INBOX"], "from": "notifiche@01s.eu"},
+        "2": {"labelIds": ["INBOX", "STARRED"], "from": "notifiche@01s.eu"},
+        "3": {"labelIds": ["INBOX"], "from": "other@example.com"},
+        "4": {"labelIds": ["INBOX", "Label_7"], "from": "notifiche@01s.eu"},
+    }
+    calls = []
+    history = {"result": None}
+
+    class Messages:
+        def list(self, userId="me", q=None, maxResults=None):
+            calls.append("list")
+            return Execute({"messages": [{"id": "1"}]})
+
+        def get(self, userId="me", id=None, format="full"):
+            item = store[id]
+            return Execute(
+                {
+                    "labelIds": item["labelIds"],
+                    "payload": {"headers": [{"name": "From", "value": item["from"]}]},
+                }
+            )
+
+    class History:
+        def list(self, **kwargs):
+            calls.append(("history", kwargs["startHistoryId"]))
+            return Execute(history["result"])
+
+    class Labels:
+        def list(self, userId="me"):
+            return Execute({"labels": [{"id": "Label_7", "name": "SDI Fatture"}]})
+
+    class Users:
+        def messages(self):
+            return Messages()
+
+        def history(self):
+            return History()
+
+        def labels(self):
+            return Labels()
+
+        def getProfile(self, userId="me"):
+            return Execute({"historyId": "100"})
+
+    monkeypatch.setattr(sys.modules["googleapiclient.discovery"], "build", lambda *a, **k: types.SimpleNamespace(users=Users))
+    state = tmp_path / "state.json"
+    config = {
+        "token_file": "t.json",
+        "query": "from:notifiche@01s.eu label:inbox -is:starred",
+        "history": True,
+        "state_file": str(state),
+    }
+    trigger = gp.GmailPollTrigger(config)
+    msgs = trigger.poll()
+    assert [m["id"] for m in msgs] == ["1"]
+    # the checkpoint is stored once the messages were processed
+    assert not state.exists()
+    trigger.commit(msgs)
+    assert json.loads(state.read_text()) == {"t.json": "100"}
+
+    history["result"] = {
+        "historyId": "120",
+        "history": [
+            {"messagesAdded": [{"message": {"id": "2"}}, {"message": {"id": "3"}}]},
+            {"labelsAdded": [{"message": {"id": "4"}, "labelIds": ["Label_7"]}]},
+        ],
+    }
+    calls.clear()
+    trigger = gp.GmailPollTrigger(config)
+    assert [m["id"] for m in trigger.poll()] == ["4"]
+    assert calls == [("history", "100")]
+    # nothing succeeded, so the next poll stores the checkpoint
+    history["result"] = {"historyId": "120"}
+    assert trigger.poll() == []
+    assert json.loads(state.read_text()) == {"t.json": "120"}
+
+    config["query"] = "label:sdi-fatture"
+    history["result"] = {"historyId": "130", "history": [
+        {"labelsAdded": [{"message": {"id": "4"}}]},
+    ]}
+    trigger = gp.GmailPollTrigger(config)
+    msgs = trigger.poll()
+    assert [m["id"] for m in msgs] == ["4"]
+    trigger.commit(msgs)
+
+    history["result"] = NotFound()
+    calls.clear()
+    trigger = gp.GmailPollTrigger(config)
+    msgs = trigger.poll()
+    assert [m["id"] for m in msgs] == ["1"]
+    assert calls == [("history", "130"), "list"]
+    trigger.commit(msgs)
+    assert json.loads(state.read_text()) == {"t.json": "100"}
+
+
+def test_gmail_poll_history_carries_overflow_and_failures(monkeypatch, tmp_path):
+    _setup_google(monkeypatch)
+    import importlib
+    import pyzap.plugins.gmail_poll as gp
+
+    importlib.reload(gp)
+
+    class Execute:
+        def __init__(self, data):
+            self.data = data
+
+        def execute(self):
+            if isinstance(self.data, Exception):
+                raise self.data
+            return self.data
+
+    broken = {"3"}
+    searches = []
+    history = {"result": {"historyId": "120", "history": [
+        {"messagesAdded": [{"message": {"id": i}} for i in ("1", "2", "3", "4")]},
+    ]}}
+
+    class Messages:
+        def list(self, userId="me", q=None, maxResults=None):
+            searches.append(q)
+            return Execute({"messages": [{"id": "2"}, {"id": "4"}, {"id": "9"}]})
+
+        def get(self, userId="me", id=None, format="full"):
+            if id in broken:
+                return Execute(RuntimeError("backend error"))
+            return Execute({"internalDate": str(int(id) * 1000 + 5000), "payload": {}})
+
+    class History:
+        def list(self, **kwargs):
+            return Execute(history["result"])
+
+    class Users:
+        def messages(self):
+            return Messages()
+
+        def history(self):
+            return History()
+
+    monkeypatch.setattr(
+        sys.modules["googleapiclient.discovery"],
+        "build",
+        lambda *a, **k: types.SimpleNamespace(users=Users),
+    )
+    state = tmp_path / "state.json"
+    state.write_text(json.dumps({"t.json": "100"}))
+    config = {
+        "token_file": "t.json",
+        "query": "from:a OR from:b",
+        "history": True,
+        "state_file": str(state),
+        "max_results": 1,
+    }
+    trigger = gp.GmailPollTrigger(config)
+    msgs = trigger.poll()
+    # OR cannot be checked locally, so Gmail searches after the oldest message
+    assert searches == ["(from:a OR from:b) after:5"]
+    assert [m["id"] for m in msgs] == ["2"]
+    trigger.commit(msgs)
+    saved = json.loads(state.read_text())
+    assert saved == {"t.json": "120", "pending:t.json": ["3", "4"]}
+
+    broken.clear()
+    history["result"] = {"historyId": "121"}
+    msgs = trigger.poll()
+    assert [m["id"] for m in msgs] == ["4"]
+    trigger.commit(msgs)
+    assert json.loads(state.read_text()) == {"t.json": "121"}
+
+
+def test_gmail_poll_metadata_format(monkeypatch):
+    _setup_google(monkeypatch)
+    import importlib
+    import pyzap.plugins.gmail_poll as gp
+    from pyzap.message_cache import get_cache, gmail_key
+
+    importlib.reload(gp)
+    calls = []
+
+    class Execute:
+        def __init__(self, data):
+            self.data = data
+
+        def execute(self):
+            return self.data
+
+    class Messages:
+        def list(self, userId="me", q=None, maxResults=None):
+            return Execute({"messages": [{"id": "m1"}]})
+
+        def get(self, userId="me", id=None, **kwargs):
+            calls.append(kwargs)
+            return Execute({"id": id, "payload": {"headers": []}})
+
+    class Users:
+        def messages(self):
+            return Messages()
+
+    monkeypatch.setattr(
+        sys.modules["googleapiclient.discovery"],
+        "build",
+        lambda *a, **k: types.SimpleNamespace(users=Users),
+    )
+    get_cache().discard(gmail_key("meta.json", "m1"))
+    trigger = gp.GmailPollTrigger(
+        {"token_file": "meta.json", "query": "subject:fattura", "format": "metadata"}
+    )
+    msgs = trigger.poll()
+    assert [m["id"] for m in msgs] == ["m1"]
+    assert calls == [
+        {
+            "format": "metadata",
+            "metadataHeaders": ["From", "To", "Subject", "Date"],
+            "fields": "id,threadId,labelIds,snippet,internalDate,payload/headers",
+        }
+    ]
+    # partial messages are not offered to gmail_archive as cached bodies
+    assert get_cache().get(gmail_key("meta.json", "m1")) is None
+
+
+def test_gmail_poll_metadata_history_searches_attachments(monkeypatch, tmp_path):
+    _setup_google(monkeypatch)
+    import importlib
+    import pyzap.plugins.gmail_poll as gp
+
+    importlib.reload(gp)
+
+    class Execute:
+        def __init__(self, data):
+            self.data = data
+
+        def execute(self):
+            return self.data
+
+    searches = []
+
+    class Messages:
+        def list(self, userId="me", q=None, maxResults=None):
+            searches.append(q)
+            return Execute({"messages": [{"id": "2"}]})
+
+        def get(self, userId="me", id=None, **kwargs):
+            return Execute({"internalDate": "7000", "payload": {"headers": []}})
+
+    class History:
+        def list(self, **kwargs):
+            return Execute({"historyId": "120", "history": [
+                {"messagesAdded": [{"message": {"id": "1"}}, {"message": {"id": "2"}}]},
+            ]})
+
+    class Users:
+        def messages(self):
+            return Messages()
+
+        def history(self):
+            return History()
+
+    monkeypatch.setattr(
+        sys.modules["googleapiclient.discovery"],
+        "build",
+        lambda *a, **k: types.SimpleNamespace(users=Users),
+    )
+    state = tmp_path / "state.json"
+    state.write_text(json.dumps({"t.json": "100"}))
+    trigger = gp.GmailPollTrigger({
+        "token_file": "t.json",
+        "query": "has:attachment",
+        "format": "metadata",
+        "history": True,
+        "state_file": str(state),
+    })
+    assert [m["id"] for m in trigger.poll()] == ["2"]
+    assert searches == ["(has:attachment) after:6"]
+
+
+def test_gmail_poll_backfill_resumes_from_checkpoint(monkeypatch, tmp_path):
+    _setup_google(monkeypatch)
+    import importlib
+    import pyzap.plugins.gmail_poll as gp
+
+    importlib.reload(gp)
+    pages = {None: (["1", "2"], "p2"), "p2": (["3", "4"], "p3"), "p3": (["5"], None)}
+    listed = []
+
+    class Execute:
+        def __init__(self, data):
+            self.data = data
+
+        def execute(self):
+            return self.data
+
+    class Messages:
+        def list(self, userId="me", q=None, maxResults=None, pageToken=None):
+            listed.append(pageToken)
+            ids, nxt = pages[pageToken]
+            data = {"messages": [{"id": i} for i in ids]}
+            if nxt:
+                data["nextPageToken"] = nxt
+            return Execute(data)
+
+        def get(self, userId="me", id=None, format="full"):
+            return Execute({"id": id})
+
+    class Users:
+        def messages(self):
+            return Messages()
+
+    monkeypatch.setattr(
+        sys.modules["googleapiclient.discovery"],
+        "build",
+        lambda *a, **k: types.SimpleNamespace(users=Users),
+    )
+    config = {
+        "token_file": "t.json",
+        "query": "from:notifiche@01s.eu",
+        "backfill": True,
+        "page_size": 2,
+        "state_file": str(tmp_path / "state.json"),
+    }
+    stream = gp.GmailPollTrigger(config).poll()
+    assert not isinstance(stream, list)
+    # consume the first page and part of the second, then "crash"
+    assert [next(stream)["id"] for _ in range(3)] == ["1", "2", "3"]
+    stream.close()
+
+    resumed = [m["id"] for m in gp.GmailPollTrigger(config).poll()]
+    assert resumed == ["3", "4", "5"]
+    assert listed == [None, "p2", "p2", "p3"]
+    assert list(gp.GmailPollTrigger(config).poll()) == []
+
+
+
+def test_webhook_trigger_queue_and_auth():
+    import urllib.error
+    import urllib.request
+    from pyzap.plugins.webhook import WebhookTrigger
+
+    trigger = WebhookTrigger(
+        {"port": 0, "path": "/sdi", "secret": "s3cret", "queue_size": 1, "wait": 0.1}
+    )
+    host, port = trigger.server_address
+    url = f"http://{host}:{port}/sdi"
+
+    def post(body, secret="s3cret", target=url):
+        req = urllib.request.Request(
+            target,
+            data=json.dumps(body).encode(),
+            headers={"X-Pyzap-Secret": secret, "Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=5) as resp:
+                return resp.status
+        except urllib.error.HTTPError as exc:
+            return exc.code
+
+    try:
+        assert post({"id": "1"}, secret="wrong") == 401
+        assert post({"id": "1"}, target=f"http://{host}:{port}/other") == 404
+        assert post({"id": "1"}) == 202
+        assert post({"id": "2"}) == 429
+        assert trigger.poll() == [{"id": "1"}]
+        assert post(["a"]) == 202
+        assert trigger.poll() == [{"data": ["a"]}]
+        assert trigger.poll() == []
+    finally:
+        trigger.close()
+
+
+def test_webhook_trigger_requires_secret_off_loopback():
+    from pyzap.plugins.webhook import WebhookTrigger
+
+    with pytest.raises(ValueError):
+        WebhookTrigger({"host": "0.0.0.0", "port": 0})
+    with pytest.raises(ValueError):
+        WebhookTrigger({"host": "192.0.2.1", "port": 0, "secret": ""})
+    WebhookTrigger({"host": "0.0.0.0", "port": 0, "secret": "s3cret"})
+    WebhookTrigger({"host": "localhost", "port": 0})
+    WebhookTrigger({"host": "::1", "port": 0})
+
+
+def test_imap_poll_on_success_updates_in_batch(monkeypatch):
+    from pyzap.plugins.imap_poll import ImapPollTrigger
+
+    fetched = []
+    commands = []
+
+    class DummyIMAP:
+        capabilities = ("IMAP4REV1", "MOVE")
+
+        def __init__(self, host, port):
+            pass
+
+        def login(self, user, pwd):
+            pass
+
+        def select(self, mbox):
+            pass
+
+        def response(self, code):
+            return ("OK", [b"9"])
+
+        def search(self, charset, query):
+            return ("OK", [b"1 2 3"])
+
+        def fetch(self, num, parts):
+            fetched.append(parts)
+            uid = int(num) + 4
+            return ("OK", [(b"%s (UID %d)" % (num, uid), b"Subject: s\r\n\r\nBody")])
+
+        def uid(self, command, *args):
+            commands.append((command,) + args)
+            return ("OK", [None])
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc, tb):
+            pass
+
+    monkeypatch.setattr(imaplib, "IMAP4_SSL", lambda host, port=993: DummyIMAP(host, port))
+    trigger = ImapPollTrigger(
+        {
+            "host": "h",
+            "username": "u",
+            "password": "p",
+            "on_success": {"add_flags": ["\\Seen", "$Processed"], "move_to": "Done Items"},
+        }
+    )
+    assert trigger.redeliver
+    msgs = trigger.poll()
+    # messages are not marked as read while fetching
+    assert set(fetched) == {"(UID BODY.PEEK[])"}
+    assert [(m["uid"], m["uidvalidity"]) for m in msgs] == [("5", "9"), ("6", "9"), ("7", "9")]
+
+    trigger.commit([msgs[0], msgs[2], msgs[1]])
+    assert commands == [
+        ("STORE", "5:7", "+FLAGS.SILENT", "(\\Seen $Processed)"),
+        ("MOVE", "5:7", '"Done Items"'),
+    ]
+
+    # without MOVE or UIDPLUS the messages stay put rather than expunging
+    # every deleted message of the mailbox
+    commands.clear()
+    DummyIMAP.capabilities = ("IMAP4REV1",)
+    DummyIMAP.expunge = lambda self: commands.append(("EXPUNGE",))
+    trigger.commit(msgs)
+    assert commands == [("STORE", "5:7", "+FLAGS.SILENT", "(\\Seen $Processed)")]